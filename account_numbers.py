@@ -0,0 +1,97 @@
+import os
+import threading
+from typing import List
+from flask import current_app
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from models import AccountNumberSequence
+from app import db
+
+SERIAL_DIGITS = 9
+SEQUENCE_ID = 1
+
+
+def luhn_check_digit(digits: str) -> str:
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_account_number(account_number: str) -> bool:
+    """Valida o dígito verificador dos números gerados pelo alocador (10 dígitos)"""
+    if len(account_number) != SERIAL_DIGITS + 1 or not account_number.isdigit():
+        return False
+    return luhn_check_digit(account_number[:-1]) == account_number[-1]
+
+
+def format_account_number(serial: int) -> str:
+    digits = str(serial).zfill(SERIAL_DIGITS)
+    if len(digits) > SERIAL_DIGITS:
+        raise OverflowError('Faixa de números de conta esgotada')
+    return digits + luhn_check_digit(digits)
+
+
+def reserve_block(size: int) -> range:
+    """Reserva `size` números consecutivos em uma transação própria e curta"""
+    with db.engine.begin() as conn:
+        end = conn.execute(
+            update(AccountNumberSequence)
+            .where(AccountNumberSequence.id == SEQUENCE_ID)
+            .values(next_value=AccountNumberSequence.next_value + size)
+            .returning(AccountNumberSequence.next_value)
+        ).scalar_one_or_none()
+        if end is not None:
+            return range(end - size, end)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(insert(AccountNumberSequence).values(id=SEQUENCE_ID, next_value=1 + size))
+        return range(1, 1 + size)
+    except IntegrityError:
+        # Another process created the row first
+        return reserve_block(size)
+
+
+class AccountNumberAllocator:
+    """Entrega números de conta únicos sem consultar a tabela de contas.
+
+    Cada processo reserva blocos de `block_size` seriais e os consome em
+    memória; um bloco não usado até o fim do processo vira uma lacuna.
+    """
+
+    def __init__(self, block_size: int = 100):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._block = iter(())
+        self._pid = os.getpid()
+
+    def allocate(self) -> str:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._block, self._pid = iter(()), os.getpid()
+            serial = next(self._block, None)
+            if serial is None:
+                self._block = iter(reserve_block(self.block_size))
+                serial = next(self._block)
+            return format_account_number(serial)
+
+    def allocate_many(self, count: int) -> List[str]:
+        """Reserva exatamente `count` números de uma vez (abertura de contas em lote)"""
+        return [format_account_number(serial) for serial in reserve_block(count)]
+
+
+def get_allocator() -> AccountNumberAllocator:
+    allocator = current_app.extensions.get('account_numbers')
+    if allocator is None:
+        allocator = AccountNumberAllocator(current_app.config.get('ACCOUNT_NUMBER_BLOCK_SIZE', 100))
+        current_app.extensions['account_numbers'] = allocator
+    return allocator
+
+
+def allocate_account_number() -> str:
+    return get_allocator().allocate()
@@ -0,0 +1,301 @@
+"""Agregados de movimentação por conta ou por usuário, por dia, semana ou mês.
+
+Períodos fechados (terminados antes da marca d'água) vêm da tabela
+account_flow_rollups, mantida por `flask analytics rollup`; o trecho ainda
+aberto é agregado na hora a partir de transactions, com GROUP BY sobre os
+índices (account_id, created_at). Consultar cinco anos por mês lê ~60 linhas
+de rollup por conta mais as transações desde a última execução do job.
+"""
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from typing import List, Optional
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Date, case, cast, delete, func, literal, select, type_coerce, union_all
+from models import Account, AccountFlowRollup, RollupWatermark, Transaction, TransactionArchive
+from app import db
+
+analytics_cli = AppGroup('analytics', help='Agregados de movimentação')
+
+GRAINS = ('day', 'week', 'month')
+WATERMARK = 'account_flows'
+
+# kind -> (sum column, count column), in the order they are returned
+FLOWS = {
+    'deposit': ('deposits', 'deposit_count'),
+    'withdrawal': ('withdrawals', 'withdrawal_count'),
+    'transfer_in': ('transfers_in', 'transfer_in_count'),
+    'transfer_out': ('transfers_out', 'transfer_out_count'),
+}
+
+
+def period_start(grain: str, day: date) -> date:
+    """Primeiro dia do período que contém `day` (semanas começam na segunda)"""
+    if grain == 'week':
+        return day - timedelta(days=day.weekday())
+    if grain == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def period_end(grain: str, start: date) -> date:
+    """Primeiro dia do período seguinte"""
+    if grain == 'week':
+        return start + timedelta(days=7)
+    if grain == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def _bucket(dialect: str, grain: str, column):
+    """Expressão SQL com o início do período de `column` (data ou data/hora)"""
+    if dialect == 'postgresql':
+        return cast(func.date_trunc(grain, column), Date)
+    if dialect == 'sqlite':
+        modifiers = {'day': (), 'week': ('weekday 0', '-6 days'), 'month': ('start of month',)}[grain]
+        return type_coerce(func.date(column, *modifiers), Date)
+    raise ValueError(f'Agregação por período não suportada no banco {dialect}')
+
+
+def _dialect() -> str:
+    return db.session.get_bind().dialect.name
+
+
+def _totals(kind_column, amount_column):
+    """SUM/COUNT condicionais de cada tipo de movimento, rotulados como em FLOWS"""
+    columns = []
+    for kind, (total, count) in FLOWS.items():
+        columns.append(func.coalesce(func.sum(case((kind_column == kind, amount_column))), 0).label(total))
+        columns.append(func.count(case((kind_column == kind, 1))).label(count))
+    return columns
+
+
+def _movements(start: datetime, end: datetime, account_ids=None):
+    """Movimentos por conta com o tipo do ponto de vista da conta (kind)"""
+    outgoing = select(
+        Transaction.account_id.label('account_id'),
+        Transaction.created_at.label('created_at'),
+        case((Transaction.transaction_type == 'transfer', literal('transfer_out')),
+             else_=Transaction.transaction_type).label('kind'),
+        Transaction.amount.label('amount')
+    ).where(Transaction.created_at >= start, Transaction.created_at < end)
+    incoming = select(
+        Transaction.to_account_id.label('account_id'),
+        Transaction.created_at.label('created_at'),
+        literal('transfer_in').label('kind'),
+        Transaction.amount.label('amount')
+    ).where(Transaction.transaction_type == 'transfer', Transaction.to_account_id.is_not(None),
+            Transaction.created_at >= start, Transaction.created_at < end)
+    if account_ids is not None:
+        outgoing = outgoing.where(Transaction.account_id.in_(account_ids))
+        incoming = incoming.where(Transaction.to_account_id.in_(account_ids))
+    return union_all(outgoing, incoming).subquery()
+
+
+def live_flows(grain: str, start: date, end: date, account_ids=None, by_account: bool = False):
+    """Agregados por período calculados direto das transações de [start, end)"""
+    movements = _movements(datetime.combine(start, time.min), datetime.combine(end, time.min), account_ids)
+    period = _bucket(_dialect(), grain, movements.c.created_at).label('period_start')
+    keys = [movements.c.account_id, period] if by_account else [period]
+    return db.session.execute(
+        select(*keys, *_totals(movements.c.kind, movements.c.amount)).group_by(*keys)
+    ).all()
+
+
+def rolled_flows(grain: str, start: date, end: date, account_ids):
+    """Agregados dos períodos já consolidados em account_flow_rollups"""
+    keys = [AccountFlowRollup.period_start]
+    totals = [func.sum(getattr(AccountFlowRollup, column)).label(column)
+              for names in FLOWS.values() for column in names]
+    return db.session.execute(
+        select(*keys, *totals)
+        .where(AccountFlowRollup.account_id.in_(account_ids), AccountFlowRollup.grain == grain,
+               AccountFlowRollup.period_start >= start, AccountFlowRollup.period_start < end)
+        .group_by(*keys)
+    ).all()
+
+
+def closed_until() -> Optional[date]:
+    return db.session.scalar(select(RollupWatermark.closed_until).where(RollupWatermark.name == WATERMARK))
+
+
+def _as_dict(row) -> dict:
+    flows = {column: getattr(row, column) for names in FLOWS.values() for column in names}
+    for total, _ in FLOWS.values():
+        flows[total] = Decimal(flows[total] or 0)
+    return flows
+
+
+def flow_summary(account_ids, grain: str, start: date, end: date) -> dict:
+    """Agregados de [start, end] por período; só aparecem períodos com movimento.
+
+    `account_ids` é uma lista ou subconsulta de ids; os valores são somados
+    entre as contas. As datas são estendidas aos limites dos períodos.
+    """
+    if grain not in GRAINS:
+        raise ValueError(f"Granularidade inválida; use {', '.join(GRAINS)}")
+    first = period_start(grain, start)
+    last = period_end(grain, period_start(grain, end))
+    watermark = closed_until()
+    # Periods that end on or before the watermark are fully rolled up
+    boundary = min(period_start(grain, watermark), last) if watermark else first
+    boundary = max(boundary, first)
+
+    rows = rolled_flows(grain, first, boundary, account_ids) if boundary > first else []
+    if boundary < last:
+        rows = list(rows) + list(live_flows(grain, boundary, last, account_ids))
+
+    periods = []
+    for row in sorted(rows, key=lambda r: r.period_start):
+        flows = _as_dict(row)
+        net = flows['deposits'] + flows['transfers_in'] - flows['withdrawals'] - flows['transfers_out']
+        periods.append(dict(
+            {'period_start': row.period_start.isoformat(),
+             'period_end': period_end(grain, row.period_start).isoformat()},
+            **{key: str(value) if isinstance(value, Decimal) else value for key, value in flows.items()},
+            net_flow=str(net)
+        ))
+    return {
+        'grain': grain,
+        'from': first.isoformat(),
+        'to': (last - timedelta(days=1)).isoformat(),
+        'rolled_up_until': watermark.isoformat() if watermark else None,
+        'periods': periods
+    }
+
+
+def user_account_ids(user_id: int):
+    """Subconsulta com as contas do usuário, para flow_summary"""
+    return select(Account.id).where(Account.user_id == user_id)
+
+
+def rollup_statement(dialect: str):
+    """INSERT ... ON CONFLICT que grava os rollups; None se o dialeto não suportar upsert"""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(AccountFlowRollup.__table__)
+    return stmt.on_conflict_do_update(
+        index_elements=[AccountFlowRollup.account_id, AccountFlowRollup.grain, AccountFlowRollup.period_start],
+        set_={column: stmt.excluded[column] for names in FLOWS.values() for column in names}
+    )
+
+
+def upsert_rollups(rows: List[dict]) -> None:
+    if not rows:
+        return
+    stmt = rollup_statement(_dialect())
+    if stmt is None:
+        for row in rows:
+            db.session.merge(AccountFlowRollup(**row))
+        return
+    # One statement with many parameter sets: compiled once, cached afterwards
+    db.session.execute(stmt, rows)
+
+
+def _rollup_rows(grain: str, rows) -> List[dict]:
+    return [dict(_as_dict(row), account_id=row.account_id, grain=grain, period_start=row.period_start)
+            for row in rows]
+
+
+def archived_day_rows(path: str, fmt: str) -> List[dict]:
+    """Linhas diárias de um mês arquivado e removido do banco, com os mesmos totais de live_flows"""
+    # archive -> analytics: imported here to break the cycle
+    import archive
+    rows = {}
+
+    def add(account_id, day, kind, amount):
+        row = rows.get((account_id, day))
+        if row is None:
+            row = rows[(account_id, day)] = dict(
+                {column: Decimal('0') if column == total else 0
+                 for total, count in FLOWS.values() for column in (total, count)},
+                account_id=account_id, grain='day', period_start=day
+            )
+        total, count = FLOWS[kind]
+        row[total] += amount
+        row[count] += 1
+
+    for row in archive.read_file(path, fmt):
+        day = row.created_at.date()
+        add(row.account_id, day, 'transfer_out' if row.transaction_type == 'transfer' else row.transaction_type,
+            row.amount)
+        if row.transaction_type == 'transfer' and row.to_account_id is not None:
+            add(row.to_account_id, day, 'transfer_in', row.amount)
+    return list(rows.values())
+
+
+def roll_up(start: date, end: date) -> int:
+    """Consolida os dias de [start, end) e as semanas e meses que terminam nesse intervalo"""
+    days = _rollup_rows('day', live_flows('day', start, end, by_account=True))
+    upsert_rollups(days)
+    totals = [func.sum(getattr(AccountFlowRollup, column)).label(column)
+              for names in FLOWS.values() for column in names]
+    for grain in GRAINS[1:]:
+        # Periods that close inside (start, end], summed from the day rows
+        first, last = period_start(grain, start), period_start(grain, end)
+        if first == last:
+            continue
+        period = _bucket(_dialect(), grain, AccountFlowRollup.period_start).label('period_start')
+        upsert_rollups(_rollup_rows(grain, db.session.execute(
+            select(AccountFlowRollup.account_id, period, *totals)
+            .where(AccountFlowRollup.grain == 'day',
+                   AccountFlowRollup.period_start >= first, AccountFlowRollup.period_start < last)
+            .group_by(AccountFlowRollup.account_id, period)
+        ).all()))
+
+    watermark = db.session.get(RollupWatermark, WATERMARK)
+    if watermark is None:
+        db.session.add(RollupWatermark(name=WATERMARK, closed_until=end))
+    else:
+        watermark.closed_until = end
+    return len(days)
+
+
+@analytics_cli.command('rollup')
+@click.option('--until', 'until', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Consolida até este dia, exclusive (padrão: hoje, em UTC)')
+@click.option('--days-per-batch', type=int, default=31, help='Dias consolidados por transação')
+@click.option('--rebuild', is_flag=True,
+              help='Apaga os rollups e recomeça da primeira transação (meses arquivados: dos arquivos)')
+def rollup(until: Optional[datetime], days_per_batch: int, rebuild: bool):
+    """Consolida os períodos fechados desde a última execução."""
+    end = until.date() if until else datetime.utcnow().date()
+    dropped = []
+    if rebuild:
+        # archive -> analytics: imported here to break the cycle
+        import archive
+        db.session.execute(delete(AccountFlowRollup))
+        db.session.execute(delete(RollupWatermark).where(RollupWatermark.name == WATERMARK))
+        # Months removed by `partitions archive` only exist in their files now;
+        # their days are summed from there, in the first batch's transaction
+        dropped = db.session.execute(
+            select(TransactionArchive.month, TransactionArchive.file, TransactionArchive.format)
+            .where(TransactionArchive.dropped_at.is_not(None))
+            .order_by(TransactionArchive.month)
+        ).all()
+        for month, name, fmt in dropped:
+            upsert_rollups(archived_day_rows(archive.file_path(name), fmt))
+    start = closed_until()
+    if start is None:
+        first = db.session.scalar(select(func.min(Transaction.created_at)))
+        start = first.date() if first else end
+        if dropped:
+            # Weeks and months of the archived days are summed by the batches below
+            start = min(start, dropped[0].month)
+    if start >= end:
+        db.session.commit()
+        click.echo(f'Nada a consolidar (marca em {start.isoformat()})')
+        return
+
+    days = 0
+    while start < end:
+        # Each batch commits with its watermark, so an interrupted run resumes
+        batch_end = min(start + timedelta(days=days_per_batch), end)
+        days += roll_up(start, batch_end)
+        db.session.commit()
+        start = batch_end
+    click.echo(f'{days} linhas diárias consolidadas; marca em {end.isoformat()}')
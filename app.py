@@ -1,93 +1,247 @@
 import os
 import logging
+import click
 from flask import Flask
+from flask.cli import with_appcontext
 from flask_jwt_extended import JWTManager
 from flask_restx import Api
 from flask_login import LoginManager
 from datetime import timedelta
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.middleware.proxy_fix import ProxyFix
 from sqlalchemy.orm import DeclarativeBase
+import metrics
+import ratelimit
+from database import RoutingSession, REPLICA, pool_options
 
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
-# create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET")
-
-# Configure SQLAlchemy
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-# initialize the app with the extension, flask-sqlalchemy >= 3.0.x
-db.init_app(app)
-
-with app.app_context():
-    # Make sure to import the models here or their tables won't be created
-    import models  # noqa: F401
-
-    db.create_all()
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
-
-# Configure app
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key')
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
-
-# Initialize extensions
-jwt = JWTManager(app)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
+jwt = JWTManager()
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Por favor, faça login para acessar esta página.'
 login_manager.login_message_category = 'info'
 
+logger = logging.getLogger(__name__)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return models.User.query.get(int(user_id))
-
-with app.app_context():
-    # Register blueprints first
-    from views import auth, main
-    app.register_blueprint(main)  # Register main blueprint first for root route priority
-    app.register_blueprint(auth)
-
-    # Initialize API with swagger documentation
-    authorizations = {
-        'Bearer': {
-            'type': 'apiKey',
-            'in': 'header',
-            'name': 'Authorization',
-            'description': "Type in the *'Value'* input box below: **'Bearer &lt;JWT&gt;'**, where JWT is the token"
-        }
+    from storage import storage
+    return storage.get_user_by_id(user_id)
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db():
+    """Cria as tabelas que ainda não existem."""
+    import models  # noqa: F401
+    db.create_all()
+    click.echo('Tabelas criadas')
+
+
+def _optional(name, cast):
+    value = os.environ.get(name)
+    return cast(value) if value not in (None, '') else None
+
+
+def load_config(app):
+    app.secret_key = os.environ.get("SESSION_SECRET")
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    app.config['DB_POOL_PROFILE'] = os.environ.get('DB_POOL_PROFILE', 'default')
+    app.config['DB_POOL_SIZE'] = _optional('DB_POOL_SIZE', int)
+    app.config['DB_MAX_OVERFLOW'] = _optional('DB_MAX_OVERFLOW', int)
+    app.config['DB_POOL_TIMEOUT'] = _optional('DB_POOL_TIMEOUT', float)
+    app.config['DB_POOL_RECYCLE'] = _optional('DB_POOL_RECYCLE', int)
+    app.config['DB_PRE_PING'] = os.environ.get('DB_PRE_PING') or None
+    app.config['REPLICA_DATABASE_URL'] = os.environ.get('REPLICA_DATABASE_URL')
+    app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    app.config['REPLICA_RETRY_SECONDS'] = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key')
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+    # Users with more accounts get tokens without the account list
+    app.config['IDENTITY_MAX_ACCOUNTS'] = int(os.environ.get('IDENTITY_MAX_ACCOUNTS', 50))
+    app.config['BATCH_CHUNK_SIZE'] = int(os.environ.get('BATCH_CHUNK_SIZE', 500))
+    app.config['BATCH_MAX_OPERATIONS'] = int(os.environ.get('BATCH_MAX_OPERATIONS', 5000))
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'local')
+    app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 60))
+    app.config['CACHE_MAXSIZE'] = int(os.environ.get('CACHE_MAXSIZE', 10000))
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 2))
+    app.config['HASH_MAX_PENDING'] = int(os.environ.get('HASH_MAX_PENDING', 0)) or None
+    app.config['HASH_TIMEOUT'] = float(os.environ.get('HASH_TIMEOUT', 5))
+    app.config['ACCOUNT_NUMBER_BLOCK_SIZE'] = int(os.environ.get('ACCOUNT_NUMBER_BLOCK_SIZE', 100))
+    app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+    # Longer than any request may run (gunicorn kills workers at 30s); a key whose
+    # request died unfinished is free for a retry after this
+    app.config['IDEMPOTENCY_PROCESSING_SECONDS'] = int(os.environ.get('IDEMPOTENCY_PROCESSING_SECONDS', 120))
+    app.config['ANALYTICS_MAX_DAYS'] = int(os.environ.get('ANALYTICS_MAX_DAYS', 1000))
+    # Proxies in front of the app whose X-Forwarded-For is trusted (the Replit
+    # deployment has one); the rate limits key anonymous clients on that address
+    app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 1))
+    app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'local')
+    app.config['RATE_LIMIT_MAXSIZE'] = int(os.environ.get('RATE_LIMIT_MAXSIZE', 100000))
+    # Per client and route; an empty value turns the rule off
+    app.config['RATE_LIMITS'] = {
+        'auth': os.environ.get('RATE_LIMIT_AUTH', '10/minute'),
+        'write': os.environ.get('RATE_LIMIT_WRITE', '120/minute'),
+        'read': os.environ.get('RATE_LIMIT_READ', '600/minute'),
+    }
+    app.config['ADMISSION_POOL_WAIT_MS'] = float(os.environ.get('ADMISSION_POOL_WAIT_MS', 250))
+    app.config['ADMISSION_MAX_INFLIGHT'] = int(os.environ.get('ADMISSION_MAX_INFLIGHT', 0))
+    app.config['RECURRING_BATCH_SIZE'] = int(os.environ.get('RECURRING_BATCH_SIZE', 100))
+    app.config['RECURRING_LEASE_SECONDS'] = float(os.environ.get('RECURRING_LEASE_SECONDS', 300))
+    app.config['RECURRING_MAX_ATTEMPTS'] = int(os.environ.get('RECURRING_MAX_ATTEMPTS', 3))
+    app.config['RECURRING_RETRY_SECONDS'] = float(os.environ.get('RECURRING_RETRY_SECONDS', 3600))
+    app.config['RECURRING_POLL_SECONDS'] = float(os.environ.get('RECURRING_POLL_SECONDS', 30))
+    app.config['RECURRING_IN_PROCESS'] = os.environ.get('RECURRING_IN_PROCESS', '0') != '0'
+    app.config['RISK_ENABLED'] = os.environ.get('RISK_ENABLED', '1') != '0'
+    app.config['RISK_SYNC_SECONDS'] = float(os.environ.get('RISK_SYNC_SECONDS', 1))
+    # How long a debit waits for the windows still being built at startup before it is refused
+    app.config['RISK_READY_TIMEOUT'] = float(os.environ.get('RISK_READY_TIMEOUT', 10))
+    # Debit velocity per account type: window=count/amount; an empty part turns that limit off
+    app.config['RISK_LIMITS'] = {
+        'checking': os.environ.get('RISK_LIMITS_CHECKING', '1m=10/10000,1h=60/50000,24h=200/100000'),
+        'savings': os.environ.get('RISK_LIMITS_SAVINGS', '1m=5/10000,1h=20/50000,24h=50/100000'),
+    }
+    app.config['OUTBOX_ENABLED'] = os.environ.get('OUTBOX_ENABLED', '1') != '0'
+    # Comma-separated: ndjson:<path under instance/>, webhook:<url>, queue
+    app.config['OUTBOX_SINKS'] = os.environ.get('OUTBOX_SINKS', 'ndjson:events.ndjson')
+    app.config['OUTBOX_BATCH_SIZE'] = int(os.environ.get('OUTBOX_BATCH_SIZE', 500))
+    app.config['OUTBOX_LEASE_SECONDS'] = float(os.environ.get('OUTBOX_LEASE_SECONDS', 60))
+    app.config['OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+    app.config['OUTBOX_BACKOFF_SECONDS'] = float(os.environ.get('OUTBOX_BACKOFF_SECONDS', 1))
+    app.config['OUTBOX_MAX_BACKOFF_SECONDS'] = float(os.environ.get('OUTBOX_MAX_BACKOFF_SECONDS', 600))
+    app.config['OUTBOX_POLL_SECONDS'] = float(os.environ.get('OUTBOX_POLL_SECONDS', 1))
+    app.config['OUTBOX_IN_PROCESS'] = os.environ.get('OUTBOX_IN_PROCESS', '0') != '0'
+    # Months of transactions kept in the database; older closed months go to ARCHIVE_PATH
+    app.config['TRANSACTIONS_HOT_MONTHS'] = int(os.environ.get('TRANSACTIONS_HOT_MONTHS', 13))
+    app.config['PARTITIONS_AHEAD'] = int(os.environ.get('PARTITIONS_AHEAD', 3))
+    app.config['ARCHIVE_PATH'] = os.environ.get('ARCHIVE_PATH', os.path.join(app.instance_path, 'archive'))
+    # parquet (needs pyarrow), csv.gz, or auto: parquet when pyarrow is installed
+    app.config['ARCHIVE_FORMAT'] = os.environ.get('ARCHIVE_FORMAT', 'auto')
+    # Annual interest rate per account type, accrued daily over 365 days; 0 turns it off
+    app.config['INTEREST_RATES'] = {
+        'savings': os.environ.get('INTEREST_RATE_SAVINGS', '0.06'),
+        'checking': os.environ.get('INTEREST_RATE_CHECKING', '0'),
     }
+    app.config['INTEREST_CHUNK_SIZE'] = int(os.environ.get('INTEREST_CHUNK_SIZE', 5000))
+    app.config['INTEREST_WORKERS'] = int(os.environ.get('INTEREST_WORKERS', 4))
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+    app.config['API_DOCS'] = os.environ.get('API_DOCS', '1') != '0'
+
+
+def create_app(config=None):
+    """Monta a aplicação; `config` sobrescreve os valores lidos do ambiente.
+
+    Não acessa o banco: as tabelas são criadas com `flask init-db`.
+    """
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
+    if "SQLALCHEMY_ENGINE_OPTIONS" not in app.config:
+        if ':memory:' in (app.config["SQLALCHEMY_DATABASE_URI"] or ''):
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+        else:
+            # Same pool as the default, but it reports how long checkouts wait
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(pool_options(app.config),
+                                                           poolclass=metrics.TimedQueuePool)
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+    if app.config['REPLICA_DATABASE_URL']:
+        app.config.setdefault("SQLALCHEMY_BINDS", {})[REPLICA] = app.config['REPLICA_DATABASE_URL']
+
+    # initialize the app with the extension, flask-sqlalchemy >= 3.0.x
+    db.init_app(app)
+    jwt.init_app(app)
+    login_manager.init_app(app)
+
+    with app.app_context():
+        # Make sure to import the models here so the mappers are configured
+        import models  # noqa: F401
+
+        # Register blueprints first
+        from views import auth, main
+        app.register_blueprint(main)  # Register main blueprint first for root route priority
+        app.register_blueprint(auth)
+
+        # Initialize API with swagger documentation
+        authorizations = {
+            'Bearer': {
+                'type': 'apiKey',
+                'in': 'header',
+                'name': 'Authorization',
+                'description': "Type in the *'Value'* input box below: **'Bearer &lt;JWT&gt;'**, where JWT is the token"
+            }
+        }
+
+        # The Swagger spec itself is only built when /swagger.json is first
+        # requested; API_DOCS=0 also skips registering the documentation UI.
+        api = Api(
+            app,
+            version='1.0',
+            title='My Bank API',
+            description='API bancária REST com autenticação JWT',
+            doc='/docs' if app.config['API_DOCS'] else False,
+            authorizations=authorizations,
+            security='Bearer'
+        )
+
+        # Import routes after app initialization to avoid circular imports
+        from routes import initialize_routes
+        initialize_routes(api)
+        metrics.init_app(app, api)
+        ratelimit.init_app(app)
+
+    from snapshots import snapshots_cli
+    from idempotency import idempotency_cli
+    from ledger import ledger_cli
+    from analytics import analytics_cli
+    from search import search_cli
+    from recurring import recurring_cli
+    from outbox import outbox_cli
+    from partitions import partitions_cli
+    from interest import interest_cli
+    app.cli.add_command(init_db)
+    app.cli.add_command(snapshots_cli)
+    app.cli.add_command(idempotency_cli)
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(recurring_cli)
+    app.cli.add_command(outbox_cli)
+    app.cli.add_command(partitions_cli)
+    app.cli.add_command(interest_cli)
+
+    return app
+
+
+def dispose_engines(app):
+    """Descarta as conexões herdadas do processo pai (uso após fork)"""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def __getattr__(name):
+    # `from app import app` keeps working for scripts: the default
+    # application is only built the first time it is asked for.
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    api = Api(
-        app,
-        version='1.0',
-        title='My Bank API',
-        description='API bancária REST com autenticação JWT',
-        doc='/docs',
-        authorizations=authorizations,
-        security='Bearer'
-    )
-
-    # Import routes after app initialization to avoid circular imports
-    from routes import initialize_routes
-    initialize_routes(api)
-
-    # Log registered routes
-    logger.info("Rotas registradas:")
-    for rule in app.url_map.iter_rules():
-        logger.info(f"  {rule.endpoint}: {rule.rule}")
 
 if __name__ == '__main__':
+    # Build through the importable module so models and views share its `db`
+    from app import create_app as build_app
     # ALWAYS serve the app on port 5000
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    build_app().run(host='0.0.0.0', port=5000, debug=True)
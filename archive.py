@@ -0,0 +1,311 @@
+"""Arquivos dos meses de transações que saíram do banco (ver partitions.py).
+
+Cada mês arquivado é um arquivo em ARCHIVE_PATH com as colunas de
+transactions ordenadas por (account_id, created_at, id): Parquet com zstd
+quando o pyarrow está instalado, CSV com gzip caso contrário. Ao lado dele
+fica uma cópia das transferências recebidas (<arquivo>.incoming, sem as da
+conta para ela mesma) ordenada por (to_account_id, created_at, id), e um
+índice (<arquivo>.index.json). Os dois são gravados em blocos de BLOCK_ROWS
+linhas (grupos de linhas no Parquet, membros gzip independentes no CSV), e
+o índice diz em que blocos de cada um está cada conta. Como cada conta fica
+contígua nos dois, a leitura de uma conta descomprime poucos blocos; sem o
+índice (arquivos gravados antes dele), o arquivo inteiro é lido e filtrado.
+
+O catálogo (transaction_archives) fica em cache; as leituras do extrato e da
+exportação pegam dos arquivos os meses arquivados do intervalo e do banco só
+o que vem depois do último deles.
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import zlib
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Optional, Tuple
+from flask import current_app
+from sqlalchemy import select
+from models import TransactionArchive
+from analytics import period_end
+from app import db
+
+COLUMNS = ('id', 'account_id', 'to_account_id', 'transaction_type', 'amount', 'description', 'created_at')
+ArchivedTransaction = namedtuple('ArchivedTransaction', COLUMNS)
+
+FORMATS = ('parquet', 'csv.gz')
+CATALOG_KEY = 'transactions:archives'
+# Rows per block: smaller blocks skip more of the file on a one-account read
+# and compress a little worse
+BLOCK_ROWS = 2048
+INDEX_CACHE_SIZE = 64
+
+
+def month_of(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def archive_format(config) -> str:
+    """Formato dos novos arquivos segundo ARCHIVE_FORMAT"""
+    name = config.get('ARCHIVE_FORMAT', 'auto')
+    if name == 'auto':
+        try:
+            import pyarrow  # noqa: F401  optional dependency, only needed for Parquet archives
+        except ImportError:
+            return 'csv.gz'
+        return 'parquet'
+    if name not in FORMATS:
+        raise ValueError(f"ARCHIVE_FORMAT inválido {name!r}; use auto, {' ou '.join(FORMATS)}")
+    return name
+
+
+def file_name(month: date, fmt: str) -> str:
+    return f'transactions_{month:%Y_%m}.{fmt}'
+
+
+def file_path(name: str) -> str:
+    return os.path.join(current_app.config['ARCHIVE_PATH'], name)
+
+
+def index_path(path: str) -> str:
+    return path + '.index.json'
+
+
+def incoming_path(path: str) -> str:
+    return path + '.incoming'
+
+
+def write_month(partitions: Iterable[list], incoming: Iterable[list], path: str, fmt: str) -> Tuple[int, str]:
+    """Grava o mês (lotes de tuplas em COLUMNS, por account_id), a cópia das transferências recebidas
+    (por to_account_id) e o índice; devolve (linhas, sha256 do arquivo do mês)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    count, outgoing = _write_blocks(partitions, partial, fmt, 1)
+    if count:
+        received = _write_blocks(incoming, incoming_path(path) + '.partial', fmt, 2)[1]
+        os.replace(incoming_path(path) + '.partial', incoming_path(path))
+        _write_json(index_path(path), {'outgoing': outgoing, 'incoming': received})
+    # The month's file only takes its final name once the rest is in place
+    os.replace(partial, path)
+    return count, file_digest(path)
+
+
+def _write_blocks(partitions: Iterable[list], path: str, fmt: str, key: int) -> Tuple[int, dict]:
+    """Grava em blocos; devolve (linhas, {'blocks': extents, 'accounts': {row[key]: [blocos]}})"""
+    accounts = defaultdict(list)
+
+    def indexed(blocks):
+        for number, rows in enumerate(blocks):
+            for account_id in {row[key] for row in rows}:
+                accounts[account_id].append(number)
+            yield rows
+
+    writer = _write_parquet if fmt == 'parquet' else _write_csv
+    count, extents = writer(indexed(_blocks(partitions)), path)
+    with open(path, 'rb') as file:
+        os.fsync(file.fileno())
+    return count, {'blocks': extents, 'accounts': accounts}
+
+
+def _blocks(partitions: Iterable[list]) -> Iterator[list]:
+    """Relotea as linhas em blocos de exatamente BLOCK_ROWS (o último pode ser menor)"""
+    buffer = []
+    for rows in partitions:
+        buffer.extend(rows)
+        while len(buffer) >= BLOCK_ROWS:
+            yield buffer[:BLOCK_ROWS]
+            del buffer[:BLOCK_ROWS]
+    if buffer:
+        yield buffer
+
+
+def _write_json(path: str, data: dict) -> None:
+    partial = path + '.partial'
+    with open(partial, 'w', encoding='utf-8') as file:
+        json.dump(data, file, separators=(',', ':'))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(partial, path)
+
+
+def load_index(path: str) -> Optional[dict]:
+    """{'outgoing'|'incoming': {'blocks': extents ou None, 'accounts': {conta: [blocos]}}}; None sem índice"""
+    try:
+        stat = os.stat(index_path(path))
+    except FileNotFoundError:
+        return None
+    # Keyed by the index's own mtime and size: a month archived again gets a new one
+    return _read_index(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=INDEX_CACHE_SIZE)
+def _read_index(path: str, mtime_ns: int, size: int) -> dict:
+    with open(index_path(path), encoding='utf-8') as file:
+        data = json.load(file)
+    return {
+        side: {'blocks': part['blocks'], 'accounts': {int(key): value for key, value in part['accounts'].items()}}
+        for side, part in data.items()
+    }
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.int64()), ('account_id', pa.int64()), ('to_account_id', pa.int64()),
+        ('transaction_type', pa.string()), ('amount', pa.decimal128(18, 2)),
+        ('description', pa.string()), ('created_at', pa.timestamp('us')),
+    ])
+
+
+def _write_parquet(blocks, path) -> Tuple[int, None]:
+    import pyarrow as pa  # optional dependency, only needed for Parquet archives
+    import pyarrow.parquet as pq
+    schema = _parquet_schema()
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in blocks:
+            columns = list(zip(*rows))
+            # One row group per block: the index refers to row groups by number
+            writer.write_batch(pa.record_batch(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+            ), row_group_size=BLOCK_ROWS)
+            count += len(rows)
+    return count, None
+
+
+def _write_csv(blocks, path) -> Tuple[int, List[List[int]]]:
+    """Cabeçalho e cada bloco em membros gzip separados; devolve (linhas, [início, tamanho] de cada bloco)"""
+    count, extents = 0, []
+    with open(path, 'wb') as file:
+        file.write(gzip.compress(_csv_text([COLUMNS])))
+        for rows in blocks:
+            member = gzip.compress(_csv_text(
+                (row[0], row[1], '' if row[2] is None else row[2], row[3], row[4], row[5], row[6].isoformat())
+                for row in rows
+            ))
+            extents.append([file.tell(), len(member)])
+            file.write(member)
+            count += len(rows)
+    return count, extents
+
+
+def _csv_text(rows) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def _csv_rows(records, account_id: Optional[int], positions=(1, 2)) -> List[ArchivedTransaction]:
+    rows = []
+    wanted = None if account_id is None else str(account_id)
+    for record in records:
+        if wanted is not None and all(record[position] != wanted for position in positions):
+            continue
+        rows.append(ArchivedTransaction(
+            int(record[0]), int(record[1]), int(record[2]) if record[2] else None, record[3],
+            Decimal(record[4]), record[5], datetime.fromisoformat(record[6])
+        ))
+    return rows
+
+
+def _read_blocks(path: str, fmt: str, part: dict, account_id: int, key: int) -> List[ArchivedTransaction]:
+    """Linhas com row[key] == account_id, lendo só os blocos do índice que a contêm"""
+    blocks = part['accounts'].get(account_id)
+    if not blocks:
+        return []
+    if fmt == 'parquet':
+        import pyarrow.compute as pc  # optional dependency, only needed for Parquet archives
+        import pyarrow.parquet as pq
+        table = pq.ParquetFile(path).read_row_groups(blocks, columns=list(COLUMNS))
+        table = table.filter(pc.equal(table[COLUMNS[key]], account_id))
+        return [ArchivedTransaction(**row) for row in table.to_pylist()]
+    rows = []
+    with open(path, 'rb') as file:
+        for block in blocks:
+            offset, size = part['blocks'][block]
+            file.seek(offset)
+            text = zlib.decompress(file.read(size), wbits=31).decode('utf-8')
+            rows.extend(_csv_rows(csv.reader(io.StringIO(text, newline='')), account_id, (key,)))
+    return rows
+
+
+def read_file(path: str, fmt: str, account_id: Optional[int] = None) -> List[ArchivedTransaction]:
+    """Linhas do arquivo; com `account_id`, só as que a conta envia ou recebe"""
+    index = load_index(path) if account_id is not None else None
+    if index is not None:
+        return (_read_blocks(path, fmt, index['outgoing'], account_id, 1)
+                + _read_blocks(incoming_path(path), fmt, index['incoming'], account_id, 2))
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq  # optional dependency, only needed for Parquet archives
+        filters = None
+        if account_id is not None:
+            # Without the index: every row group whose account_id range misses the account
+            # is still read for the to_account_id side
+            filters = [[('account_id', '=', account_id)], [('to_account_id', '=', account_id)]]
+        table = pq.read_table(path, columns=list(COLUMNS), filters=filters)
+        return [ArchivedTransaction(**row) for row in table.to_pylist()]
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+        records = csv.reader(file)
+        next(records)
+        return _csv_rows(records, account_id)
+
+
+def catalog() -> List[tuple]:
+    """(mês, arquivo, formato) de cada mês arquivado, em ordem"""
+    # storage -> utils -> snapshots -> archive: imported here to break the cycle
+    from storage import storage
+    months = storage.cache.get(CATALOG_KEY)
+    if months is None:
+        months = [tuple(row) for row in db.session.execute(
+            select(TransactionArchive.month, TransactionArchive.file, TransactionArchive.format)
+            .order_by(TransactionArchive.month)
+        ).all()]
+        storage.cache.set(CATALOG_KEY, months)
+    return months
+
+
+def boundary(months: List[tuple]) -> Optional[datetime]:
+    """Início do primeiro mês depois dos arquivados: o banco é lido daí em diante"""
+    if not months:
+        return None
+    return datetime.combine(period_end('month', months[-1][0]), time.min)
+
+
+def account_history(account_id: int, months: List[tuple], start: Optional[datetime] = None,
+                    end: Optional[datetime] = None) -> Iterator[ArchivedTransaction]:
+    """Transações arquivadas da conta em [start, end), em ordem de (created_at, id).
+
+    Lê um mês por vez: só as linhas da conta em um mês ficam em memória.
+    Transferências entre a conta e ela mesma aparecem uma vez, como no banco.
+    """
+    for month, name, fmt in months:
+        if (end is not None and datetime.combine(month, time.min) >= end) or \
+                (start is not None and datetime.combine(period_end('month', month), time.min) <= start):
+            continue
+        # Files are sorted by account_id first; the account's rows of one month
+        # are re-sorted here, and months follow each other in order
+        rows = [
+            row for row in read_file(file_path(name), fmt, account_id)
+            if (start is None or row.created_at >= start) and (end is None or row.created_at < end)
+        ]
+        rows.sort(key=lambda row: (row.created_at, row.id))
+        yield from rows
+
+
+def signed_amount(row: ArchivedTransaction, account_id: int) -> Decimal:
+    """Valor com sinal do ponto de vista da conta, como em snapshots.account_movements"""
+    if row.account_id == account_id:
+        return row.amount if row.transaction_type == 'deposit' else -row.amount
+    return row.amount
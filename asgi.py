@@ -0,0 +1,437 @@
+"""Modo de execução assíncrono (ASGI) da API REST.
+
+As rotas dos namespaces auth, accounts e transactions rodam aqui sobre um
+engine assíncrono do SQLAlchemy (asyncpg/aiosqlite), com os mesmos schemas,
+mensagens e instruções SQL do modo síncrono. Todo o resto (páginas HTML,
+extrato, lote, documentação) continua sendo atendido pelo Flask, montado
+como aplicação WSGI.
+
+Dependências opcionais: starlette, uvicorn e o driver assíncrono do banco.
+
+    SERVER_MODE=async uvicorn main:app --workers 4
+"""
+import asyncio
+import logging
+import re
+from decimal import Decimal
+from typing import Optional
+
+from flask import current_app
+from flask_jwt_extended import create_access_token, decode_token
+from marshmallow import ValidationError
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route, Router
+from werkzeug.exceptions import HTTPException
+
+import idempotency
+import identity
+import risk
+from account_numbers import allocate_account_number
+from cache import account_keys
+from database import pool_options
+from models import Account, User
+from ratelimit import get_rate_limiter
+from schemas import AccountSchema, LoginSchema, TransactionSchema, UserSchema
+from storage import ACCOUNT_CACHED_COLUMNS, DEFAULT_PAGE_SIZE, storage
+from utils import hash_password, transaction_steps
+
+logger = logging.getLogger(__name__)
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+# Paths whose sync counterparts share a URL with the HTML blueprint; they are
+# only routed to the async API when the request carries a bearer token.
+API_PATH = re.compile(r'^/(auth/|accounts(/\d+)?$|transactions/\d+$)')
+
+
+class APIError(Exception):
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def async_database_url(url: str) -> str:
+    url = make_url(url)
+    return str(url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)))
+
+
+def create_asgi_app(flask_app):
+    engine = create_async_engine(
+        flask_app.config.get('ASYNC_DATABASE_URL')
+        or async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+        **pool_options(flask_app.config)
+    )
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    limiter = get_rate_limiter(flask_app)
+
+    def endpoint(handler, authenticated=True, idempotent=False, rule='read'):
+        async def wrapper(request: Request):
+            # Flask helpers used here (JWT, cache, hashing, config) need an app
+            # context; contexts are contextvars, so this is per request task.
+            with flask_app.app_context():
+                try:
+                    user_id = _identity(request) if authenticated else None
+                    client = str(user_id) if user_id is not None else _client_address(request)
+                    limiter.check(rule, handler.__name__, client)
+                    key = request.headers.get(idempotency.HEADER) if idempotent else None
+                    if key:
+                        return await _idempotent_call(handler, request, sessions, user_id, key)
+                    async with sessions() as session:
+                        body, status, *headers = await handler(request, session, user_id)
+                    return JSONResponse(body, status_code=status, headers=headers[0] if headers else None)
+                except APIError as e:
+                    return JSONResponse({'message': e.message}, status_code=e.status_code)
+                except ValidationError as e:
+                    return JSONResponse({'message': str(e.messages)}, status_code=400)
+                except SQLAlchemyError as e:
+                    # As the sync resources: a database error is a 400 with its message
+                    logger.error(f"Erro em {handler.__name__}: {str(e)}")
+                    return JSONResponse({'message': str(e)}, status_code=400)
+                except HTTPException as e:
+                    retry_after = getattr(e, 'retry_after', None)
+                    return JSONResponse({'message': e.description}, status_code=e.code,
+                                        headers={'Retry-After': str(retry_after)} if retry_after else None)
+        return wrapper
+
+    wsgi = WSGIMiddleware(flask_app)
+    router = Router(
+        routes=[
+            Route('/auth/register', endpoint(register, False, rule='auth'), methods=['POST']),
+            Route('/auth/login', endpoint(login, False, rule='auth'), methods=['POST']),
+            Route('/accounts', endpoint(list_accounts), methods=['GET']),
+            Route('/accounts', endpoint(create_account, rule='write'), methods=['POST']),
+            Route('/accounts/{account_id:int}', endpoint(get_account), methods=['GET']),
+            Route('/transactions/{account_id:int}', endpoint(list_transactions), methods=['GET']),
+            Route('/transactions/{account_id:int}', endpoint(create_transaction, idempotent=True, rule='write'),
+                  methods=['POST']),
+        ],
+        default=wsgi,
+        lifespan=_lifespan(flask_app, engine),
+    )
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'http' and not _is_api_request(scope):
+            await wsgi(scope, receive, send)
+        else:
+            await router(scope, receive, send)
+
+    return app
+
+
+def _lifespan(flask_app, engine):
+    from contextlib import asynccontextmanager
+
+    @asynccontextmanager
+    async def lifespan(app):
+        # Builds the debit windows in the background before the first request needs them
+        risk.start_in_thread(flask_app)
+        yield
+        await engine.dispose()
+    return lifespan
+
+
+async def _idempotent_call(handler, request, sessions, user_id, key):
+    """Mesmo fluxo do decorator idempotency.idempotent; o registro da chave usa a sessão síncrona"""
+    fingerprint = idempotency.request_fingerprint(request.url.path, await request.body())
+    stored = await asyncio.to_thread(idempotency.begin, user_id, key, fingerprint)
+    if stored is not None:
+        return JSONResponse(stored[0], status_code=stored[1], headers={'Idempotent-Replayed': 'true'})
+    request.state.idempotency_key = (user_id, key)
+    try:
+        async with sessions() as session:
+            body, status, *headers = await handler(request, session, user_id)
+    except APIError as e:
+        if e.status_code >= 500:
+            await asyncio.to_thread(idempotency.release, user_id, key)
+        else:
+            await asyncio.to_thread(idempotency.complete, user_id, key, fingerprint,
+                                    {'message': e.message}, e.status_code)
+        raise
+    except ValidationError as e:
+        await asyncio.to_thread(idempotency.complete, user_id, key, fingerprint,
+                                {'message': str(e.messages)}, 400)
+        raise
+    except BaseException:
+        await asyncio.to_thread(idempotency.release, user_id, key)
+        raise
+    await asyncio.to_thread(idempotency.complete, user_id, key, fingerprint, body, status)
+    return JSONResponse(body, status_code=status, headers=headers[0] if headers else None)
+
+
+def _is_api_request(scope) -> bool:
+    path = scope['path']
+    if not API_PATH.match(path):
+        return False
+    if path.startswith('/auth/'):
+        return True
+    return any(name == b'authorization' for name, _ in scope['headers'])
+
+
+def _client_address(request: Request) -> str:
+    """Endereço do cliente como o ProxyFix do modo síncrono o resolve, pelos PROXY_FIX_X_FOR proxies confiáveis"""
+    hops = current_app.config['PROXY_FIX_X_FOR']
+    forwarded = request.headers.get('x-forwarded-for') if hops else None
+    if forwarded:
+        values = forwarded.split(',')
+        if len(values) >= hops:
+            return values[-hops].strip()
+    return request.client.host if request.client else '-'
+
+
+def _identity(request: Request) -> int:
+    header = request.headers.get('authorization', '')
+    if not header.startswith('Bearer '):
+        raise APIError('Missing Authorization Header', 401)
+    try:
+        request.state.claims = decode_token(header[len('Bearer '):])
+        return int(request.state.claims['sub'])
+    except Exception:
+        raise APIError('Token inválido', 401)
+
+
+async def _accounts_version(session, user_id: int) -> int:
+    """identity.accounts_version pela sessão assíncrona (mesma chave de cache)"""
+    key = identity.version_key(user_id)
+    version = storage.cache.get(key)
+    if version is None:
+        version = await session.scalar(identity.version_statement(user_id)) or 0
+        storage.cache.set(key, version)
+    return version
+
+
+async def _access_token(session, user_id: int) -> str:
+    """Token com as mesmas claims de identidade do modo síncrono"""
+    version = await _accounts_version(session, user_id)
+    account_ids = list(await session.scalars(identity.account_ids_statement(user_id)))
+    return create_access_token(identity=str(user_id), additional_claims=identity.claims_for(account_ids, version))
+
+
+async def _require_account(request, session, account_id: int, user_id: int) -> None:
+    """Posse pelas claims do token quando atualizadas; senão pela conta (cache ou banco)"""
+    claims = request.state.claims
+    owned = None
+    if identity.ACCOUNTS_CLAIM in claims:
+        owned = identity.claims_own(claims, account_id, await _accounts_version(session, user_id))
+    if owned is None:
+        await _owned_account(session, account_id, user_id)
+    elif not owned:
+        raise APIError('Conta não encontrada', 404)
+
+
+async def _payload(request: Request) -> dict:
+    try:
+        return await request.json()
+    except ValueError:
+        raise APIError('JSON inválido', 400)
+
+
+async def _owned_account(session, account_id: int, user_id: int) -> dict:
+    """Colunas fixas da conta (ACCOUNT_CACHED_COLUMNS) via cache, com as mesmas chaves do Storage, ou banco"""
+    key = account_keys(account_id)[0]
+    data = storage.cache.get(key)
+    if data is None:
+        account = await session.get(Account, account_id)
+        if account is not None:
+            data = {column: getattr(account, column) for column in ACCOUNT_CACHED_COLUMNS}
+            storage.cache.set(key, data)
+    if data is None or data['user_id'] != user_id:
+        raise APIError('Conta não encontrada', 404)
+    return data
+
+
+async def register(request, session, _):
+    data = UserSchema().load(await _payload(request))
+    if await session.scalar(select(User.id).where(User.username == data['username'])):
+        raise APIError('Nome de usuário já existe', 400)
+    password_hash = await asyncio.to_thread(hash_password, data['password'])
+    session.add(User(username=data['username'], email=data['email'], password_hash=password_hash))
+    await session.commit()
+    return {'message': 'Usuário registrado com sucesso'}, 201
+
+
+async def login(request, session, _):
+    data = LoginSchema().load(await _payload(request))
+    user = await session.scalar(select(User).where(User.username == data['username']))
+    # Same check as the sync Login, including the rehash of outdated hashes
+    if not user or not await asyncio.to_thread(user.check_password, data['password']):
+        raise APIError('Credenciais inválidas', 401)
+    await session.commit()
+    return {'access_token': await _access_token(session, user.id)}, 200
+
+
+async def list_accounts(request, session, user_id):
+    accounts = await session.scalars(select(Account).where(Account.user_id == user_id))
+    return [{
+        'id': acc.id,
+        'type': acc.account_type,
+        'balance': str(acc.balance)
+    } for acc in accounts], 200
+
+
+async def create_account(request, session, user_id):
+    data = AccountSchema().load(await _payload(request))
+    account = Account(
+        account_number=await asyncio.to_thread(allocate_account_number),
+        user_id=user_id,
+        balance=Decimal('0'),
+        account_type=data['account_type']
+    )
+    session.add(account)
+    await session.commit()
+    return {
+        'message': 'Conta criada com sucesso',
+        'account_id': account.id,
+        'access_token': await _access_token(session, user_id)
+    }, 201
+
+
+async def get_account(request, session, user_id):
+    account = await _owned_account(session, request.path_params['account_id'], user_id)
+    # The balance is not cached: other processes change it
+    balance = await session.scalar(select(Account.balance).where(Account.id == account['id']))
+    return {
+        'id': account['id'],
+        'type': account['account_type'],
+        'balance': str(balance)
+    }, 200
+
+
+async def list_transactions(request, session, user_id):
+    account_id = request.path_params['account_id']
+    await _require_account(request, session, account_id, user_id)
+    try:
+        stmt, limit = storage.history_statement(
+            account_id,
+            int(request.query_params.get('limit', DEFAULT_PAGE_SIZE)),
+            request.query_params.get('cursor')
+        )
+    except ValueError as e:
+        raise APIError(str(e), 400)
+    transactions, next_cursor = storage.split_page((await session.scalars(stmt)).all(), limit)
+    body = [{
+        'id': t.id,
+        'type': t.transaction_type,
+        'amount': str(t.amount),
+        'description': t.description,
+        'created_at': t.created_at.isoformat(),
+        'to_account_id': t.to_account_id
+    } for t in transactions]
+    return body, 200, {'X-Next-Cursor': next_cursor} if next_cursor else {}
+
+
+async def create_transaction(request, session, user_id):
+    account_id = request.path_params['account_id']
+    await _require_account(request, session, account_id, user_id)
+    data = TransactionSchema().load(await _payload(request))
+    response = {}
+
+    async def respond(transaction_id, message, balances):
+        response.update(message=message, transaction_id=transaction_id, new_balance=str(balances[account_id]))
+        # As idempotency.stage: the key completes in the same commit as the transaction
+        active = getattr(request.state, 'idempotency_key', None)
+        if active is not None:
+            await session.execute(idempotency.completion_statement(*active, response, 200))
+
+    try:
+        success, message, _, _ = await process_transaction_async(
+            session, account_id, data['transaction_type'], Decimal(str(data['amount'])),
+            data['description'], data.get('to_account_id'), before_commit=respond
+        )
+    except SQLAlchemyError as e:
+        # Nothing was applied: a 5xx releases the idempotency key, as in TransactionResource
+        logger.error(f"Erro de banco na transação: {str(e)}")
+        raise APIError('Banco de dados indisponível no momento; tente novamente', 503)
+    if not success:
+        raise APIError(message, 400)
+    return response, 200
+
+
+async def _check_debit(session, account_id: int, amount: Decimal):
+    """risk.check_debit pela sessão assíncrona"""
+    engine = risk.get_risk_engine(current_app)
+    if engine is None:
+        return None, risk.NO_RESERVATION
+    # Built and synced by the risk-sync thread; waiting for it must not block the event loop
+    ready = engine.ready or await asyncio.to_thread(risk.ensure_ready, current_app._get_current_object(), engine)
+    if not ready:
+        return risk.NOT_READY, risk.NO_RESERVATION
+    if not engine.knows(account_id):
+        account_type = await session.scalar(risk.account_type_statement(account_id))
+        if account_type is None:
+            return None, risk.NO_RESERVATION
+        engine.set_account_type(account_id, account_type)
+    window, reservation = engine.reserve(account_id, amount)
+    return (risk.refusal(window) if window else None), reservation
+
+
+async def _run_steps(session, steps):
+    """utils.transaction_steps pela sessão assíncrona"""
+    result = None
+    try:
+        while True:
+            kind, value = steps.send(result)
+            result = None
+            if kind == 'execute':
+                result = await session.execute(value)
+            elif kind == 'add':
+                session.add(value)
+            else:
+                await session.merge(value)
+    except StopIteration as done:
+        return done.value
+
+
+async def process_transaction_async(session, account_id: int, transaction_type: str, amount: Decimal,
+                                    description: str, to_account_number: Optional[str] = None,
+                                    before_commit=None):
+    """Versão assíncrona de utils.process_transaction: executa os mesmos passos (utils.transaction_steps);
+    `before_commit(id da transação, mensagem, saldos)` é aguardado antes do commit"""
+    to_account_id = None
+    if transaction_type == 'transfer':
+        if not to_account_number:
+            return False, "Número da conta de destino não especificado", None, None
+        to_account_id = await session.scalar(
+            select(Account.id).where(Account.account_number == to_account_number)
+        )
+        if to_account_id is None:
+            return False, "Conta de destino não encontrada", None, None
+
+    reservation = risk.NO_RESERVATION
+    try:
+        if transaction_type != 'deposit':
+            refused, reservation = await _check_debit(session, account_id, amount)
+            if refused:
+                await session.rollback()
+                return False, refused, None, None
+        message, transaction, balances = await _run_steps(session, transaction_steps(
+            account_id, transaction_type, amount, description, to_account_id, session.bind.dialect.name
+        ))
+        if transaction is None:
+            await session.rollback()
+            reservation.release()
+            return False, message, None, None
+        if before_commit:
+            await session.flush()
+            await before_commit(transaction.id, message, balances)
+        await session.commit()
+    except SQLAlchemyError:
+        await session.rollback()
+        reservation.release()
+        raise
+    reservation.confirm(transaction.id)
+
+    storage.cache.delete(*(key for changed in balances for key in account_keys(changed)))
+    return True, message, transaction.id, balances[account_id]
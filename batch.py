@@ -0,0 +1,225 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+from marshmallow import ValidationError
+from sqlalchemy import case, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from models import Account, LedgerEntry, OutboxEvent, Transaction
+from cache import account_keys, invalidate_on_commit
+from schemas import BatchTransactionSchema
+from snapshots import record_daily_balances
+from ledger import ledger_legs
+from risk import check_debit
+import outbox
+from utils import apply_transaction
+from app import db
+
+DEFAULT_CHUNK_SIZE = 500
+TRANSIENT_ERROR = "Erro temporário no banco de dados; a operação não foi aplicada"
+
+
+def process_batch(user_id: int, operations: List[dict], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  before_commit: Optional[Callable[[List[dict]], None]] = None) -> List[dict]:
+    """Processa um lote de operações e retorna um resultado por item, na ordem recebida.
+
+    `before_commit(resultados)` roda na transação do último bloco, antes do
+    commit, já com o resultado de todos os itens. Um erro do banco antes de
+    qualquer operação confirmada é propagado; depois disso, as operações
+    restantes voltam como falhas e o lote termina.
+    """
+    results: List[dict] = [None] * len(operations)
+
+    try:
+        loaded = BatchTransactionSchema(many=True).load(operations)
+        invalid = {}
+    except ValidationError as e:
+        loaded, invalid = e.valid_data, e.messages
+    for index, errors in invalid.items():
+        results[index] = {'index': index, 'success': False, 'errors': errors}
+
+    items = [
+        dict(data, index=index)
+        for index, data in enumerate(loaded)
+        if index not in invalid
+    ]
+
+    # One query for the source accounts and one for every destination number
+    owned = set(db.session.scalars(
+        select(Account.id).where(
+            Account.id.in_(list({item['account_id'] for item in items})),
+            Account.user_id == user_id
+        )
+    ))
+    numbers = {item['to_account_id'] for item in items
+               if item['transaction_type'] == 'transfer' and item.get('to_account_id')}
+    destinations = dict(db.session.execute(
+        select(Account.account_number, Account.id).where(Account.account_number.in_(list(numbers)))
+    ).all()) if numbers else {}
+
+    pending = []
+    for item in items:
+        if item['account_id'] not in owned:
+            results[item['index']] = _failure(item, "Conta não encontrada")
+            continue
+        if item['transaction_type'] == 'transfer':
+            if not item.get('to_account_id'):
+                results[item['index']] = _failure(item, "Número da conta de destino não especificado")
+                continue
+            if item['to_account_id'] not in destinations:
+                results[item['index']] = _failure(item, "Conta de destino não encontrada")
+                continue
+            item['to_id'] = destinations[item['to_account_id']]
+        pending.append(item)
+
+    def finish(chunk_results):
+        for result in chunk_results:
+            results[result['index']] = result
+        before_commit(results)
+
+    applied = False
+    for start in range(0, len(pending), chunk_size):
+        last = start + chunk_size >= len(pending)
+        try:
+            chunk_results = _apply_chunk(pending[start:start + chunk_size],
+                                         finish if last and before_commit else None)
+        except SQLAlchemyError:
+            if not applied:
+                raise
+            # Earlier chunks are committed: report the rest instead of failing the whole batch
+            for item in pending[start:]:
+                results[item['index']] = _failure(item, TRANSIENT_ERROR)
+            break
+        for result in chunk_results:
+            results[result['index']] = result
+        applied = applied or any(result['success'] for result in chunk_results)
+    return results
+
+
+def _apply_chunk(chunk: List[dict], before_commit=None) -> List[dict]:
+    account_ids = {item['account_id'] for item in chunk} | {item['to_id'] for item in chunk if 'to_id' in item}
+    now = datetime.utcnow()
+    reservations = []
+    try:
+        balances: Dict[int, Decimal] = dict(db.session.execute(
+            select(Account.id, Account.balance)
+            .where(Account.id.in_(list(account_ids)))
+            .order_by(Account.id)
+            .with_for_update()
+        ).all())
+
+        deltas = defaultdict(Decimal)
+        results, applied = [], []
+        for item in chunk:
+            amount, source = item['amount'], item['account_id']
+            if item['transaction_type'] == 'deposit':
+                deltas[source] += amount
+                balances[source] += amount
+            elif balances[source] < amount:
+                results.append(_failure(item, "Saldo insuficiente"))
+                continue
+            else:
+                refused, reservation = check_debit(source, amount)
+                if refused:
+                    results.append(_failure(item, refused))
+                    continue
+                reservations.append((item['index'], reservation))
+                deltas[source] -= amount
+                balances[source] -= amount
+                if item['transaction_type'] == 'transfer':
+                    deltas[item['to_id']] += amount
+                    balances[item['to_id']] += amount
+            applied.append(item)
+
+        deltas = {account_id: delta for account_id, delta in deltas.items() if delta}
+        if deltas:
+            delta = case(deltas, value=Account.id)
+            updated = dict(db.session.execute(
+                update(Account)
+                .where(Account.id.in_(list(deltas)), Account.balance + delta >= 0)
+                .values(balance=Account.balance + delta)
+                .returning(Account.id, Account.balance)
+                .execution_options(synchronize_session=False)
+            ).all())
+            if len(updated) != len(deltas):
+                # A balance moved under us (no row locks on this backend):
+                # fall back to the per-operation path for this chunk.
+                db.session.rollback()
+                for _, reservation in reservations:
+                    reservation.release()
+                reservations = []
+                return _apply_each(chunk, before_commit)
+            invalidate_on_commit(db.session, [key for account_id in updated for key in account_keys(account_id)])
+            record_daily_balances(updated, now.date())
+
+        if applied:
+            transaction_ids = db.session.scalars(
+                insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True),
+                [{
+                    'account_id': item['account_id'],
+                    'transaction_type': item['transaction_type'],
+                    'amount': item['amount'],
+                    'description': item['description'],
+                    'to_account_id': item.get('to_id'),
+                    'created_at': now
+                } for item in applied]
+            ).all()
+            db.session.execute(insert(LedgerEntry), [
+                dict(leg, transaction_id=transaction_id, created_at=now)
+                for item, transaction_id in zip(applied, transaction_ids)
+                for leg in ledger_legs(item['transaction_type'], item['account_id'],
+                                       item['amount'], item.get('to_id'))
+            ])
+            if outbox.enabled():
+                # Core inserts skip the ORM flush hook, so the events go in here
+                db.session.execute(insert(OutboxEvent), [
+                    outbox.transaction_event(transaction_id, item['account_id'], item['transaction_type'],
+                                             item['amount'], item['description'], item.get('to_id'), now, now)
+                    for item, transaction_id in zip(applied, transaction_ids)
+                ])
+            for item, transaction_id in zip(applied, transaction_ids):
+                results.append({'index': item['index'], 'success': True, 'transaction_id': transaction_id})
+        if before_commit:
+            before_commit(results)
+        db.session.commit()
+        committed = {result['index']: result['transaction_id'] for result in results if result['success']}
+        for index, reservation in reservations:
+            reservation.confirm(committed[index])
+        return results
+    except SQLAlchemyError:
+        db.session.rollback()
+        for _, reservation in reservations:
+            reservation.release()
+        raise
+
+
+def _apply_each(chunk: List[dict], before_commit=None) -> List[dict]:
+    """Aplica os itens um a um, com débitos condicionais, numa única transação do banco"""
+    results, confirmed = [], []
+    try:
+        for item in chunk:
+            message, transaction, _, reservation = apply_transaction(
+                item['account_id'], item['transaction_type'], item['amount'],
+                item['description'], item.get('to_id')
+            )
+            if transaction is None:
+                results.append(_failure(item, message))
+                continue
+            confirmed.append((transaction.id, reservation))
+            results.append({'index': item['index'], 'success': True, 'transaction_id': transaction.id})
+        # Same commit as the operations, as in the bulk path
+        if before_commit:
+            before_commit(results)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        for _, reservation in confirmed:
+            reservation.release()
+        raise
+    for transaction_id, reservation in confirmed:
+        reservation.confirm(transaction_id)
+    return results
+
+
+def _failure(item: dict, message: str) -> dict:
+    return {'index': item['index'], 'success': False, 'message': message}
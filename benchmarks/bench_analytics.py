@@ -0,0 +1,114 @@
+"""Analytics endpoints: rollups versus aggregating the whole history live.
+
+Seeds a multi-year history, consolidates it with `flask analytics rollup` in
+two runs (to exercise the incremental path), then for each grain checks that
+the rollup-backed answer equals the live GROUP BY over transactions and times
+both. Exits 1 if any answer differs.
+
+    python -m benchmarks.bench_analytics --years 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-analytics')
+
+from sqlalchemy import delete, event, func, select  # noqa: E402
+
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from analytics import GRAINS, WATERMARK  # noqa: E402
+from models import AccountFlowRollup, RollupWatermark  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+
+def rollup(*args):
+    result = app.test_cli_runner().invoke(args=['analytics', 'rollup', *args])
+    if result.exit_code != 0:
+        raise SystemExit(result.output or repr(result.exception))
+    return result.output.strip()
+
+
+def timed_get(client, path, headers, runs):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    samples = []
+    for _ in range(runs):
+        statements.clear()
+        event.listen(engine, 'before_cursor_execute', record)
+        started = time.perf_counter()
+        response = client.get(path, headers=headers)
+        samples.append(time.perf_counter() - started)
+        event.remove(engine, 'before_cursor_execute', record)
+        if response.status_code != 200:
+            raise SystemExit(f'{path} respondeu {response.status_code}: {response.get_data(as_text=True)}')
+    return response.json, statistics.median(samples) * 1000, len(statements)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--accounts-per-user', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=2000, help='transações por conta no seed')
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    days = args.years * 365
+    data = seed(args.users, args.accounts_per_user, args.transactions, history_days=days)
+    print(f'seed: {len(data["accounts"])} contas, {data["transactions"]} transações em {days} dias')
+
+    midpoint = (datetime.utcnow() - timedelta(days=days // 2)).strftime('%Y-%m-%d')
+    started = time.perf_counter()
+    with app.app_context():
+        print('rollup:', rollup('--until', midpoint))
+        print('rollup:', rollup())
+        rows = db.session.scalar(select(func.count()).select_from(AccountFlowRollup))
+    print(f'rollup total: {time.perf_counter() - started:.1f}s, {rows} linhas')
+
+    user_id = data['users'][0][0]
+    account_id = next(a[0] for a in data['accounts'] if a[2] == user_id)
+    with app.app_context():
+        headers = {'Authorization': f'Bearer {create_access_token(identity=str(user_id))}'}
+    client = app.test_client()
+    start = (datetime.utcnow() - timedelta(days=days)).date().isoformat()
+
+    paths = {}
+    for grain in GRAINS:
+        window = start if grain != 'day' else (datetime.utcnow() - timedelta(days=365)).date().isoformat()
+        paths[f'conta/{grain}'] = f'/analytics/accounts/{account_id}?grain={grain}&from={window}'
+        paths[f'usuário/{grain}'] = f'/analytics/summary?grain={grain}&from={window}'
+
+    rolled = {name: timed_get(client, path, headers, args.runs) for name, path in paths.items()}
+    with app.app_context():
+        # Without a watermark every period is aggregated from transactions
+        db.session.execute(delete(RollupWatermark).where(RollupWatermark.name == WATERMARK))
+        db.session.commit()
+    live = {name: timed_get(client, path, headers, args.runs) for name, path in paths.items()}
+
+    failed = False
+    print(f'\n{"consulta":<16} {"períodos":>8} {"rollup ms":>10} {"ao vivo ms":>11} {"sql":>4}  resultado')
+    for name in paths:
+        rolled_body, rolled_ms, statements = rolled[name]
+        live_body, live_ms, _ = live[name]
+        same = rolled_body['periods'] == live_body['periods']
+        failed |= not same
+        print(f'{name:<16} {len(rolled_body["periods"]):>8} {rolled_ms:>10.1f} {live_ms:>11.1f} '
+              f'{statements:>4}  {"ok" if same else "DIFERENTE"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Monthly partitions and the cold archive: reads before and after moving old months out.
+
+Seeds `--months` of history, rolls it up, and records for a sample of
+accounts the full NDJSON export, a statement spanning the archive boundary
+and the monthly flow summary. Then runs `flask partitions archive` keeping
+`--hot-months` in the database (on Postgres the table is converted to
+monthly partitions first), and reports the rows moved, file sizes, the
+share of each file's blocks a one-account read decompresses and the time of
+each read before and after.
+
+Checks that every answer is unchanged after archiving, that the archived
+months left the database, that while a month is both published and still
+in the database (the grace period) nothing is read twice, and that
+`restore` brings the newest month back without changing any answer, and
+that a file without its block index is still read correctly, and that
+`analytics rollup --rebuild` restores the archived months' rollups. On
+Postgres it also checks that a one-month statement plans over a single
+partition. Exits 1 on a failed check.
+
+    python -m benchmarks.bench_archive --months 24 --hot-months 6
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-archive')
+os.environ.setdefault('ARCHIVE_PATH', tempfile.mkdtemp())
+
+from sqlalchemy import func, select, text  # noqa: E402
+
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from analytics import flow_summary  # noqa: E402
+from export import stream_ndjson  # noqa: E402
+from models import AccountFlowRollup, Transaction, TransactionArchive  # noqa: E402
+from snapshots import build_statement  # noqa: E402
+from storage import storage  # noqa: E402
+import archive  # noqa: E402
+import partitions  # noqa: E402
+
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def cli(*args):
+    result = app.test_cli_runner().invoke(args=list(args))
+    if result.exit_code != 0:
+        raise SystemExit(f'flask {" ".join(args)}: {result.output or repr(result.exception)}')
+    return result.output.strip()
+
+
+def answers(accounts, statement_range):
+    """(respostas por conta, segundos gastos em exportação, extrato e analytics)"""
+    start, end = statement_range
+    results, timings = {}, {'exportação': 0.0, 'extrato': 0.0, 'analytics': 0.0}
+    with app.app_context():
+        storage.cache.clear()
+        for account_id in accounts:
+            started = time.perf_counter()
+            exported = ''.join(stream_ndjson(account_id))
+            timings['exportação'] += time.perf_counter() - started
+            started = time.perf_counter()
+            statement = build_statement(account_id, start, end)
+            timings['extrato'] += time.perf_counter() - started
+            started = time.perf_counter()
+            flows = flow_summary([account_id], 'month', date(2000, 1, 1), date.today())
+            timings['analytics'] += time.perf_counter() - started
+            results[account_id] = (exported, statement, flows)
+        db.session.remove()
+    return results, timings
+
+
+def rollups():
+    """Todas as linhas de account_flow_rollups, ordenadas"""
+    with app.app_context():
+        result = [tuple(row) for row in db.session.execute(
+            select(*AccountFlowRollup.__table__.columns).order_by(
+                AccountFlowRollup.account_id, AccountFlowRollup.grain, AccountFlowRollup.period_start)
+        )]
+        db.session.remove()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--transactions-per-account', type=int, default=300)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--hot-months', type=int, default=6)
+    parser.add_argument('--sample', type=int, default=20, help='contas comparadas')
+    parser.add_argument('--format', choices=('auto',) + archive.FORMATS, default='auto')
+    parser.add_argument('--block-rows', type=int, default=archive.BLOCK_ROWS, help='linhas por bloco dos arquivos')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(args.users, 2, args.transactions_per_account, history_days=args.months * 31)
+    app.config['TRANSACTIONS_HOT_MONTHS'] = args.hot_months
+    app.config['ARCHIVE_FORMAT'] = args.format
+    archive.BLOCK_ROWS = args.block_rows
+    cli('analytics', 'rollup')
+    accounts = [account[0] for account in data['accounts'][:args.sample]]
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        total = db.session.scalar(select(func.count()).select_from(Transaction))
+        fmt = archive.archive_format(app.config)
+    today = date.today()
+    cutoff = partitions.add_months(today.replace(day=1), -args.hot_months)
+    # Two months on each side of the boundary
+    statement_range = (partitions.add_months(cutoff, -2), partitions.add_months(cutoff, 2) - timedelta(days=1))
+
+    before, before_timings = answers(accounts, statement_range)
+    if dialect == 'postgresql':
+        cli('partitions', 'convert')
+        check(answers(accounts, statement_range)[0] == before, 'respostas iguais após particionar')
+    else:
+        result = app.test_cli_runner().invoke(args=['partitions', 'convert'])
+        check(result.exit_code != 0, f'convert recusado fora do Postgres: {result.output.strip()}')
+
+    started = time.perf_counter()
+    output = cli('partitions', 'archive', '--grace', '0')
+    elapsed = time.perf_counter() - started
+    print(output.splitlines()[-1])
+    with app.app_context():
+        remaining = db.session.scalar(select(func.count()).select_from(Transaction))
+        oldest = db.session.scalar(select(func.min(Transaction.created_at)))
+        entries = db.session.scalars(select(TransactionArchive).order_by(TransactionArchive.month)).all()
+        size = sum(os.path.getsize(archive.file_path(entry.file)) for entry in entries)
+        copies = sum(os.path.getsize(archive.incoming_path(archive.file_path(entry.file))) for entry in entries)
+        archived_rows = sum(entry.row_count for entry in entries)
+        indexes = [archive.load_index(archive.file_path(entry.file)) for entry in entries]
+        newest_file = entries[-1].file if entries else None
+    print(f'{archived_rows} de {total} transações em {len(entries)} arquivos {fmt} '
+          f'({size / 1024:.0f} KiB, {size / max(archived_rows, 1):.1f} bytes/linha, mais {copies / 1024:.0f} KiB '
+          f'de cópias das transferências recebidas) em {elapsed:.1f}s')
+    check(entries and remaining == total - archived_rows and all(entry.dropped_at for entry in entries),
+          f'meses arquivados saíram do banco ({remaining} linhas restantes)')
+    check(oldest is not None and oldest.date() >= cutoff, f'banco começa no corte {cutoff:%Y-%m} ({oldest})')
+
+    shares = [
+        sum(len(index[side]['accounts'].get(account_id, ())) for side in ('outgoing', 'incoming'))
+        / sum(1 + max(max(blocks) for blocks in index[side]['accounts'].values()) for side in ('outgoing', 'incoming'))
+        for index in indexes for account_id in accounts
+    ]
+    print(f'leitura de uma conta: {sum(shares) / max(len(shares), 1):.0%} dos blocos de cada mês, em média')
+    check(indexes and all(index is not None for index in indexes), 'cada arquivo tem seu índice de blocos')
+
+    after, after_timings = answers(accounts, statement_range)
+    for name in before_timings:
+        print(f'{name:<11} antes {before_timings[name] / len(accounts) * 1000:7.2f}ms  '
+              f'depois {after_timings[name] / len(accounts) * 1000:7.2f}ms por conta')
+    for index, name in enumerate(('exportação completa', 'extrato atravessando o corte', 'analytics mensal')):
+        check(all(after[a][index] == before[a][index] for a in accounts), f'{name} igual após arquivar')
+    check(all(len(before[a][0].splitlines()) > 0 for a in accounts), 'contas da amostra têm histórico')
+
+    # Files archived before the index existed are read in full
+    with app.app_context():
+        os.rename(archive.index_path(archive.file_path(newest_file)), archive.index_path(archive.file_path(newest_file)) + '.bak')
+        check(answers(accounts, statement_range)[0] == before, 'arquivo sem índice lido por inteiro, mesmas respostas')
+        os.rename(archive.index_path(archive.file_path(newest_file)) + '.bak', archive.index_path(archive.file_path(newest_file)))
+
+    # The newest archived month comes back; the answers must not move
+    output = cli('partitions', 'restore')
+    print(output)
+    check(answers(accounts, statement_range)[0] == before, 'respostas iguais após restore')
+
+    # Published but not yet removed: the rows exist in both places during the grace period
+    with app.app_context():
+        newest = partitions.add_months(cutoff, -1)
+        entry = partitions.copy_month(newest, fmt)
+        published = entry.row_count if entry is not None else None
+        in_database = db.session.scalar(select(func.count()).select_from(Transaction).where(
+            Transaction.created_at < partitions.month_range(newest)[1],
+            Transaction.created_at >= partitions.month_range(newest)[0]))
+        db.session.remove()
+    check(published is not None and in_database == published,
+          f'{newest:%Y-%m} publicado com as linhas ainda no banco ({in_database})')
+    check(answers(accounts, statement_range)[0] == before, 'nada lido duas vezes durante a carência')
+    cli('partitions', 'archive', '--grace', '0')
+    check(answers(accounts, statement_range)[0] == before, 'respostas iguais após arquivar de novo')
+    print(cli('partitions', 'status').splitlines()[-1])
+
+    # Rebuilding the rollups sums the removed months from their files
+    rolled = rollups()
+    print(cli('analytics', 'rollup', '--rebuild'))
+    check(rollups() == rolled, f'rollup --rebuild refaz os meses arquivados ({len(rolled)} linhas)')
+    check(answers(accounts, statement_range)[0] == before, 'respostas iguais após rollup --rebuild')
+
+    if dialect == 'postgresql':
+        month = partitions.add_months(today.replace(day=1), -1)
+        start, end = partitions.month_range(month)
+        with app.app_context():
+            plan = '\n'.join(db.session.scalars(text(
+                'EXPLAIN SELECT * FROM transactions WHERE account_id = :account '
+                'AND created_at >= :start AND created_at < :end'
+            ), {'account': accounts[0], 'start': start, 'end': end}))
+        scanned = set(re.findall(rf'\b{partitions.TABLE}_(?:p\d{{4}}_\d{{2}}|default)\b', plan))
+        check(scanned == {partitions.partition_name(month)}, f'extrato de um mês lê só a partição do mês ({scanned})')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
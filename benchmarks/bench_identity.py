@@ -0,0 +1,168 @@
+"""SQL statements per authenticated API request, with and without identity claims.
+
+Seeds users with accounts and history, then runs the same request sequences
+with two tokens for one user: a plain token (identity only, as issued before
+the claims existed) and the login token carrying the account ids and
+version. A deposit invalidates the cached account, so with the plain token
+the next request on that account pays for an ownership query; with the
+claims it is decided without the database unless the request needs the row
+anyway (GET /accounts/<id> returns the balance). Reports statements and time
+per sequence.
+
+Then checks the invalidation rules: another user's account is refused from
+the claims alone; after a new account is created the old token falls back
+to the database (and still works), the token returned by the creation takes
+the fast path again; a removed account is refused to a token that listed it.
+Exits 1 on a failed check.
+
+    python -m benchmarks.bench_identity --iterations 200
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-identity')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.exceptions import HTTPException  # noqa: E402
+
+from benchmarks.seed import PASSWORD, TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Account  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+# /accounts and /transactions/<id> belong to the HTML blueprint under WSGI,
+# so the API resources are called directly inside a request context
+ROUTES = {
+    'POST conta': ('accounts_account_list', 'POST', '/accounts', {'account_type': 'checking'}),
+    'GET conta': ('accounts_account_resource', 'GET', '/accounts/{id}', None),
+    'POST transação': ('transactions_transaction_resource', 'POST', '/transactions/{id}',
+                       {'transaction_type': 'deposit', 'amount': 1, 'description': 'identidade'}),
+    'GET histórico': ('transactions_transaction_resource', 'GET', '/transactions/{id}', None),
+}
+SEQUENCES = {
+    'depósitos seguidos': ['POST transação'],
+    'depósito e histórico': ['POST transação', 'GET histórico'],
+    'depósito, histórico e saldo': ['POST transação', 'GET histórico', 'GET conta'],
+}
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def call(token, route, account_id=None):
+    """(status, corpo, instruções SQL) de uma chamada à rota da API"""
+    endpoint, method, path, body = ROUTES[route]
+    recorded = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        recorded.append(statement)
+
+    kwargs = {} if account_id is None else {'account_id': account_id}
+    with app.test_request_context(path.format(id=account_id), method=method, json=body,
+                                  headers={'Authorization': f'Bearer {token}'}):
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = app.make_response(app.view_functions[endpoint](**kwargs))
+        except HTTPException as e:
+            response = e.get_response()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+            db.session.remove()
+    return response.status_code, response.get_json(silent=True), recorded
+
+
+def login(client, username):
+    response = client.post('/auth/login', json={'username': username, 'password': PASSWORD})
+    return response.json['access_token']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--accounts-per-user', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--verbose', action='store_true', help='mostra o SQL de uma iteração')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(args.users, args.accounts_per_user, 20)
+    (user_id, username), (other_id, _) = data['users'][:2]
+    account_id = next(a[0] for a in data['accounts'] if a[2] == user_id)
+    other_account = next(a[0] for a in data['accounts'] if a[2] == other_id)
+    client = app.test_client()
+    with app.app_context():
+        tokens = {'sem claims': create_access_token(identity=str(user_id)),
+                  'com claims': login(client, username)}
+
+    width = max(map(len, SEQUENCES))
+    print(f'{"sequência":<{width}} {"token":<11} {"sql/req":>8} {"µs/req":>8}')
+    results = {}
+    for sequence, routes in SEQUENCES.items():
+        for name, token in tokens.items():
+            count = elapsed = 0
+            for iteration in range(args.iterations + 1):
+                for route in routes:
+                    started = time.perf_counter()
+                    status, body, statements = call(token, route, account_id)
+                    if status != 200:
+                        raise SystemExit(f'{route} respondeu {status}: {body}')
+                    if iteration == 0:
+                        # Warm-up: leaves the cache as the previous sequence would
+                        continue
+                    elapsed += time.perf_counter() - started
+                    count += len(statements)
+                    if args.verbose and iteration == 1:
+                        print(f'  {name} {route}:')
+                        for statement in statements:
+                            print('    ' + ' '.join(statement.split())[:140])
+            requests = args.iterations * len(routes)
+            results[sequence, name] = count / requests
+            print(f'{sequence:<{width}} {name:<11} {count / requests:>8.2f} {elapsed / requests * 1e6:>8.0f}')
+    for sequence, routes in SEQUENCES.items():
+        before, after = results[sequence, 'sem claims'], results[sequence, 'com claims']
+        # Reading the balance loads the row the plain token would have checked
+        saves = 'GET conta' not in routes
+        check(after < before if saves else after <= before,
+              f'{sequence}: {before:.2f} -> {after:.2f} consultas por requisição')
+
+    claims_token = tokens['com claims']
+    _, _, current = call(claims_token, 'GET histórico', account_id)
+    status, _, statements = call(claims_token, 'GET histórico', other_account)
+    check(status == 404 and not statements, f'conta de outro usuário: {status} sem consulta ({len(statements)})')
+
+    status, body, _ = call(claims_token, 'POST conta')
+    new_account, fresh_token = body['account_id'], body['access_token']
+    # After a deposit the account is out of the cache: only a database check costs a query
+    call(fresh_token, 'POST transação', account_id)
+    status, _, fresh = call(fresh_token, 'GET histórico', account_id)
+    check(status == 200 and len(fresh) == len(current),
+          f'token devolvido na criação usa as claims ({len(fresh)} consultas)')
+    call(claims_token, 'POST transação', account_id)
+    status, _, stale = call(claims_token, 'GET histórico', account_id)
+    check(status == 200 and len(stale) > len(fresh),
+          f'token anterior à nova conta volta ao banco ({len(stale)} consultas)')
+    status, _, _ = call(claims_token, 'GET histórico', new_account)
+    check(status == 200, f'token anterior acessa a conta nova pelo banco ({status})')
+
+    with app.app_context():
+        db.session.delete(db.session.get(Account, new_account))
+        db.session.commit()
+    status, _, _ = call(fresh_token, 'GET histórico', new_account)
+    check(status == 404, f'conta removida é recusada ao token que a listava ({status})')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
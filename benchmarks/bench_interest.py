@@ -0,0 +1,270 @@
+"""End-of-day interest accrual: per-account transactions against the chunked bulk job.
+
+Seeds `--users` × `--accounts-per-user` accounts with varied balances (some
+on an exact half-cent of interest), times crediting the interest of a sample
+one account at a time through utils.process_transaction, then runs `flask
+interest accrue` in-process and with `--workers` processes, each on its own
+day, and reports accounts per second.
+
+Checks that every account got exactly (end-of-day balance × rate / 365)
+rounded half even to the cent, that a day run after later credits still
+pays on that day's closing balance, one transaction per credited account and none for
+accounts without a rate or with nothing to credit, that the ledger moved
+with the balances, that a run interrupted halfway resumes without paying
+any range twice, that a range cannot be paid twice even when asked
+directly, and that running a finished day again changes nothing. Exits 1
+on a failed check.
+
+    python -m benchmarks.bench_interest --users 4000 --workers 4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from decimal import ROUND_HALF_EVEN, Decimal
+from math import gcd
+from unittest import mock
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-interest')
+os.environ.setdefault('RISK_ENABLED', '0')
+
+from sqlalchemy import case, delete, func, select, update  # noqa: E402
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from ledger import ledger_balances  # noqa: E402
+from models import Account, AccountDailyBalance, InterestCheckpoint, Transaction  # noqa: E402
+from snapshots import upsert_daily_balances  # noqa: E402
+from utils import process_transaction  # noqa: E402
+import interest  # noqa: E402
+
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def cli(*args):
+    result = app.test_cli_runner().invoke(args=list(args))
+    if result.exit_code != 0:
+        raise SystemExit(f'flask {" ".join(args)}: {result.output or repr(result.exception)}')
+    return result.output.strip()
+
+
+def tie_cents(rate):
+    """Um saldo em centavos cujo juro do dia cai exatamente em meio centavo, se houver"""
+    numerator, denominator = rate
+    denominator *= interest.DAYS_PER_YEAR
+    g = gcd(numerator, denominator)
+    if denominator % 2 or (denominator // 2) % g:
+        return None
+    modulus = denominator // g
+    return (denominator // 2 // g) * pow(numerator // g, -1, modulus) % modulus or modulus
+
+
+def set_balances(accounts, rates, rng, day):
+    """Saldos variados: zero, centavos, milhões e empates de meio centavo, vigentes desde `day`"""
+    ties = [tie_cents(rate) for rate in rates.values()]
+    ties = [cents for cents in ties if cents]
+    balances = {}
+    for account_id in accounts:
+        kind = rng.random()
+        if kind < 0.05:
+            cents = 0
+        elif kind < 0.15:
+            cents = rng.randint(1, 500)
+        elif kind < 0.30 and ties:
+            cents = rng.choice(ties) * rng.choice((1, 3, 5, 7))
+        else:
+            cents = rng.randint(1, 10 ** 10)
+        balances[account_id] = Decimal(cents).scaleb(-2)
+    with app.app_context():
+        for offset in range(0, len(accounts), 1000):
+            batch = {account_id: balances[account_id] for account_id in accounts[offset:offset + 1000]}
+            db.session.execute(
+                update(Account).where(Account.id.in_(list(batch)))
+                .values(balance=case(batch, value=Account.id))
+                .execution_options(synchronize_session=False)
+            )
+        # The daily balances agree: the balance set here is each account's closing balance from `day` on
+        db.session.execute(delete(AccountDailyBalance).where(AccountDailyBalance.day >= day))
+        upsert_daily_balances([{'account_id': account_id, 'day': day, 'balance': balance}
+                               for account_id, balance in balances.items()])
+        db.session.commit()
+
+
+def state():
+    """{conta: (tipo, saldo, saldo - razão)}"""
+    with app.app_context():
+        ledger = ledger_balances()
+        rows = db.session.execute(
+            select(Account.id, Account.account_type, Account.balance, func.coalesce(ledger.c.balance, 0))
+            .outerjoin(ledger, ledger.c.account_id == Account.id)
+        ).all()
+        db.session.remove()
+    return {row[0]: (row[1], Decimal(row[2]), Decimal(row[2]) - Decimal(row[3])) for row in rows}
+
+
+def credits_for(day):
+    """{conta: [valores]} das transações de juros do dia"""
+    with app.app_context():
+        rows = db.session.execute(
+            select(Transaction.account_id, Transaction.amount)
+            .where(Transaction.description == interest.description_for(day))
+        ).all()
+        db.session.remove()
+    credited = {}
+    for account_id, amount in rows:
+        credited.setdefault(account_id, []).append(Decimal(amount))
+    return credited
+
+
+def closing_balances(day):
+    """{conta: saldo no fim de `day`}, lido conta a conta do último saldo diário"""
+    with app.app_context():
+        rows = db.session.execute(
+            select(AccountDailyBalance.account_id, AccountDailyBalance.balance)
+            .where(AccountDailyBalance.day <= day)
+            .order_by(AccountDailyBalance.account_id, AccountDailyBalance.day)
+        ).all()
+        db.session.remove()
+    # Ordered by day, so the last one wins
+    return {account_id: Decimal(balance) for account_id, balance in rows}
+
+
+def expected_interest(before, rates, day):
+    """Juro esperado por conta sobre o saldo do fim de `day`, calculado com Decimal"""
+    expected = {}
+    closing = closing_balances(day)
+    for account_id, (account_type, _, _) in before.items():
+        balance = closing.get(account_id, Decimal('0'))
+        rate = rates.get(account_type)
+        if rate is None or balance <= 0:
+            continue
+        value = (balance * Decimal(rate) / interest.DAYS_PER_YEAR).quantize(Decimal('0.01'), ROUND_HALF_EVEN)
+        if value:
+            expected[account_id] = value
+    return expected
+
+
+def verify(label, day, before, rates):
+    after = state()
+    expected = expected_interest(before, rates, day)
+    credited = credits_for(day)
+    check(credited == {a: [v] for a, v in expected.items()},
+          f'{label}: um crédito por conta com o valor exato ({len(credited)} contas)')
+    check(all(after[a][1] == before[a][1] + expected.get(a, 0) for a in before),
+          f'{label}: saldos somam exatamente o juro')
+    check(all(after[a][2] == before[a][2] for a in before), f'{label}: razão acompanha os saldos')
+    return after, expected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--accounts-per-user', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--sample', type=int, default=500, help='contas creditadas uma a uma')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(args.users, args.accounts_per_user, 1)
+    accounts = [account[0] for account in data['accounts']]
+    rates = {'savings': '0.06', 'checking': '0.0125'}
+    app.config['INTEREST_RATES'] = rates
+    parsed = interest.parse_rates(rates)
+    chunk = str(args.chunk_size)
+    today = date.today()
+    set_balances(accounts, parsed, random.Random(7), today - timedelta(days=4))
+
+    # Baseline: one process_transaction per account, interest computed with Decimal
+    before = state()
+    sample = accounts[:args.sample]
+    expected = expected_interest(before, rates, today)
+    started = time.perf_counter()
+    with app.app_context():
+        for account_id in sample:
+            if account_id in expected:
+                account = db.session.get(Account, account_id)
+                process_transaction(account, 'deposit', expected[account_id], 'juros por conta')
+        db.session.remove()
+    baseline = len(sample) / (time.perf_counter() - started)
+    print(f'uma transação por conta: {baseline:.0f} contas/s')
+
+    runs = {}
+    for label, day, workers in (('em processo', today - timedelta(days=1), 0),
+                                (f'{args.workers} processos', today - timedelta(days=2), args.workers)):
+        before = state()
+        started = time.perf_counter()
+        output = cli('interest', 'accrue', '--date', day.isoformat(), '--workers', str(workers), '--chunk-size', chunk)
+        elapsed = time.perf_counter() - started
+        print(f'{label}: {output}')
+        runs[label] = len(accounts) / elapsed
+        _, expected = verify(label, day, before, rates)
+        if workers:
+            # Run after yesterday's credits: the current balances would pay a different amount
+            check(expected != expected_interest(before, rates, today),
+                  f'{label}: dia anterior pago sobre o saldo daquele dia, não o atual')
+    for label, speed in runs.items():
+        print(f'{label}: {speed:.0f} contas/s ({speed / baseline:.1f}x uma transação por conta)')
+
+    # Interrupted run: some ranges committed, one rolled back midway, then the CLI resumes
+    day = today - timedelta(days=3)
+    before = state()
+    with app.app_context():
+        ranges = interest.account_ranges(args.chunk_size, parsed)
+        for start, end in ranges[:len(ranges) // 2]:
+            interest.accrue_range(day, start, end, parsed)
+        db.session.remove()
+        # Crash before the commit of the next range
+        start, end = ranges[len(ranges) // 2]
+        with mock.patch.object(db.session, 'commit', side_effect=RuntimeError('queda')):
+            try:
+                interest.accrue_range(day, start, end, parsed)
+            except RuntimeError:
+                db.session.rollback()
+        db.session.remove()
+    refused = app.test_cli_runner().invoke(args=['interest', 'accrue', '--date', day.isoformat(),
+                                                 '--chunk-size', str(args.chunk_size * 2)])
+    check(refused.exit_code != 0, f'retomada com outra largura de faixa recusada: {refused.output.strip()}')
+    print(f'retomada: {cli("interest", "accrue", "--date", day.isoformat(), "--chunk-size", chunk)}')
+    verify('retomada', day, before, rates)
+
+    # A finished day and a finished range are not paid again
+    before = state()
+    print(cli('interest', 'accrue', '--date', day.isoformat(), '--chunk-size', chunk))
+    with app.app_context():
+        start, end = ranges[0]
+        try:
+            interest.accrue_range(day, start, end, parsed)
+            duplicated = True
+        except IntegrityError:
+            db.session.rollback()
+            duplicated = False
+        checkpoints = db.session.scalar(select(func.count()).select_from(InterestCheckpoint)
+                                        .where(InterestCheckpoint.accrual_date == day))
+        db.session.remove()
+    check(not duplicated, 'faixa já lançada recusada pela chave do checkpoint')
+    check(checkpoints == len(ranges), f'um checkpoint por faixa ({checkpoints} de {len(ranges)})')
+    check(state() == before, 'dia já lançado não muda nenhum saldo')
+    print(cli('interest', 'status', '--date', day.isoformat()))
+
+    refused = app.test_cli_runner().invoke(args=['interest', 'accrue', '--date', today.isoformat()])
+    check(refused.exit_code != 0, 'dia em andamento recusado')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
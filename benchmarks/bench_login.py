@@ -0,0 +1,87 @@
+"""Login throughput (password verification) versus hashing worker count.
+
+Each run keeps `--clients` threads calling HashingService.verify for
+`--duration` seconds, like concurrent requests on /auth/login, and reports
+verifications per second, latency percentiles and how many calls were shed
+with 429.
+
+    python -m benchmarks.bench_login --workers 0 1 2 4 --clients 16
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.security import generate_password_hash
+
+from hashing import HashingService
+
+
+def run(workers, clients, duration, method, max_pending):
+    service = HashingService(method=method, workers=workers, max_pending=max_pending, timeout=60)
+    password_hash = generate_password_hash('benchmark-password', method)
+    service.verify(password_hash, 'benchmark-password')  # start the pool before timing
+
+    latencies, rejected = [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        local, shed = [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                service.verify(password_hash, 'benchmark-password')
+                local.append(time.perf_counter() - started)
+            except TooManyRequests:
+                shed += 1
+                time.sleep(0.001)
+        with lock:
+            latencies.extend(local)
+            rejected[0] += shed
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    service.shutdown()
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    return {
+        'workers': workers,
+        'clients': clients,
+        'throughput': len(latencies) / duration,
+        'p50_ms': quantiles[49] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'rejected': rejected[0],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, os.cpu_count() or 4])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--method', default='scrypt')
+    parser.add_argument('--max-pending', type=int, default=None)
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f'{"workers":>8} {"logins/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"429s":>6}')
+    for workers in args.workers:
+        result = run(workers, args.clients, args.duration, args.method, args.max_pending)
+        results.append(result)
+        print(f'{workers:>8} {result["throughput"]:>10.1f} {result["p50_ms"]:>8.1f} '
+              f'{result["p99_ms"]:>8.1f} {result["rejected"]:>6}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
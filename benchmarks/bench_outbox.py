@@ -0,0 +1,274 @@
+"""Transaction event outbox: commit overhead, dispatch throughput and lag, delivery guarantees.
+
+Times deposits through utils.process_transaction with OUTBOX_ENABLED off and
+on (the difference is the one INSERT added to each commit), then produces
+`--transactions` more deposits and a bulk batch while `--workers` forked
+dispatchers drain the outbox into an NDJSON file, and reports throughput and
+the lag from commit to delivery.
+
+Checks that every committed transaction (per-operation and bulk) has exactly
+one event and a rolled-back one has none, that the file holds every event
+exactly once, that a webhook answering 503 to some big batches still receives
+every event while a poison event that always fails ends 'dead' after
+OUTBOX_MAX_ATTEMPTS, and that events claimed by a worker that died are
+redelivered when its lease ends, the late worker's marks being discarded.
+Exits 1 on a failed check.
+
+    python -m benchmarks.bench_outbox --transactions 5000 --workers 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-outbox')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('RISK_ENABLED', '0')
+
+from sqlalchemy import event, func, select, update  # noqa: E402
+
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db, dispose_engines  # noqa: E402
+from models import Account, OutboxEvent, Transaction  # noqa: E402
+from outbox import Dispatcher, DispatchResult, NDJSONSink, WebhookSink, claim_statement, summarize  # noqa: E402
+from batch import process_batch  # noqa: E402
+from utils import process_transaction  # noqa: E402
+
+POISON = 'veneno'
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def deposit(account_id, description='outbox'):
+    with app.app_context():
+        account = db.session.get(Account, account_id)
+        success, message, _ = process_transaction(account, 'deposit', Decimal('1.00'), description)
+        db.session.remove()
+    if not success:
+        raise SystemExit(f'depósito recusado: {message}')
+
+
+def timed_deposits(accounts, count):
+    """(µs por depósito, instruções SQL por depósito)"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    started = time.perf_counter()
+    try:
+        for i in range(count):
+            deposit(accounts[i % len(accounts)])
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return (time.perf_counter() - started) / count * 1e6, len(statements) / count
+
+
+def dispatch(worker, path, batch_size, done, queue):
+    """Worker: drena o outbox até o produtor terminar e a fila esvaziar"""
+    dispose_engines(app)
+    with app.app_context():
+        dispatcher = Dispatcher([NDJSONSink(path)], worker=f'bench-{worker}', batch_size=batch_size)
+        results = []
+        while True:
+            finished = done.is_set()
+            batch = dispatcher.run_batch()
+            db.session.remove()
+            if batch.claimed:
+                results.append(batch)
+            elif finished:
+                break
+            else:
+                time.sleep(0.01)
+    queue.put([(b.claimed, b.sent, b.retried, b.dead, b.lost, b.elapsed, b.lags) for b in results])
+
+
+class Webhook(BaseHTTPRequestHandler):
+    """Destino de teste: 503 a um de cada três lotes grandes, 500 para qualquer lote com o evento venenoso"""
+    received = []
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        events = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['events']
+        with Webhook.lock:
+            Webhook.calls += 1
+            # Overload hits big batches; the one-by-one fallback gets through
+            flaky = len(events) > 1 and Webhook.calls % 3 == 0
+            if not flaky and all(item['data']['description'] != POISON for item in events):
+                Webhook.received.extend(item['id'] for item in events)
+        if flaky:
+            status = 503
+        elif any(item['data']['description'] == POISON for item in events):
+            status = 500
+        else:
+            status = 204
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def pending_ids():
+    return set(db.session.scalars(select(OutboxEvent.id).where(OutboxEvent.status == 'pending')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--transactions', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--overhead', type=int, default=500, help='depósitos por medição de sobrecarga')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(args.users, 1, 5)
+    accounts = [account[0] for account in data['accounts']]
+
+    app.config['OUTBOX_ENABLED'] = False
+    off, off_sql = timed_deposits(accounts, args.overhead)
+    app.config['OUTBOX_ENABLED'] = True
+    on, on_sql = timed_deposits(accounts, args.overhead)
+    print(f'depósito sem outbox: {off:.0f}µs, {off_sql:.1f} instruções; '
+          f'com outbox: {on:.0f}µs, {on_sql:.1f} instruções ({on - off:+.0f}µs)')
+    check(on_sql - off_sql == 1, f'outbox acrescenta uma instrução ao commit ({on_sql - off_sql:+.1f})')
+
+    # Events of the timed deposits are removed so the drain below starts empty
+    with app.app_context():
+        db.session.execute(OutboxEvent.__table__.delete())
+        db.session.commit()
+        produced_from = db.session.scalar(select(func.max(Transaction.id)))
+
+    path = os.path.join(tempfile.mkdtemp(), 'events.ndjson')
+    context = multiprocessing.get_context('fork')
+    done, queue = context.Event(), context.Queue()
+    processes = [context.Process(target=dispatch, args=(i, path, args.batch_size, done, queue))
+                 for i in range(args.workers)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    for i in range(args.transactions):
+        deposit(accounts[i % len(accounts)])
+    with app.app_context():
+        bulk = process_batch(data['accounts'][0][2], [
+            {'account_id': accounts[0], 'transaction_type': 'deposit', 'amount': 1, 'description': 'lote'}
+            for _ in range(100)
+        ] + [{'account_id': accounts[0], 'transaction_type': 'withdrawal', 'amount': 10 ** 9, 'description': 'lote'}])
+        db.session.remove()
+    produced = time.perf_counter() - started
+    done.set()
+    reports = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    batches = []
+    for report in reports:
+        for claimed, sent, retried, dead, lost, batch_elapsed, lags in report:
+            batch = DispatchResult()
+            batch.claimed, batch.sent, batch.retried, batch.dead, batch.lost, batch.elapsed, batch.lags = (
+                claimed, sent, retried, dead, lost, batch_elapsed, lags)
+            batches.append(batch)
+    print(f'produção: {args.transactions / produced:.0f} depósitos/s; '
+          f'{args.workers} despachante(s): {summarize(batches, elapsed)}')
+
+    with app.app_context():
+        created = set(db.session.scalars(select(Transaction.id).where(Transaction.id > produced_from)))
+        events = db.session.execute(select(OutboxEvent.id, OutboxEvent.aggregate_id, OutboxEvent.status)).all()
+        aggregates = [row.aggregate_id for row in events]
+        check(sorted(aggregates) == sorted(created),
+              f'um evento por transação commitada ({len(events)} eventos, {len(created)} transações, '
+              f'{sum(r["success"] for r in bulk)} do lote)')
+        check(all(row.status == 'sent' for row in events), 'todos os eventos marcados como enviados')
+        with open(path, encoding='utf-8') as file:
+            delivered = [json.loads(line) for line in file]
+        ids = [item['id'] for item in delivered]
+        check(len(ids) == len(set(ids)) and set(ids) == {row.id for row in events},
+              f'arquivo com cada evento uma única vez ({len(ids)} linhas)')
+        check({item['data']['transaction_id'] for item in delivered} == created,
+              'eventos do arquivo cobrem todas as transações')
+
+        # A flushed transaction that is rolled back leaves no event behind
+        db.session.add(Transaction(account_id=accounts[0], transaction_type='deposit', amount=Decimal('1'),
+                                   description='desfeita'))
+        db.session.flush()
+        db.session.rollback()
+        check(not pending_ids(), 'transação desfeita não deixa evento')
+
+    # Webhook that fails some batches, plus one event no retry can deliver
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Webhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for i in range(300):
+        deposit(accounts[i % len(accounts)], POISON if i == 150 else 'webhook')
+    with app.app_context():
+        webhook_events = pending_ids()
+        dispatcher = Dispatcher([WebhookSink(f'http://127.0.0.1:{server.server_port}/')], worker='bench-webhook',
+                                batch_size=50, max_attempts=3, backoff_seconds=0)
+        results = dispatcher.run(drain=True)
+        statuses = dict(db.session.execute(
+            select(OutboxEvent.id, OutboxEvent.status).where(OutboxEvent.id.in_(webhook_events))).all())
+        dead = [event_id for event_id, status in statuses.items() if status == 'dead']
+        poison = db.session.get(OutboxEvent, dead[0]) if len(dead) == 1 else None
+    server.shutdown()
+    print(f'webhook: {Webhook.calls} chamadas; {summarize(results, sum(r.elapsed for r in results))}')
+    check(poison is not None and json.loads(poison.payload)['description'] == POISON and poison.attempts == 3,
+          f'evento venenoso descartado após 3 tentativas ({len(dead)} descartado(s))')
+    check(set(Webhook.received) == webhook_events - set(dead),
+          f'webhook recebeu todos os outros eventos apesar das falhas ({len(set(Webhook.received))})')
+    check(sum(status == 'sent' for status in statuses.values()) == len(webhook_events) - 1,
+          'demais eventos marcados como enviados')
+
+    # A worker claims a batch and dies: the lease runs out and another worker delivers it
+    for i in range(20):
+        deposit(accounts[i % len(accounts)], 'concessão')
+    second = os.path.join(tempfile.mkdtemp(), 'events.ndjson')
+    with app.app_context():
+        lease = timedelta(seconds=1)
+        claimed = db.session.execute(claim_statement('morto', 100, datetime.utcnow(), lease)).all()
+        db.session.commit()
+        rescuer = Dispatcher([NDJSONSink(second)], worker='resgate', lease_seconds=60)
+        early = rescuer.run_batch()
+        time.sleep(lease.total_seconds() + 0.1)
+        late = rescuer.run_batch()
+        stale = db.session.execute(
+            update(OutboxEvent).where(OutboxEvent.id.in_([row.id for row in claimed]),
+                                      OutboxEvent.claimed_by == 'morto')
+            .values(status='dead').execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        check(len(claimed) == 20 and early.claimed == 0,
+              f'eventos reivindicados não são entregues durante a concessão ({early.claimed})')
+        check(late.sent == 20, f'concessão vencida: outro worker entrega os eventos ({late.sent})')
+        check(stale == 0, 'worker atrasado não altera eventos reivindicados por outro')
+
+    lags = sorted(lag for batch in batches for lag in batch.lags)
+    if lags:
+        print(f'atraso commit -> entrega: p50 {statistics.median(lags) * 1000:.0f}ms, '
+              f'máx {lags[-1] * 1000:.0f}ms')
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
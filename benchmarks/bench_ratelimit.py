@@ -0,0 +1,129 @@
+"""Rate limiter and admission control: per-request overhead and behaviour.
+
+Times, in microseconds per call:
+- the bucket backends alone (local, and shared via the local stand-in), from
+  one thread and from several contending threads;
+- the @rate_limited decorator as a request pays for it (JWT identity lookup,
+  key, bucket update);
+- admission enter/leave.
+
+Then checks the behaviour through the test client: the auth rule answers 429
+with Retry-After once the bucket is empty, other clients keep their own
+bucket, and a saturated pool makes admission answer 503.
+Exits 1 if decorator plus admission cost more than `--budget-us` per request
+or a check fails.
+
+    python -m benchmarks.bench_ratelimit
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ratelimit.db')
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-ratelimit')
+
+from flask_jwt_extended import create_access_token, verify_jwt_in_request  # noqa: E402
+
+import metrics  # noqa: E402
+from app import create_app, db  # noqa: E402
+from cache import LocalSharedStore  # noqa: E402
+from ratelimit import Admission, LocalRateLimiter, SharedRateLimiter, rate_limited  # noqa: E402
+
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def per_call_us(fn, calls, threads=1):
+    def worker():
+        for _ in range(calls):
+            fn()
+
+    if threads == 1:
+        # Same thread: keeps the caller's request context
+        started = time.perf_counter()
+        worker()
+        return (time.perf_counter() - started) / calls * 1e6
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return (time.perf_counter() - started) / (calls * threads) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--keys', type=int, default=10000, help='clientes distintos')
+    parser.add_argument('--budget-us', type=float, default=50)
+    args = parser.parse_args(argv)
+
+    backends = {'local': LocalRateLimiter(), 'shared (substituto local)': SharedRateLimiter(LocalSharedStore())}
+    print(f'{"backend":<28} {"threads":>7} {"µs/chamada":>11}')
+    for name, backend in backends.items():
+        for threads in (1, args.threads):
+            counter = iter(range(10 ** 9))
+
+            def take():
+                backend.take(f'read:route:{next(counter) % args.keys}', 600, 10)
+            print(f'{name:<28} {threads:>7} {per_call_us(take, args.calls // threads, threads):>11.2f}')
+
+    app = create_app({'RATE_LIMITS': {'auth': '5/minute', 'read': '1000000/second'},
+                      'ADMISSION_POOL_WAIT_MS': 100})
+    with app.app_context():
+        db.create_all()
+        token = create_access_token(identity='42')
+
+    view = rate_limited('read')(lambda: None)
+    with app.test_request_context('/accounts', headers={'Authorization': f'Bearer {token}'}):
+        verify_jwt_in_request()
+        baseline = per_call_us(lambda: None, args.calls)
+        decorated = per_call_us(view, args.calls) - baseline
+    admission = Admission(max_pool_wait=0.1, max_inflight=1000)
+
+    def admit():
+        admission.enter()
+        admission.leave()
+    admitted = per_call_us(admit, args.calls)
+    print(f'\n@rate_limited por requisição: {decorated:.2f} µs; admissão: {admitted:.2f} µs')
+    check(decorated + admitted < args.budget_us,
+          f'custo por requisição abaixo de {args.budget_us:.0f} µs ({decorated + admitted:.2f} µs)')
+
+    client = app.test_client()
+    statuses = [client.post('/auth/login', json={'username': 'x', 'password': 'y'},
+                            environ_base={'REMOTE_ADDR': '10.0.0.1'}) for _ in range(6)]
+    check([r.status_code for r in statuses[:5]] == [401] * 5 and statuses[5].status_code == 429
+          and statuses[5].headers.get('Retry-After') is not None,
+          f'login: 5 tentativas e então 429 (Retry-After {statuses[5].headers.get("Retry-After")})')
+    other = client.post('/auth/login', json={'username': 'x', 'password': 'y'},
+                        environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    check(other.status_code == 401, f'outro IP tem o próprio balde ({other.status_code})')
+
+    for _ in range(20):
+        metrics.pool_pressure.observe(0.5)
+    shed = client.get('/accounts', headers={'Authorization': f'Bearer {token}'})
+    served = client.get('/metrics')
+    check(shed.status_code == 503 and shed.headers.get('Retry-After') == '1' and served.status_code == 200,
+          f'pool saturado: 503 nas rotas ({shed.status_code}), /metrics continua ({served.status_code})')
+    metrics.pool_pressure.updated -= metrics.pool_pressure.stale
+    recovered = client.get('/', headers={'Authorization': f'Bearer {token}'})
+    check(recovered.status_code == 200, f'sem checkouts recentes a admissão volta a aceitar ({recovered.status_code})')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Recurring transfers: scheduler throughput and lag versus one request per transfer.
+
+Seeds accounts, times a sample of transfers posted one at a time through
+POST /transactions/<id> (what a cron job calling the API does), then creates
+`--instructions` recurring transfers that all fall due at the same instant
+(a month-start spike) and drains them with `--workers` scheduler processes
+claiming from the same queue. Lag is measured from that instant, so the
+p95 is how long the spike takes to clear. A few instructions point at an empty account,
+so the retry path runs too.
+
+Checks that every due instruction ran exactly once (one transaction each,
+next_run_at moved one period ahead, no claim left behind), that failures are
+waiting for a retry, and that the transfers moved money without creating or
+losing any. Exits 1 on a failed check.
+
+    python -m benchmarks.bench_recurring --instructions 5000 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-recurring')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+# Thousands of transfers per minute from the same accounts would trip the velocity limits
+os.environ.setdefault('RISK_ENABLED', '0')
+
+from sqlalchemy import func, insert, select, update  # noqa: E402
+
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db, dispose_engines  # noqa: E402
+from models import Account, RecurringTransfer, Transaction  # noqa: E402
+from recurring import Scheduler, next_occurrence, summarize  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+DESCRIPTION = 'programada'
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def drain(worker, batch_size, queue):
+    dispose_engines(app)
+    with app.app_context():
+        scheduler = Scheduler.from_config(app.config, worker=f'bench-{worker}', batch_size=batch_size)
+        results = scheduler.run(drain=True)
+    queue.put([(batch.succeeded, batch.failed, batch.lost, batch.elapsed, batch.lags) for batch in results])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--instructions', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=300, help='transferências do caminho por requisição')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(args.users, 2, 20)
+    rng = random.Random(7)
+    accounts = data['accounts']
+    with app.app_context():
+        # Plenty of money everywhere except one account, which makes its instructions fail
+        db.session.execute(update(Account).values(balance=Account.balance + 100000))
+        empty = accounts[0][0]
+        db.session.execute(update(Account).where(Account.id == empty).values(balance=0))
+        db.session.commit()
+        total_before = db.session.scalar(select(func.sum(Account.balance)))
+
+    # The HTML blueprint owns /transactions/<id> under WSGI, so the API
+    # resource is called directly in a request context
+    view = app.view_functions['transactions_transaction_resource']
+    tokens = {}
+    started = time.perf_counter()
+    for _ in range(args.requests):
+        (source, _, owner), (_, target, _) = rng.sample(accounts[1:], 2)
+        if owner not in tokens:
+            with app.app_context():
+                tokens[owner] = create_access_token(identity=str(owner))
+        with app.test_request_context(f'/transactions/{source}', method='POST',
+                                      headers={'Authorization': f'Bearer {tokens[owner]}'},
+                                      json={'transaction_type': 'transfer', 'amount': 1, 'description': 'cron',
+                                            'to_account_id': target}):
+            response = app.make_response(view(account_id=source))
+        if response.status_code != 200:
+            raise SystemExit(f'POST /transactions respondeu {response.status_code}: {response.get_data(as_text=True)}')
+    per_request = args.requests / (time.perf_counter() - started)
+    print(f'uma requisição por transferência: {per_request:.0f}/s ({args.requests} transferências)')
+
+    now = datetime.utcnow()
+    rows = []
+    for _ in range(args.instructions):
+        source, target = rng.sample(accounts, 2)
+        scheduled = now
+        rows.append({
+            'account_id': source[0], 'to_account_id': target[0],
+            'amount': Decimal(rng.randint(100, 5000)) / 100, 'description': DESCRIPTION,
+            'frequency': rng.choice(('daily', 'weekly', 'monthly')), 'anchor_day': scheduled.day,
+            'next_run_at': scheduled, 'active': True, 'attempts': 0, 'created_at': now,
+        })
+    expected_failures = sum(1 for row in rows if row['account_id'] == empty)
+    with app.app_context():
+        db.session.execute(insert(RecurringTransfer), rows)
+        db.session.commit()
+
+    queue = multiprocessing.get_context('fork').Queue()
+    processes = [multiprocessing.get_context('fork').Process(target=drain, args=(i, args.batch_size, queue))
+                 for i in range(args.workers)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    reports = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    from recurring import BatchResult
+    batches = []
+    for report in reports:
+        for succeeded, failed, lost, batch_elapsed, lags in report:
+            batch = BatchResult()
+            batch.succeeded, batch.failed, batch.lost, batch.elapsed, batch.lags = (
+                succeeded, failed, lost, batch_elapsed, lags)
+            batch.claimed = succeeded + failed + lost
+            batches.append(batch)
+    print(f'agendador, {args.workers} worker(s): {summarize(batches, elapsed)}')
+    per_worker = [sum(b[0] + b[1] for b in report) for report in reports]
+    print(f'ocorrências por worker: {per_worker}; {len(batches)} lotes')
+
+    with app.app_context():
+        executed = db.session.scalar(
+            select(func.count()).select_from(Transaction).where(Transaction.description == DESCRIPTION))
+        check(executed == args.instructions - expected_failures,
+              f'{executed} transferências para {args.instructions - expected_failures} instruções executáveis')
+        check(sum(per_worker) == args.instructions,
+              f'cada instrução reivindicada por um único worker ({sum(per_worker)} execuções)')
+        stored = db.session.execute(select(RecurringTransfer)).scalars().all()
+        moved = [r for r in stored if r.account_id != empty]
+        waiting = [r for r in stored if r.account_id == empty]
+        original = {i + 1: row for i, row in enumerate(rows)}
+        check(all(r.next_run_at == next_occurrence(original[r.id]['next_run_at'], r.frequency, r.anchor_day)
+                  and r.last_status == 'ok' for r in moved),
+              f'{len(moved)} instruções avançaram exatamente um período')
+        check(all(r.claimed_by is None for r in stored), 'nenhuma concessão ficou presa')
+        check(all(r.last_status == 'failed' and r.attempts == 1 and r.claimed_until > now for r in waiting),
+              f'{len(waiting)} instruções sem saldo aguardam nova tentativa')
+        total_after = db.session.scalar(select(func.sum(Account.balance)))
+        check(total_after == total_before, f'soma dos saldos preservada ({total_after})')
+        due = db.session.scalar(select(func.count()).select_from(RecurringTransfer).where(
+            RecurringTransfer.next_run_at <= datetime.utcnow(),
+            (RecurringTransfer.claimed_until.is_(None)) | (RecurringTransfer.claimed_until < datetime.utcnow())))
+        check(due == 0, f'fila vazia ao final ({due} vencidas)')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
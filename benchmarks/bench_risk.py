@@ -0,0 +1,258 @@
+"""Velocity limits: in-memory check versus querying recent transactions.
+
+Seeds a day of history, then:
+
+- rebuilds the engine from the last 25 hours and checks every window of a
+  sample of accounts against the same aggregate computed in SQL;
+- times one limit check (reserve + release) against the query the check
+  would otherwise run on every debit (count and sum per window over the
+  account's recent debits);
+- times withdrawals through utils.process_transaction with the engine on and off;
+- measures the engine's memory for `--accounts` active accounts with
+  tracemalloc and extrapolates to a million;
+- checks the rules: the debit over a limit is refused without touching the
+  balance, a debit refused for lack of funds does not count, the background
+  thread builds the windows, debits committed by another process are seen
+  after a sync, ids skipped by an open transaction are read again, a debit is never counted twice when a sync
+  sees it before its own confirmation, and idle slots are reused.
+
+Exits 1 on a failed check.
+
+    python -m benchmarks.bench_risk --accounts 200000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-risk')
+os.environ.setdefault('RISK_SYNC_SECONDS', '0')
+
+from sqlalchemy import case, func, select, update  # noqa: E402
+
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Account, Transaction  # noqa: E402
+import risk  # noqa: E402
+from utils import process_transaction  # noqa: E402
+
+UNLIMITED = {'checking': '', 'savings': ''}
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def window_statement(account_id, now):
+    """A consulta que cada débito faria sem o motor: quantidade e soma por janela"""
+    columns = []
+    for _, length, _ in risk.WINDOWS:
+        recent = Transaction.created_at >= now - timedelta(seconds=length)
+        columns += [func.sum(case((recent, 1), else_=0)), func.sum(case((recent, Transaction.amount), else_=0))]
+    return select(*columns).where(
+        Transaction.account_id == account_id,
+        Transaction.created_at >= now - timedelta(seconds=max(length for _, length, _ in risk.WINDOWS)),
+        Transaction.transaction_type.in_(risk.DEBIT_TYPES))
+
+
+def sql_totals(account_id, now, slice=False):
+    """(quantidade, centavos) por janela de W segundos, ou de W + uma fatia"""
+    result = {}
+    for name, length, width in risk.WINDOWS:
+        count, total = db.session.execute(select(func.count(), func.coalesce(func.sum(Transaction.amount), 0)).where(
+            Transaction.account_id == account_id,
+            Transaction.created_at >= now - timedelta(seconds=length + (width if slice else 0)),
+            Transaction.transaction_type.in_(risk.DEBIT_TYPES))).one()
+        result[name] = (count, risk.to_cents(total))
+    return result
+
+
+def fresh_engine(limits=None, sync_seconds=0):
+    app.config['RISK_LIMITS'] = limits or UNLIMITED
+    app.config['RISK_SYNC_SECONDS'] = sync_seconds
+    app.extensions.pop('risk', None)
+    return risk.get_risk_engine(app)
+
+
+def rebuilt(engine):
+    engine.load(db.session.execute(risk.rebuild_statement(datetime.utcnow())).all(),
+                db.session.scalar(risk.max_id_statement()))
+    return engine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--transactions', type=int, default=20, help='transações por conta nas últimas 24 h')
+    parser.add_argument('--accounts', type=int, default=200000, help='contas ativas na medida de memória')
+    parser.add_argument('--checks', type=int, default=2000)
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(args.users, 2, args.transactions, history_days=1)
+    rng = random.Random(3)
+    account_ids = [account[0] for account in data['accounts']]
+    every_day = {'checking': '24h=1000000', 'savings': '24h=1000000'}
+
+    with app.app_context():
+        engine = fresh_engine(every_day)
+        started = time.perf_counter()
+        rebuilt(engine)
+        print(f'montagem: {len(engine)} contas com débito em {(time.perf_counter() - started) * 1000:.0f} ms '
+              f'({data["transactions"]} transações)')
+        now = datetime.utcnow()
+        at = (now - risk.EPOCH).total_seconds()
+        sample = rng.sample(account_ids, 200)
+        mismatched = []
+        for account_id in sample:
+            totals = engine.totals(account_id, at)
+            low, high = sql_totals(account_id, now), sql_totals(account_id, now, slice=True)
+            # A window covers between W and W + one slice
+            for name in low:
+                if not low[name] <= totals[name] <= high[name]:
+                    mismatched.append((account_id, name, low[name], totals[name], high[name]))
+        check(not mismatched, f'janelas entre o SQL de W e de W + uma fatia em {len(sample)} contas {mismatched[:3]}')
+
+        engine = fresh_engine({'checking': '1m=1000000,1h=1000000,24h=1000000',
+                               'savings': '1m=1000000,1h=1000000,24h=1000000'})
+        rebuilt(engine)
+        elapsed = []
+        for _ in range(args.checks):
+            account_id = rng.choice(account_ids)
+            started = time.perf_counter()
+            refused, reservation = engine.reserve(account_id, Decimal('1.00'))
+            elapsed.append(time.perf_counter() - started)
+            reservation.release()
+        memory_p50, memory_p99 = percentile(elapsed, 0.5) * 1e6, percentile(elapsed, 0.99) * 1e6
+        elapsed = []
+        for _ in range(args.checks // 4):
+            account_id = rng.choice(account_ids)
+            started = time.perf_counter()
+            db.session.execute(window_statement(account_id, datetime.utcnow())).one()
+            elapsed.append(time.perf_counter() - started)
+        sql_p50, sql_p99 = percentile(elapsed, 0.5) * 1e6, percentile(elapsed, 0.99) * 1e6
+        db.session.rollback()
+        print(f'checagem em memória: p50 {memory_p50:.1f} µs, p99 {memory_p99:.1f} µs')
+        print(f'consulta das janelas: p50 {sql_p50:.0f} µs, p99 {sql_p99:.0f} µs')
+        check(memory_p99 < sql_p50, 'checagem em memória abaixo de uma consulta')
+
+        db.session.execute(update(Account).values(balance=Account.balance + 100000))
+        db.session.commit()
+        timings = {}
+        for label, enabled in (('sem limites', False), ('com limites', True)):
+            app.config['RISK_ENABLED'] = enabled
+            fresh_engine({'checking': '1m=1000000', 'savings': '1m=1000000'}, sync_seconds=1)
+            rows = [(account_id, db.session.get(Account, account_id)) for account_id in rng.sample(account_ids, 50)]
+            db.session.rollback()
+            process_transaction(rows[0][1], 'withdrawal', Decimal('0.01'), 'aquecimento')
+            elapsed = []
+            for _ in range(300):
+                account_id, _ = rng.choice(rows)
+                started = time.perf_counter()
+                success, message, _ = process_transaction(
+                    db.session.get(Account, account_id), 'withdrawal', Decimal('0.01'), 'risco')
+                elapsed.append(time.perf_counter() - started)
+                if not success:
+                    raise SystemExit(message)
+            timings[label] = statistics.mean(elapsed) * 1000
+            print(f'saque via process_transaction, {label}: {timings[label]:.2f} ms')
+        app.config['RISK_ENABLED'] = True
+        check(timings['com limites'] < timings['sem limites'] * 1.25,
+              f'limites custam {timings["com limites"] - timings["sem limites"]:+.2f} ms por saque')
+
+    memory = risk.RiskEngine({'checking': '24h=100'}, 0)
+    for account_id in range(1, args.accounts + 1):
+        memory.set_account_type(account_id, 'checking')
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for account_id in range(1, args.accounts + 1):
+        memory.reserve(account_id, Decimal('10'))
+    per_account = (tracemalloc.get_traced_memory()[0] - before) / args.accounts
+    tracemalloc.stop()
+    print(f'memória: {per_account:.0f} bytes por conta ativa, '
+          f'{per_account * 1e6 / 2 ** 30:.2f} GiB por milhão (+{len(memory._types) / args.accounts:.0f} '
+          f'byte de tipo por id)')
+    check(500 < per_account < 800, f'memória por conta dentro do documentado ({per_account:.0f} bytes)')
+
+    with app.app_context():
+        fresh_engine({'checking': '1m=3/100', 'savings': '1m=3/100'})
+        account_id = account_ids[0]
+        account = db.session.get(Account, account_id)
+        balance = account.balance
+        results = [process_transaction(account, 'withdrawal', Decimal('10'), 'limite')[:2] for _ in range(4)]
+        check([r[0] for r in results] == [True, True, True, False] and 'janela de 1m' in results[3][1],
+              f'quarto saque no minuto recusado: {results[3][1]}')
+        after = db.session.get(Account, account_id).balance
+        check(after == balance - 30, f'saque recusado não altera o saldo ({balance} -> {after})')
+
+        fresh_engine({'checking': '1m=3/100', 'savings': '1m=3/100'})
+        other = account_ids[1]
+        db.session.execute(update(Account).where(Account.id == other).values(balance=5))
+        db.session.commit()
+        refused = process_transaction(db.session.get(Account, other), 'withdrawal', Decimal('50'), 'sem saldo')
+        engine = risk.get_risk_engine(app)
+        check(not refused[0] and engine.totals(other)['1m'] == (0, 0),
+              f'saque sem saldo não conta no limite ({engine.totals(other)["1m"]})')
+        engine = fresh_engine({'checking': '1m=30/1000', 'savings': '1m=30/1000'}, sync_seconds=1)
+        risk.start_in_thread(app)
+        check(engine.wait_ready(30) and len(engine) > 0, f'janelas montadas pela thread risk-sync ({len(engine)} contas)')
+        db.session.execute(update(Account).where(Account.id == other).values(balance=1000))
+        db.session.commit()
+        observer = rebuilt(risk.RiskEngine(app.config['RISK_LIMITS'], sync_seconds=1))
+        for _ in range(3):
+            process_transaction(db.session.get(Account, other), 'withdrawal', Decimal('5'), 'outro processo')
+        observer.sync(db.session.execute(observer.sync_statement()).all())
+        db.session.rollback()
+        check(observer.totals(other)['1m'] == engine.totals(other)['1m'] == (3, 1500),
+              f'débitos de outro processo vistos após o sync {observer.totals(other)["1m"]}')
+
+    engine = risk.RiskEngine({'checking': '1m=10'}, sync_seconds=1)
+    engine.load([], 100)
+    created = datetime.utcnow()
+    row = (101, 7, 'withdrawal', Decimal('5'), created, 'checking')
+    engine.sync([(102, 7, 'withdrawal', Decimal('5'), created, 'checking')])
+    statement = str(engine.sync_statement().compile(compile_kwargs={'literal_binds': True}))
+    check('101' in statement, 'id pulado por transação aberta é lido de novo')
+    engine.sync([row])
+    check(engine.totals(7)['1m'] == (2, 1000), f'transação atrasada contada uma vez {engine.totals(7)["1m"]}')
+
+    refused, reservation = engine.reserve(7, Decimal('1'))
+    engine.sync([(103, 7, 'withdrawal', Decimal('1'), created, 'checking')])
+    reservation.confirm(103)
+    check(engine.totals(7)['1m'] == (3, 1100), f'sync antes da confirmação não conta duas vezes {engine.totals(7)["1m"]}')
+    refused, reservation = engine.reserve(7, Decimal('1'))
+    reservation.confirm(104)
+    engine.sync([(104, 7, 'withdrawal', Decimal('1'), created, 'checking')])
+    check(engine.totals(7)['1m'] == (4, 1200), f'confirmação antes do sync não conta duas vezes {engine.totals(7)["1m"]}')
+
+    engine = risk.RiskEngine({'checking': '24h=10'}, sync_seconds=0)
+    engine.set_account_type(1, 'checking')
+    engine.set_account_type(2, 'checking')
+    engine.reserve(1, Decimal('1'), now=time.time() - 2 * 86400)
+    engine._sweep()
+    engine.reserve(2, Decimal('1'))
+    check(len(engine) == 1 and len(engine._marks) == len(risk.WINDOWS) and engine.totals(2)['24h'] == (1, 100),
+          'slot de conta parada é reaproveitado limpo')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Transaction search: latency per filter combination and result checks.
+
+Seeds a history with varied descriptions, then for one user runs each search
+through the test client and reports p50/p95 latency and SQL statements per
+request. Each text search is compared with the plain LIKE fallback (same
+rows expected), and one query is paged to the end to check the cursor
+(no gaps, no repeats, newest first). Exits 1 on a mismatch or when a p95
+exceeds `--target-ms`.
+
+    python -m benchmarks.bench_search --transactions 1000 --explain
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'bench-search')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+
+from sqlalchemy import event, select  # noqa: E402
+
+import search  # noqa: E402
+from benchmarks.seed import TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Account  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def run(client, path, headers, runs):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    samples = []
+    for _ in range(runs):
+        statements.clear()
+        event.listen(engine, 'before_cursor_execute', record)
+        started = time.perf_counter()
+        response = client.get(path, headers=headers)
+        samples.append((time.perf_counter() - started) * 1000)
+        event.remove(engine, 'before_cursor_execute', record)
+        if response.status_code != 200:
+            raise SystemExit(f'{path} respondeu {response.status_code}: {response.get_data(as_text=True)}')
+    quantiles = statistics.quantiles(samples, n=20) if len(samples) > 1 else samples * 19
+    return response, statistics.median(samples), quantiles[18], len(statements)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--accounts-per-user', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=500, help='transações por conta no seed')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--target-ms', type=float, default=50, help='p95 máximo por busca')
+    parser.add_argument('--explain', action='store_true', help='mostra o plano de cada consulta')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    started = time.perf_counter()
+    data = seed(args.users, args.accounts_per_user, args.transactions)
+    print(f'seed: {len(data["accounts"])} contas, {data["transactions"]} transações '
+          f'em {time.perf_counter() - started:.1f}s')
+
+    user_id = data['users'][0][0]
+    with app.app_context():
+        headers = {'Authorization': f'Bearer {create_access_token(identity=str(user_id))}'}
+        dialect = db.engine.dialect.name
+        account_ids = list(db.session.scalars(select(Account.id).where(Account.user_id == user_id)))
+    other_number = next(number for _, number, owner in data['accounts'] if owner != user_id)
+    week_ago = (datetime.utcnow() - timedelta(days=7)).date().isoformat()
+    searches = {
+        'texto': 'q=aluguel',
+        'texto 2 palavras': 'q=pagamento+farmácia',
+        'prefixo': 'q=mensal',
+        'texto + tipo': 'q=compra&type=withdrawal',
+        'texto + valor': 'q=internet&min_amount=100&max_amount=300',
+        'texto + período': f'q=salário&from={week_ago}',
+        'contraparte': f'counterparty={other_number}',
+        'só filtros': 'type=transfer&min_amount=400',
+        'uma conta': f'account_id={account_ids[0]}&q=hotel',
+    }
+
+    client = app.test_client()
+    print(f'\n{"busca":<18} {"linhas":>6} {"p50 ms":>8} {"p95 ms":>8} {"sql":>4}')
+    for name, params in searches.items():
+        response, p50, p95, statements = run(client, f'/transactions/search?{params}', headers, args.runs)
+        print(f'{name:<18} {len(response.json):>6} {p50:>8.2f} {p95:>8.2f} {statements:>4}')
+        check(p95 <= args.target_ms, f'{name}: p95 {p95:.2f} ms (alvo {args.target_ms:.0f} ms)')
+
+    if dialect == 'sqlite':
+        # Same searches through LIKE; accents and prefixes are FTS-only
+        comparable = ('texto', 'texto + tipo', 'texto + valor', 'uma conta')
+        with_fts = {name: client.get(f'/transactions/search?{searches[name]}&limit=500', headers=headers).json
+                    for name in comparable}
+        with app.app_context():
+            key = db.engine.url.render_as_string()
+        search._fts_ready[key] = False
+        for name in comparable:
+            plain = client.get(f'/transactions/search?{searches[name]}&limit=500', headers=headers).json
+            check([t['id'] for t in plain] == [t['id'] for t in with_fts[name]],
+                  f'{name}: FTS e LIKE devolvem as mesmas {len(plain)} linhas')
+        search._fts_ready.pop(key)
+
+    seen, pages, cursor = [], 0, None
+    while True:
+        path = '/transactions/search?q=compra&limit=25' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(path, headers=headers)
+        seen += [(t['created_at'], t['id']) for t in response.json]
+        pages += 1
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    everything = client.get('/transactions/search?q=compra&limit=500', headers=headers).json
+    check(seen == sorted(seen, reverse=True) and len(set(seen)) == len(seen) and len(seen) == len(everything),
+          f'paginação: {len(seen)} linhas em {pages} páginas, sem repetição nem buraco')
+
+    if args.explain:
+        from search import search_statement
+        with app.app_context():
+            for name, params in searches.items():
+                if 'counterparty' in params or 'account_id' in params:
+                    continue
+                query = dict(pair.split('=') for pair in params.split('&'))
+                stmt, _ = search_statement(account_ids, 50, query=query.get('q', '').replace('+', ' '),
+                                           transaction_type=query.get('type'))
+                compiled = stmt.compile(db.engine, compile_kwargs={'literal_binds': True})
+                prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+                print(f'\n{name}:')
+                for row in db.session.connection().exec_driver_sql(prefix + str(compiled)):
+                    print('   ', row[-1])
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
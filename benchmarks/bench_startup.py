@@ -0,0 +1,101 @@
+"""Startup cost: importing the application, building it and serving a first request.
+
+Every measurement runs in a fresh interpreter, like a new worker or test
+process, and the median of `--runs` is reported per phase:
+
+- import: `import app` (modules, extensions; nothing is built);
+- create_app: blueprints, REST resources, metrics hooks;
+- first request: GET / through the test client, then the first API request
+  that touches the database.
+
+    python -m benchmarks.bench_startup --runs 10 --json startup.json
+
+`--importtime` also prints the slowest modules from `python -X importtime`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = r'''
+import json, os, time
+started = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+application = module.create_app()
+created = time.perf_counter()
+client = application.test_client()
+client.get('/')
+first_page = time.perf_counter()
+client.post('/auth/login', json={'username': 'nobody', 'password': 'nobody'})
+first_query = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_page_ms': (first_page - created) * 1000,
+    'first_query_ms': (first_query - first_page) * 1000,
+    'total_ms': (first_query - started) * 1000,
+}))
+'''
+
+
+def _environment():
+    env = dict(os.environ)
+    if not env.get('DATABASE_URL'):
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')
+    env.setdefault('SESSION_SECRET', 'bench-startup')
+    env.setdefault('HASH_WORKERS', '0')
+    env['LOG_LEVEL'] = 'WARNING'
+    return env
+
+
+def measure(runs, env):
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'main', 'init-db'], env=env,
+                   check=True, capture_output=True)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def import_profile(env, top):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app; app.create_app()'],
+                            env=env, check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # "import time:  self [us] | cumulative | imported package"
+        own, cumulative, name = line.split(':', 1)[1].split('|')
+        rows.append((int(cumulative), int(own), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', type=int, nargs='?', const=15, default=0,
+                        help='mostra os N módulos mais lentos de importar')
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    args = parser.parse_args(argv)
+
+    env = _environment()
+    result = measure(args.runs, env)
+    for key, value in result.items():
+        print(f'{key[:-3]:<14} {value:>8.1f} ms')
+    if args.importtime:
+        print(f'\n{"acumulado ms":>12} {"próprio ms":>10}  módulo')
+        for cumulative, own, name in import_profile(env, args.importtime):
+            print(f'{cumulative / 1000:>12.1f} {own / 1000:>10.1f}  {name}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(result, runs=args.runs), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Counts the SQL statements each HTML page issues and fails on regressions.
+
+Seeds a user with several accounts and a history that touches every
+relationship the templates render, then requests each page twice and counts
+the statements of the second (warm) request. The budgets do not depend on the
+number of accounts or transactions, so an N+1 shows up as an overrun.
+
+    python -m benchmarks.check_query_counts            # exit status 1 on overrun
+    python -m benchmarks.check_query_counts --verbose  # also prints the SQL
+
+With DATABASE_URL set, its tables are dropped and recreated: pass --reset.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from decimal import Decimal
+
+TEMPORARY_DATABASE = not os.environ.get('DATABASE_URL')
+if TEMPORARY_DATABASE:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'queries.db')
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ.setdefault('SESSION_SECRET', 'check-query-counts')
+# The seed runs many transfers per account in a few seconds
+os.environ.setdefault('RISK_ENABLED', '0')
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import User, Account  # noqa: E402
+from utils import process_transaction  # noqa: E402
+
+# Statements allowed per warm request. The logged-in user comes from the
+# cache, so these are the page's own queries.
+BUDGETS = {
+    'dashboard': 1,
+    'accounts': 1,
+    'transactions': 2,
+}
+
+
+def seed(num_accounts, num_transactions):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='queries', email='queries@example.com', password_hash='-')
+        db.session.add(user)
+        db.session.flush()
+        accounts = [
+            Account(account_number=f'Q{i:07d}', user_id=user.id,
+                    balance=Decimal('0'), account_type='checking')
+            for i in range(num_accounts)
+        ]
+        db.session.add_all(accounts)
+        db.session.commit()
+        ids = [(a.id, a.account_number) for a in accounts]
+        for i in range(num_transactions):
+            account_id, _ = ids[i % len(ids)]
+            _, to_number = ids[(i + 1) % len(ids)]
+            account = db.session.get(Account, account_id)
+            process_transaction(account, 'deposit', Decimal('10'), 'seed')
+            process_transaction(account, 'transfer', Decimal('1'), 'seed', to_number)
+        return user.id, ids[0][0]
+
+
+def count_statements(client, path):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    if response.status_code != 200:
+        raise SystemExit(f'{path} respondeu {response.status_code}')
+    return statements
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--transactions', type=int, default=40)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    user_id, account_id = seed(args.accounts, args.transactions)
+    pages = {
+        'dashboard': '/dashboard',
+        'accounts': '/accounts',
+        'transactions': f'/transactions/{account_id}',
+    }
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+
+    failed = False
+    for name, path in pages.items():
+        client.get(path)
+        statements = count_statements(client, path)
+        budget = BUDGETS[name]
+        status = 'ok' if len(statements) <= budget else 'ACIMA DO LIMITE'
+        failed |= len(statements) > budget
+        print(f'{name:<14} {len(statements):>3} consultas (limite {budget})  {status}')
+        if args.verbose or len(statements) > budget:
+            for statement in statements:
+                print('    ' + ' '.join(statement.split())[:160])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
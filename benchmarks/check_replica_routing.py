@@ -0,0 +1,150 @@
+"""Checks read-replica routing end to end and exits 1 on any failure.
+
+Without DATABASE_URL/REPLICA_DATABASE_URL it builds a primary SQLite file,
+seeds it and copies it to a second file that acts as the replica, so the
+two diverge as soon as the primary takes a write. Against real servers, set
+both URLs to a primary and a streaming replica (then `--reset` is required).
+
+Checked: read-only routes run their SELECTs on the replica; a user's reads
+right after their own write go to the primary and see it; other users keep
+reading from the replica; an unreachable replica falls back to the primary.
+
+    python -m benchmarks.check_replica_routing
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+
+_directory = tempfile.mkdtemp()
+PRIMARY_FILE = os.path.join(_directory, 'primary.db')
+REPLICA_FILE = os.path.join(_directory, 'replica.db')
+LOCAL = not os.environ.get('DATABASE_URL')
+if LOCAL:
+    os.environ['DATABASE_URL'] = f'sqlite:///{PRIMARY_FILE}'
+    os.environ['REPLICA_DATABASE_URL'] = f'sqlite:///{REPLICA_FILE}'
+os.environ.setdefault('SESSION_SECRET', 'check-replica-routing')
+os.environ.setdefault('REPLICA_STICKY_SECONDS', '60')
+os.environ.setdefault('HASH_WORKERS', '0')
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+from benchmarks.seed import seed  # noqa: E402
+from benchmarks.suite import register_aliases  # noqa: E402
+from app import app, create_app  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FALHA"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+class StatementLog:
+    """Conta as instruções por banco (primário ou réplica) durante um bloco"""
+
+    def __init__(self, application):
+        self.urls = {
+            str(application.config['SQLALCHEMY_DATABASE_URI']): 'primary',
+            str(application.config.get('REPLICA_DATABASE_URL')): 'replica',
+        }
+        self.counts = Counter()
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.counts[self.urls.get(conn.engine.url.render_as_string(hide_password=False), 'other')] += 1
+
+    def __enter__(self):
+        self.counts.clear()
+        event.listen(Engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, 'before_cursor_execute', self._record)
+
+
+def client_for(application, user_id):
+    client = application.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    with application.app_context():
+        token = create_access_token(identity=str(user_id))
+    return client, {'Authorization': f'Bearer {token}'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (LOCAL or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    data = seed(20, 2, 10)
+    if LOCAL:
+        shutil.copyfile(PRIMARY_FILE, REPLICA_FILE)
+    register_aliases(app)
+    (alice, _), (bob, _) = data['users'][:2]
+    alice_account = next(a[0] for a in data['accounts'] if a[2] == alice)
+    log = StatementLog(app)
+
+    alice_client, alice_auth = client_for(app, alice)
+    bob_client, bob_auth = client_for(app, bob)
+    pages = {
+        'AccountList.get': lambda client, auth: client.get('/bench/accounts', headers=auth),
+        'TransactionResource.get': lambda client, auth: client.get(
+            f'/bench/transactions/{alice_account}', headers=auth),
+        'exportação': lambda client, auth: client.get(
+            f'/transactions/{alice_account}/export?format=ndjson', headers=auth),
+        'dashboard': lambda client, auth: client.get('/dashboard'),
+    }
+    for name, request in pages.items():
+        # Warm-up: flask-login loads the session user before the view runs
+        # (so on the primary); afterwards it comes from the cache
+        request(alice_client, alice_auth).get_data()
+        with log:
+            response = request(alice_client, alice_auth)
+            response.get_data()
+        check(response.status_code == 200 and log.counts['replica'] > 0 and log.counts['primary'] == 0,
+              f'{name}: {dict(log.counts)} (status {response.status_code})')
+
+    before = float(next(a['balance'] for a in alice_client.get('/bench/accounts', headers=alice_auth).json
+                        if a['id'] == alice_account))
+    with log:
+        response = alice_client.post(f'/bench/transactions/{alice_account}', headers=alice_auth,
+                                     json={'transaction_type': 'deposit', 'amount': 10, 'description': 'rw'})
+    check(response.status_code == 200 and log.counts['replica'] == 0, f'depósito no primário: {dict(log.counts)}')
+
+    with log:
+        accounts = alice_client.get('/bench/accounts', headers=alice_auth).json
+    after = float(next(a['balance'] for a in accounts if a['id'] == alice_account))
+    check(log.counts['replica'] == 0 and after == before + 10,
+          f'leitura após a própria escrita no primário: {dict(log.counts)}, saldo {before} -> {after}')
+
+    with log:
+        response = bob_client.get('/bench/accounts', headers=bob_auth)
+    check(log.counts['replica'] > 0 and log.counts['primary'] == 0,
+          f'outro usuário continua na réplica: {dict(log.counts)}')
+
+    unreachable = create_app({
+        'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+        'REPLICA_DATABASE_URL': f'sqlite:///{os.path.join(_directory, "missing", "replica.db")}',
+    })
+    register_aliases(unreachable)
+    down_log = StatementLog(unreachable)
+    client, auth = client_for(unreachable, bob)
+    with down_log:
+        response = client.get('/bench/accounts', headers=auth)
+    check(response.status_code == 200 and down_log.counts['primary'] > 0,
+          f'réplica fora do ar: {dict(down_log.counts)} (status {response.status_code})')
+
+    print(f'\n{len(failures)} falha(s)')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Compares two benchmarks.suite result files, e.g. before and after a commit.
+
+Matches runs by scenario and concurrency and prints the change in throughput
+and p95. A run regresses when throughput drops or p95 grows by more than
+`--threshold` percent; with `--fail` the exit status is 1 if any run did.
+
+    python -m benchmarks.compare results/base.json results/new.json --threshold 10 --fail
+"""
+import argparse
+import json
+import sys
+
+
+def _load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data.get('meta', {}), {(r['scenario'], r['concurrency']): r for r in data['results']}
+
+
+def _change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(base, new, threshold):
+    rows, regressions = [], 0
+    for key in sorted(base.keys() & new.keys()):
+        before, after = base[key], new[key]
+        throughput = _change(before['throughput'], after['throughput'])
+        p95 = _change(before['p95_ms'], after['p95_ms'])
+        regressed = throughput < -threshold or p95 > threshold
+        regressions += regressed
+        rows.append((key, before, after, throughput, p95, regressed))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='variação tolerada, em %%')
+    parser.add_argument('--fail', action='store_true', help='sai com status 1 se houver regressão')
+    args = parser.parse_args(argv)
+
+    base_meta, base = _load(args.base)
+    new_meta, new = _load(args.new)
+    print(f'base: {base_meta.get("commit")} ({base_meta.get("database")})  '
+          f'novo: {new_meta.get("commit")} ({new_meta.get("database")})')
+    if base_meta.get('database') != new_meta.get('database'):
+        print('aviso: os arquivos foram gerados em bancos diferentes')
+
+    rows, regressions = compare(base, new, args.threshold)
+    print(f'{"cenário":<11} {"conc":>5} {"req/s":>17} {"Δ%":>7} {"p95 ms":>15} {"Δ%":>7}')
+    for (scenario, concurrency), before, after, throughput, p95, regressed in rows:
+        print(f'{scenario:<11} {concurrency:>5} {before["throughput"]:>8.1f} {after["throughput"]:>8.1f} '
+              f'{throughput:>+7.1f} {before["p95_ms"]:>7.1f} {after["p95_ms"]:>7.1f} {p95:>+7.1f}'
+              f'{"  REGRESSÃO" if regressed else ""}')
+    for key in sorted(base.keys() ^ new.keys()):
+        print(f'{key[0]:<11} {key[1]:>5}  presente em apenas um dos arquivos')
+    sys.exit(1 if args.fail and regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""HTTP load test for comparing the sync (gunicorn) and async (uvicorn) API modes.
+
+Opens `--connections` keep-alive connections to each server and has every one
+issue requests back to back for `--duration` seconds. Each request is either
+GET /accounts (read) or a 0.01 deposit (write), split by `--write-ratio`. Only
+the standard library is used, so the client itself is not the bottleneck at
+1k connections.
+
+Start the two modes on different ports against the same database:
+
+    gunicorn --workers 4 --bind :5000 main:app
+    SERVER_MODE=async uvicorn main:app --workers 4 --port 5001
+
+and then:
+
+    python -m benchmarks.load_api --url http://127.0.0.1:5000 --url http://127.0.0.1:5001 \
+        --username bench --password bench123 --connections 1000
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def _request(reader, writer, method, path, host, token=None, body=None):
+    payload = json.dumps(body).encode() if body is not None else b''
+    headers = [f'{method} {path} HTTP/1.1', f'Host: {host}', 'Connection: keep-alive',
+               f'Content-Length: {len(payload)}']
+    if body is not None:
+        headers.append('Content-Type: application/json')
+    if token:
+        headers.append(f'Authorization: Bearer {token}')
+    writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + payload)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('conexão encerrada pelo servidor')
+    status = int(status_line.split()[1])
+    length, chunked = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+        elif name.lower() == 'transfer-encoding' and 'chunked' in value.lower():
+            chunked = True
+    if chunked:
+        data = b''
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            data += chunk[:-2]
+    else:
+        data = await reader.readexactly(length)
+    return status, data
+
+
+async def _login(base, username, password):
+    parts = urlsplit(base)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        status, data = await _request(reader, writer, 'POST', '/auth/login', parts.netloc,
+                                      body={'username': username, 'password': password})
+        if status != 200:
+            raise SystemExit(f'login falhou em {base}: {status} {data[:200]!r}')
+        token = json.loads(data)['access_token']
+        status, data = await _request(reader, writer, 'GET', '/accounts', parts.netloc, token=token)
+        accounts = json.loads(data)
+        if not accounts:
+            raise SystemExit('o usuário do benchmark precisa de ao menos uma conta')
+        return token, accounts[0]['id']
+    finally:
+        writer.close()
+
+
+async def run(base, token, account_id, connections, duration, write_ratio):
+    parts = urlsplit(base)
+    latencies, errors = [], [0]
+    deadline = time.perf_counter() + duration
+    write_every = round(1 / write_ratio) if write_ratio else 0
+
+    async def client(index):
+        try:
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        except OSError:
+            errors[0] += 1
+            return
+        sent = index
+        try:
+            while time.perf_counter() < deadline:
+                sent += 1
+                started = time.perf_counter()
+                if write_every and sent % write_every == 0:
+                    status, _ = await _request(
+                        reader, writer, 'POST', f'/transactions/{account_id}', parts.netloc, token,
+                        {'transaction_type': 'deposit', 'amount': 0.01, 'description': 'load test'}
+                    )
+                else:
+                    status, _ = await _request(reader, writer, 'GET', '/accounts', parts.netloc, token)
+                if status >= 400:
+                    errors[0] += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            errors[0] += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client(i) for i in range(connections)))
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        'url': base,
+        'connections': connections,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / duration,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+    }
+
+
+async def main_async(args):
+    results = []
+    for base in args.url:
+        token, account_id = await _login(base, args.username, args.password)
+        results.append(await run(base, token, account_id, args.connections, args.duration, args.write_ratio))
+
+    print(f'{"url":<28} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"erros":>6}')
+    for r in results:
+        print(f'{r["url"]:<28} {r["throughput"]:>9.1f} {r["p50_ms"]:>8.1f} {r["p95_ms"]:>8.1f} '
+              f'{r["p99_ms"]:>8.1f} {r["errors"]:>6}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', action='append', required=True, help='pode ser repetido')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--write-ratio', type=float, default=0.1, help='fração de depósitos')
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    asyncio.run(main_async(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
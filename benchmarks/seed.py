@@ -0,0 +1,178 @@
+"""Bulk data generator for the benchmarks.
+
+Builds users, accounts and a chronological history of deposits, withdrawals
+and transfers in memory, then writes everything with executemany INSERTs
+using ids assigned up front (Postgres sequences are moved past them at the end). The data is consistent with what
+the application would have produced: account balances, ledger legs and daily
+balance snapshots all agree, so `flask ledger verify` passes on a seeded
+database.
+
+    python -m benchmarks.seed --users 1000 --accounts-per-user 2 --transactions 50 --reset
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+TEMPORARY_DATABASE = not os.environ.get('DATABASE_URL')
+if TEMPORARY_DATABASE:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from sqlalchemy import func, insert, select, text, update  # noqa: E402
+
+from app import app, db  # noqa: E402
+from account_numbers import SEQUENCE_ID, format_account_number  # noqa: E402
+from ledger import ledger_legs  # noqa: E402
+from models import (Account, AccountDailyBalance, AccountNumberSequence, LedgerEntry,  # noqa: E402
+                    Transaction, User)
+from utils import hash_password  # noqa: E402
+
+CHUNK = 5000
+PASSWORD = 'bench-password'
+HISTORY_DAYS = 90
+# Description vocabulary, so text search has something to tell apart
+MERCHANTS = ('mercado', 'farmácia', 'posto', 'padaria', 'restaurante', 'livraria', 'academia',
+             'cinema', 'hotel', 'companhia aérea', 'loja online', 'oficina', 'escola', 'clínica')
+PURPOSES = ('compra', 'pagamento', 'reembolso', 'assinatura', 'aluguel', 'salário', 'presente',
+            'mensalidade', 'conta de luz', 'conta de água', 'internet', 'seguro')
+
+
+def _insert(model, rows):
+    # Core executemany: the ORM bulk path would split batches on None values
+    for start in range(0, len(rows), CHUNK):
+        db.session.execute(insert(model.__table__), rows[start:start + CHUNK])
+
+
+def _assign_ids(model, rows):
+    """Atribui ids explícitos: evita RETURNING, que o SQLite só ordena linha a linha"""
+    first = (db.session.scalar(select(func.max(model.id))) or 0) + 1
+    for offset, row in enumerate(rows):
+        row['id'] = first + offset
+    return [row['id'] for row in rows]
+
+
+def _sync_sequence(model):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        table = model.__tablename__
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"
+        ))
+
+
+def seed(users: int, accounts_per_user: int, transactions_per_account: int,
+         password: str = PASSWORD, rng_seed: int = 42, reset: bool = True,
+         history_days: int = HISTORY_DAYS) -> dict:
+    """Popula o banco e devolve {'users': [(id, username)], 'accounts': [(id, número, user_id)]}"""
+    rng = random.Random(rng_seed)
+    with app.app_context():
+        if reset:
+            db.drop_all()
+            db.create_all()
+        password_hash = hash_password(password)
+        created = datetime.utcnow() - timedelta(days=history_days + 1)
+        user_rows = [
+            {'username': f'bench{i}', 'email': f'bench{i}@example.com',
+             'password_hash': password_hash, 'created_at': created}
+            for i in range(users)
+        ]
+        user_ids = _assign_ids(User, user_rows)
+        _insert(User, user_rows)
+
+        account_rows = [
+            {'account_number': format_account_number(serial), 'user_id': user_id,
+             'balance': Decimal('0'), 'account_type': rng.choice(('checking', 'savings')),
+             'created_at': created}
+            for serial, user_id in enumerate(
+                (user_id for user_id in user_ids for _ in range(accounts_per_user)), start=1)
+        ]
+        account_ids = _assign_ids(Account, account_rows)
+        _insert(Account, account_rows)
+        db.session.execute(insert(AccountNumberSequence).values(
+            id=SEQUENCE_ID, next_value=len(account_ids) + 1
+        ))
+
+        # Chronological history over the last `history_days` days
+        total = len(account_ids) * transactions_per_account
+        step = timedelta(days=history_days) / max(total, 1)
+        now = datetime.utcnow() - timedelta(days=history_days)
+        balances = defaultdict(Decimal)
+        snapshots = {}
+        transactions, legs = [], []
+        # Separate stream: amounts and kinds stay the same as without descriptions
+        words = random.Random(rng_seed + 1)
+        for _ in range(total):
+            now += step
+            account_id = rng.choice(account_ids)
+            amount = Decimal(rng.randint(100, 50000)) / 100
+            kind = rng.choice(('deposit', 'deposit', 'withdrawal', 'transfer'))
+            if kind != 'deposit' and balances[account_id] < amount:
+                kind = 'deposit'
+            to_account_id = rng.choice(account_ids) if kind == 'transfer' else None
+            if to_account_id == account_id:
+                kind, to_account_id = 'deposit', None
+
+            balances[account_id] += amount if kind == 'deposit' else -amount
+            snapshots[account_id, now.date()] = balances[account_id]
+            if to_account_id is not None:
+                balances[to_account_id] += amount
+                snapshots[to_account_id, now.date()] = balances[to_account_id]
+            transactions.append({
+                'account_id': account_id, 'transaction_type': kind, 'amount': amount,
+                'description': f'{words.choice(PURPOSES)} {words.choice(MERCHANTS)} {words.randint(1, 9999)}',
+                'to_account_id': to_account_id, 'created_at': now
+            })
+            legs.append(ledger_legs(kind, account_id, amount, to_account_id))
+
+        transaction_ids = _assign_ids(Transaction, transactions)
+        _insert(Transaction, transactions)
+        _insert(LedgerEntry, [
+            dict(leg, transaction_id=transaction_id, created_at=row['created_at'])
+            for transaction_id, row, pair in zip(transaction_ids, transactions, legs)
+            for leg in pair
+        ])
+        _insert(AccountDailyBalance, [
+            {'account_id': account_id, 'day': day, 'balance': balance}
+            for (account_id, day), balance in snapshots.items()
+        ])
+        for start in range(0, len(account_ids), CHUNK):
+            # ORM bulk UPDATE by primary key: one executemany per chunk
+            db.session.execute(update(Account), [
+                {'id': account_id, 'balance': balances[account_id]}
+                for account_id in account_ids[start:start + CHUNK]
+            ])
+        for model in (User, Account, Transaction):
+            _sync_sequence(model)
+        db.session.commit()
+
+        return {
+            'users': [(user_id, f'bench{i}') for i, user_id in enumerate(user_ids)],
+            'accounts': [(account_id, row['account_number'], row['user_id'])
+                         for account_id, row in zip(account_ids, account_rows)],
+            'transactions': total,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--accounts-per-user', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=50, help='transações por conta')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true',
+                        help='apaga e recria as tabelas (obrigatório com DATABASE_URL próprio)')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    started = time.perf_counter()
+    data = seed(args.users, args.accounts_per_user, args.transactions, rng_seed=args.seed)
+    print(f'{len(data["users"])} usuários, {len(data["accounts"])} contas e {data["transactions"]} '
+          f'transações em {time.perf_counter() - started:.1f}s ({os.environ["DATABASE_URL"]})')
+
+
+if __name__ == '__main__':
+    main()
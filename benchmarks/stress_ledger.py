@@ -0,0 +1,173 @@
+"""Stress test for the transfer engine in utils.process_transaction.
+
+Runs many threads doing random deposits, withdrawals and transfers over a small
+set of accounts and checks that no update was lost. By default it uses a
+temporary SQLite file; point DATABASE_URL at a local Postgres to exercise the
+row locks (its tables are dropped and recreated, so --reset is required).
+
+A database error (e.g. "database is locked" under SQLite) fails only that
+operation, which is retried up to --retries times and then counted apart;
+nothing it did is expected in the balances. Any other exception in a thread
+aborts the run instead of showing up as a lost update.
+
+    python -m benchmarks.stress_ledger --threads 32 --operations 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy.exc import SQLAlchemyError
+
+TEMPORARY_DATABASE = not os.environ.get('DATABASE_URL')
+if TEMPORARY_DATABASE:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stress.db')
+# The point is contention on a few accounts, far above any velocity limit
+os.environ.setdefault('RISK_ENABLED', '0')
+
+from app import app, db  # noqa: E402
+from models import User, Account, Transaction  # noqa: E402
+from utils import process_transaction  # noqa: E402
+
+INITIAL_BALANCE = Decimal('100.00')
+
+
+def seed(num_accounts):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='stress', email='stress@example.com', password_hash='-')
+        db.session.add(user)
+        db.session.flush()
+        accounts = [
+            Account(account_number=f'S{i:07d}', user_id=user.id,
+                    balance=INITIAL_BALANCE, account_type='checking')
+            for i in range(num_accounts)
+        ]
+        db.session.add_all(accounts)
+        db.session.commit()
+        return [(a.id, a.account_number) for a in accounts]
+
+
+def apply(accounts, rng, retries, counters):
+    """Sorteia e aplica uma operação; devolve (tipo, conta, destino, valor, aplicada ou None se o banco falhou)"""
+    account_id, _ = rng.choice(accounts)
+    to_id, to_number = rng.choice(accounts)
+    kind = rng.choice(('deposit', 'withdrawal', 'transfer', 'transfer'))
+    amount = Decimal(rng.randint(1, 4000)) / 100
+    for attempt in range(retries + 1):
+        try:
+            account = db.session.get(Account, account_id)
+            success, _, _ = process_transaction(
+                account, kind, amount, 'stress',
+                to_number if kind == 'transfer' else None
+            )
+            return kind, account_id, to_id, amount, success
+        except SQLAlchemyError:
+            # process_transaction already rolled back; nothing of this attempt was applied
+            db.session.rollback()
+            if attempt < retries:
+                counters['retried'] += 1
+                time.sleep(0.005 * 2 ** attempt)
+        finally:
+            db.session.remove()
+    return kind, account_id, to_id, amount, None
+
+
+def worker(accounts, operations, seed_value, retries, deltas, lock, counters):
+    rng = random.Random(seed_value)
+    local = defaultdict(Decimal)
+    mine = defaultdict(int)
+    with app.app_context():
+        for _ in range(operations):
+            kind, account_id, to_id, amount, success = apply(accounts, rng, retries, mine)
+            if success is None:
+                mine['errors'] += 1
+                continue
+            if not success:
+                mine['failed'] += 1
+                continue
+            mine['ok'] += 1
+            if kind == 'deposit':
+                local[account_id] += amount
+            elif kind == 'withdrawal':
+                local[account_id] -= amount
+            else:
+                local[account_id] -= amount
+                local[to_id] += amount
+    with lock:
+        for account_id, delta in local.items():
+            deltas[account_id] += delta
+        for name, value in mine.items():
+            counters[name] += value
+
+
+def run_threads(target, args_for, count):
+    """Roda `count` threads e relança a primeira exceção de qualquer uma delas"""
+    raised = []
+
+    def guarded(*args):
+        try:
+            target(*args)
+        except BaseException as e:
+            raised.append(e)
+
+    threads = [threading.Thread(target=guarded, args=args_for(i)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if raised:
+        # A dead thread never reported its deltas: checking balances now would cry lost update
+        raise RuntimeError(f'{len(raised)} de {count} threads falharam') from raised[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--operations', type=int, default=100, help='operações por thread')
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--retries', type=int, default=3, help='novas tentativas após erro do banco')
+    parser.add_argument('--reset', action='store_true', help='obrigatório com DATABASE_URL próprio')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    accounts = seed(args.accounts)
+    deltas = defaultdict(Decimal)
+    counters = {'ok': 0, 'failed': 0, 'errors': 0, 'retried': 0}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    run_threads(worker, lambda i: (accounts, args.operations, i, args.retries, deltas, lock, counters),
+                args.threads)
+    elapsed = time.perf_counter() - started
+
+    errors = []
+    with app.app_context():
+        for account_id, _ in accounts:
+            balance = db.session.get(Account, account_id).balance
+            expected = INITIAL_BALANCE + deltas[account_id]
+            if balance != expected:
+                errors.append(f'conta {account_id}: saldo {balance}, esperado {expected}')
+            if balance < 0:
+                errors.append(f'conta {account_id}: saldo negativo {balance}')
+        recorded = db.session.query(Transaction).count()
+        if recorded != counters['ok']:
+            errors.append(f'{recorded} transações gravadas, {counters["ok"]} confirmadas')
+
+    total = counters['ok'] + counters['failed'] + counters['errors']
+    print(f'{total} operações em {elapsed:.2f}s ({total / elapsed:.0f} ops/s), '
+          f'{counters["ok"]} aplicadas, {counters["failed"]} recusadas, '
+          f'{counters["errors"]} com erro do banco ({counters["retried"]} novas tentativas)')
+    for error in errors:
+        print('ERRO:', error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
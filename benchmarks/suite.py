@@ -0,0 +1,219 @@
+"""Benchmark suite for the banking hot paths, runnable offline.
+
+Seeds the database with benchmarks.seed, then drives each scenario through
+the Flask test client from `--concurrency` threads (a sweep when several
+values are given) and reports throughput, p50/p95/p99 latency, errors and SQL
+statements per request (from the Server-Timing header). No server and no
+network are involved, so the numbers isolate the application and database.
+
+Scenarios: login (verify_password), accounts (AccountList.get), deposit,
+withdrawal and transfer (TransactionResource.post), history
+(TransactionResource.get) and dashboard (HTML page).
+
+    python -m benchmarks.suite --json results/$(git rev-parse --short HEAD).json
+    DATABASE_URL=postgresql://localhost/bench python -m benchmarks.suite --reset
+
+Compare two result files with `python -m benchmarks.compare`.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+os.environ.setdefault('SESSION_SECRET', 'benchmark-suite')
+# Measure the application itself: a few identities hammer the same routes
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('ADMISSION_POOL_WAIT_MS', '0')
+os.environ.setdefault('RISK_ENABLED', '0')
+
+from benchmarks.seed import PASSWORD, TEMPORARY_DATABASE, seed  # noqa: E402
+from app import app, db  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+SCENARIOS = ('login', 'accounts', 'deposit', 'withdrawal', 'transfer', 'history', 'dashboard')
+
+# The HTML blueprint owns GET/POST /accounts and /transactions/<id>, which
+# shadows the REST resources on the same paths; expose them under /bench.
+API_ALIASES = {
+    '/bench/accounts': 'accounts_account_list',
+    '/bench/transactions/<int:account_id>': 'transactions_transaction_resource',
+}
+
+
+def register_aliases(app):
+    for rule, endpoint in API_ALIASES.items():
+        app.add_url_rule(rule, endpoint=f'bench_{endpoint}', view_func=app.view_functions[endpoint],
+                         methods=['GET', 'POST'])
+
+
+class Client:
+    """Um cliente por thread, com token JWT e sessão do usuário escolhido"""
+
+    def __init__(self, user, accounts, all_accounts, token, rng):
+        self.user_id, self.username = user
+        self.accounts = accounts
+        self.all_accounts = all_accounts
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.rng = rng
+        self.http = app.test_client()
+        with self.http.session_transaction() as session:
+            session['_user_id'] = str(self.user_id)
+
+    def amount(self):
+        return float(Decimal(self.rng.randint(1, 100)) / 100)
+
+    def login(self):
+        return self.http.post('/auth/login', json={'username': self.username, 'password': PASSWORD})
+
+    def accounts_list(self):
+        return self.http.get('/bench/accounts', headers=self.headers)
+
+    def post(self, kind, **extra):
+        return self.http.post(
+            f'/bench/transactions/{self.rng.choice(self.accounts)[0]}', headers=self.headers,
+            json=dict(transaction_type=kind, amount=self.amount(), description='benchmark', **extra)
+        )
+
+    def history(self):
+        return self.http.get(f'/bench/transactions/{self.rng.choice(self.accounts)[0]}', headers=self.headers)
+
+    def dashboard(self):
+        return self.http.get('/dashboard')
+
+    def run(self, scenario):
+        if scenario == 'login':
+            return self.login()
+        if scenario == 'accounts':
+            return self.accounts_list()
+        if scenario in ('deposit', 'withdrawal'):
+            return self.post(scenario)
+        if scenario == 'transfer':
+            return self.post('transfer', to_account_id=self.rng.choice(self.all_accounts)[1])
+        if scenario == 'history':
+            return self.history()
+        return self.dashboard()
+
+
+def run_scenario(scenario, clients, duration):
+    latencies, statements, errors = [], [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(client):
+        local, sql, failed = [], [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = client.run(scenario)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                failed += 1
+                continue
+            local.append(elapsed)
+            timing = response.headers.get('Server-Timing', '')
+            if 'sql"' in timing:
+                sql.append(int(timing.rsplit('desc="', 1)[1].split()[0]))
+        with lock:
+            latencies.extend(local)
+            statements.extend(sql)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        'scenario': scenario,
+        'concurrency': len(clients),
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / duration,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'sql_per_request': statistics.fmean(statements) if statements else None,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--accounts-per-user', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=50, help='transações por conta no seed')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=5, help='segundos por cenário e concorrência')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true',
+                        help='apaga e recria as tabelas (obrigatório com DATABASE_URL próprio)')
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    args = parser.parse_args(argv)
+    if not (TEMPORARY_DATABASE or args.reset):
+        parser.error('use --reset para recriar as tabelas de DATABASE_URL')
+
+    started = time.perf_counter()
+    data = seed(args.users, args.accounts_per_user, args.transactions, rng_seed=args.seed)
+    print(f'seed: {len(data["users"])} usuários, {len(data["accounts"])} contas, '
+          f'{data["transactions"]} transações em {time.perf_counter() - started:.1f}s')
+    register_aliases(app)
+
+    rng = random.Random(args.seed)
+    owned = {}
+    for account in data['accounts']:
+        owned.setdefault(account[2], []).append(account)
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        tokens = {user_id: create_access_token(identity=str(user_id)) for user_id, _ in data['users']}
+
+    results = []
+    print(f'{"cenário":<11} {"conc":>5} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"sql":>5} {"erros":>6}')
+    for scenario in args.scenarios:
+        for concurrency in args.concurrency:
+            users = rng.sample(data['users'], min(concurrency, len(data['users'])))
+            clients = [
+                Client(user, owned[user[0]], data['accounts'], tokens[user[0]],
+                       random.Random(rng.random()))
+                for user in (users * concurrency)[:concurrency]
+            ]
+            result = run_scenario(scenario, clients, args.duration)
+            results.append(result)
+            sql = f'{result["sql_per_request"]:.1f}' if result['sql_per_request'] is not None else '-'
+            print(f'{scenario:<11} {concurrency:>5} {result["throughput"]:>9.1f} {result["p50_ms"]:>8.1f} '
+                  f'{result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} {sql:>5} {result["errors"]:>6}')
+
+    if args.json:
+        meta = {
+            'commit': _commit(),
+            'date': datetime.utcnow().isoformat(),
+            'database': dialect,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'users': args.users,
+            'accounts_per_user': args.accounts_per_user,
+            'transactions_per_account': args.transactions,
+            'duration': args.duration,
+        }
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+
+def user_keys(user_id, username=None) -> List[str]:
+    keys = [f'user:{user_id}']
+    if username:
+        keys.append(f'user:name:{username}')
+    return keys
+
+
+def account_keys(account_id, account_number=None) -> List[str]:
+    keys = [f'account:{account_id}']
+    if account_number:
+        keys.append(f'account:number:{account_number}')
+    return keys
+
+
+def invalidate_on_commit(session, keys: Iterable[str]) -> None:
+    """Agenda a remoção das chaves para quando a transação da sessão for confirmada"""
+    session.info.setdefault('cache_keys', set()).update(keys)
+
+
+class LocalCache:
+    """Cache em processo com TTL e descarte LRU"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'backend': 'local',
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+
+class LocalSharedStore:
+    """Substituto local de um servidor de cache compartilhado (mesma API mínima do redis)"""
+
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ex: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ex if ex else None, value)
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def update(self, key: str, fn, ex: Optional[float] = None) -> Any:
+        """Lê, altera e grava a chave atomicamente (o que um script no servidor faria).
+
+        `fn(valor atual ou None)` devolve (novo valor, resultado da chamada).
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            current = None if entry is None or (entry[0] is not None and entry[0] < time.monotonic()) else entry[1]
+            value, result = fn(current)
+            self._data[key] = (time.monotonic() + ex if ex else None, value)
+            return result
+
+    def flushdb(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+local_shared_store = LocalSharedStore()
+
+
+class SharedCache:
+    """Cache compartilhado entre processos; valores são serializados com pickle"""
+
+    def __init__(self, client, ttl: float = 60, prefix: str = 'pybank:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = self.misses = self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(raw)
+
+    def set(self, key: str, value: Any) -> None:
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys: str) -> None:
+        if keys:
+            self.invalidations += self.client.delete(*(self.prefix + key for key in keys))
+
+    def clear(self) -> None:
+        self.client.flushdb()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'backend': 'shared',
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
+
+class NullCache:
+    hits = misses = 0
+
+    def get(self, key: str) -> None:
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def delete(self, *keys: str) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {'backend': 'none'}
+
+
+def create_cache(config) -> Any:
+    """Monta o backend a partir de CACHE_BACKEND (local, shared ou none)"""
+    backend = config.get('CACHE_BACKEND', 'local')
+    ttl = config.get('CACHE_TTL', 60)
+    if backend == 'none':
+        return NullCache()
+    if backend == 'shared':
+        url = config.get('CACHE_URL')
+        if not url:
+            return SharedCache(local_shared_store, ttl)
+        import redis  # optional dependency, only needed for a real shared cache
+        return SharedCache(redis.Redis.from_url(url), ttl)
+    return LocalCache(config.get('CACHE_MAXSIZE', 10000), ttl)
@@ -0,0 +1,139 @@
+"""Perfis do pool de conexões e roteamento de leituras para uma réplica.
+
+Com REPLICA_DATABASE_URL definido, as rotas marcadas com @read_replica mandam
+seus SELECTs para a réplica; escritas, flushes e qualquer outra instrução
+continuam no primário. Depois que um usuário grava algo, suas leituras ficam
+no primário por REPLICA_STICKY_SECONDS (ler as próprias escritas apesar do
+atraso de replicação). O registro da última escrita fica no cache da
+aplicação, então só vale entre workers com CACHE_BACKEND=shared.
+
+Se a réplica não aceitar conexões, ela é ignorada por REPLICA_RETRY_SECONDS
+e as leituras voltam ao primário.
+"""
+import logging
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+REPLICA = 'replica'
+# Kept on the request rather than the session: stream_with_context runs the
+# response body under a new app context, hence a new scoped session.
+_ENVIRON_KEY = 'pybank.read_replica'
+
+# pool_pre_ping=True checks every connection on checkout ('always');
+# 'recycle' skips the round trip and relies on pool_recycle instead.
+POOL_PROFILES = {
+    'default': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30,
+                'pool_recycle': 300, 'pre_ping': 'always'},
+    # Threaded web workers: room for bursts, fail fast when exhausted
+    'web': {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 5,
+            'pool_recycle': 1800, 'pre_ping': 'always'},
+    # CLI jobs and schedulers: few long-lived connections
+    'worker': {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 60,
+               'pool_recycle': 3600, 'pre_ping': 'recycle'},
+    # Behind PgBouncer or similar: keep the client-side pool small
+    'pooler': {'pool_size': 2, 'max_overflow': 5, 'pool_timeout': 10,
+               'pool_recycle': 300, 'pre_ping': 'recycle'},
+}
+
+_replica_down_until = 0.0
+
+
+def pool_options(config) -> dict:
+    """Opções de pool do perfil DB_POOL_PROFILE, com os ajustes DB_POOL_* por cima"""
+    profile = dict(POOL_PROFILES[config.get('DB_POOL_PROFILE') or 'default'])
+    for key, option in (('DB_POOL_SIZE', 'pool_size'), ('DB_MAX_OVERFLOW', 'max_overflow'),
+                        ('DB_POOL_TIMEOUT', 'pool_timeout'), ('DB_POOL_RECYCLE', 'pool_recycle'),
+                        ('DB_PRE_PING', 'pre_ping')):
+        if config.get(key) is not None:
+            profile[option] = config[key]
+    if profile['pre_ping'] not in ('always', 'recycle'):
+        raise ValueError("DB_PRE_PING deve ser 'always' ou 'recycle'")
+    profile['pool_pre_ping'] = profile.pop('pre_ping') == 'always'
+    return profile
+
+
+class RoutingSession(Session):
+    """Sessão que envia SELECTs à réplica quando a requisição foi marcada para isso"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False):
+            if has_request_context() and request.environ.get(_ENVIRON_KEY):
+                engine = self._replica_engine()
+                if engine is not None:
+                    return engine
+        elif bind is None:
+            # DML or flush: reads by the same user must see it
+            self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _replica_engine(self):
+        global _replica_down_until
+        engine = self._db.engines.get(REPLICA)
+        if engine is None or time.monotonic() < _replica_down_until:
+            return None
+        try:
+            # Joins the session transaction; a no-op once connected
+            self.connection(bind_arguments={'bind': engine})
+        except DBAPIError as e:
+            _replica_down_until = time.monotonic() + current_app.config.get('REPLICA_RETRY_SECONDS', 30)
+            logger.warning(f"Réplica indisponível, usando o primário: {e.orig}")
+            return None
+        return engine
+
+
+def request_identity():
+    """Usuário da requisição atual (JWT ou sessão), sem disparar consultas"""
+    if not has_request_context():
+        return None
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:
+        identity = None
+    if identity is None:
+        user = g.get('_login_user')
+        identity = getattr(user, 'id', None) if getattr(user, 'is_authenticated', False) else None
+    return str(identity) if identity is not None else None
+
+
+def _write_key(identity: str) -> str:
+    return f'last_write:{identity}'
+
+
+def _cache():
+    from storage import storage
+    return storage.cache
+
+
+def read_replica(view):
+    """Marca a rota como somente leitura: SELECTs podem ir para a réplica"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_app.config.get('REPLICA_DATABASE_URL'):
+            identity = request_identity()
+            last_write = _cache().get(_write_key(identity)) if identity else None
+            sticky = current_app.config.get('REPLICA_STICKY_SECONDS', 5)
+            if last_write is None or time.time() - last_write > sticky:
+                request.environ[_ENVIRON_KEY] = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _remember_write(session):
+    if session.info.pop('wrote', False) and current_app.config.get('REPLICA_DATABASE_URL'):
+        identity = request_identity()
+        if identity:
+            _cache().set(_write_key(identity), time.time())
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_write(session):
+    session.info.pop('wrote', None)
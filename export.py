@@ -0,0 +1,165 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+from typing import Iterator, Optional
+from sqlalchemy import case, select, union_all
+from models import Transaction
+from snapshots import balance_before
+from app import db
+import archive
+
+CHUNK_ROWS = 500
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'ofx': ('application/x-ofx', 'ofx'),
+}
+
+COLUMNS = ['id', 'created_at', 'type', 'amount', 'description', 'counterparty_account_id']
+ExportRow = namedtuple('ExportRow', COLUMNS)
+
+
+def export_statement(account_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Colunas do histórico em ordem cronológica, sem carregar entidades do ORM"""
+    outgoing = select(
+        Transaction.id,
+        Transaction.created_at,
+        Transaction.transaction_type.label('type'),
+        case((Transaction.transaction_type == 'deposit', Transaction.amount),
+             else_=-Transaction.amount).label('amount'),
+        Transaction.description,
+        Transaction.to_account_id.label('counterparty_account_id')
+    ).where(Transaction.account_id == account_id)
+    incoming = select(
+        Transaction.id,
+        Transaction.created_at,
+        Transaction.transaction_type.label('type'),
+        Transaction.amount.label('amount'),
+        Transaction.description,
+        Transaction.account_id.label('counterparty_account_id')
+    ).where(Transaction.to_account_id == account_id, Transaction.account_id != account_id)
+    if start is not None:
+        outgoing = outgoing.where(Transaction.created_at >= start)
+        incoming = incoming.where(Transaction.created_at >= start)
+    if end is not None:
+        outgoing = outgoing.where(Transaction.created_at < end)
+        incoming = incoming.where(Transaction.created_at < end)
+    history = union_all(outgoing, incoming)
+    # Ordering the compound itself (not a subquery) lets the planner merge
+    # both index scans (SQLite MERGE, Postgres Merge Append) instead of sorting
+    return (
+        history
+        .order_by(history.selected_columns.created_at, history.selected_columns.id)
+        # Server-side cursor: rows arrive in batches instead of all at once
+        .execution_options(stream_results=True, yield_per=CHUNK_ROWS)
+    )
+
+
+def _archived_rows(account_id, months, start, end):
+    # account_history reads one month at a time; chunks go out as they fill
+    rows = (
+        ExportRow(row.id, row.created_at, row.transaction_type, archive.signed_amount(row, account_id),
+                  row.description, row.to_account_id if row.account_id == account_id else row.account_id)
+        for row in archive.account_history(account_id, months, start, end)
+    )
+    while True:
+        chunk = list(islice(rows, CHUNK_ROWS))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _rows(account_id, start, end):
+    # Archived months come first; the database is read from the month after them
+    months = archive.catalog()
+    edge = archive.boundary(months)
+    if edge is not None and (start is None or start < edge):
+        yield from _archived_rows(account_id, months, start, end)
+        if end is not None and end <= edge:
+            return
+        start = edge
+    statement = export_statement(account_id, start, end)
+    # The ORM does not pass compound selects to get_bind on its own, which
+    # the read-replica routing needs to recognise a read
+    result = db.session.execute(statement, bind_arguments={'clause': statement})
+    try:
+        for partition in result.partitions():
+            yield partition
+    finally:
+        result.close()
+
+
+def stream_csv(account_id: int, start=None, end=None) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for partition in _rows(account_id, start, end):
+        for row in partition:
+            writer.writerow([row.id, row.created_at.isoformat(), row.type, row.amount,
+                             row.description, row.counterparty_account_id or ''])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(account_id: int, start=None, end=None) -> Iterator[str]:
+    for partition in _rows(account_id, start, end):
+        yield ''.join(json.dumps({
+            'id': row.id,
+            'created_at': row.created_at.isoformat(),
+            'type': row.type,
+            'amount': str(row.amount),
+            'description': row.description,
+            'counterparty_account_id': row.counterparty_account_id
+        }) + '\n' for row in partition)
+
+
+def _ofx_date(value: datetime) -> str:
+    return value.strftime('%Y%m%d%H%M%S')
+
+
+def _ofx_escape(value: str) -> str:
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def stream_ofx(account, start=None, end=None) -> Iterator[str]:
+    now = datetime.utcnow()
+    yield (
+        'OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\nSECURITY:NONE\nENCODING:UTF-8\n'
+        'CHARSET:NONE\nCOMPRESSION:NONE\nOLDFILEUID:NONE\nNEWFILEUID:NONE\n\n'
+        '<OFX><BANKMSGSRSV1><STMTTRNRS><TRNUID>0<STATUS><CODE>0<SEVERITY>INFO</STATUS>'
+        '<STMTRS><CURDEF>BRL'
+        f'<BANKACCTFROM><BANKID>PYBANK<ACCTID>{account.account_number}'
+        f'<ACCTTYPE>{"SAVINGS" if account.account_type == "savings" else "CHECKING"}</BANKACCTFROM>'
+        f'<BANKTRANLIST><DTSTART>{_ofx_date(start or account.created_at)}<DTEND>{_ofx_date(end or now)}\n'
+    )
+    total = Decimal('0')
+    for partition in _rows(account.id, start, end):
+        chunk = []
+        for row in partition:
+            total += row.amount
+            chunk.append(
+                f'<STMTTRN><TRNTYPE>{"CREDIT" if row.amount > 0 else "DEBIT"}'
+                f'<DTPOSTED>{_ofx_date(row.created_at)}<TRNAMT>{row.amount}'
+                f'<FITID>{row.id}<MEMO>{_ofx_escape(row.description or "")}</STMTTRN>\n'
+            )
+        yield ''.join(chunk)
+    # LEDGERBAL is the balance at the end of the list: from the first row the
+    # running total is that balance; a closed range (end at midnight, as the
+    # routes pass it) reads it from the daily snapshot, an open one is today's
+    if start is None:
+        balance = total
+    elif end is not None:
+        balance = balance_before(account.id, end.date())
+    else:
+        balance = account.balance
+    yield (
+        f'</BANKTRANLIST><LEDGERBAL><BALAMT>{balance}<DTASOF>{_ofx_date(end or now)}</LEDGERBAL>'
+        '</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n'
+    )
@@ -2,6 +2,8 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField, DecimalField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
 from models import User, Account
+from storage import storage
+from account_numbers import is_valid_account_number
 
 class LoginForm(FlaskForm):
     username = StringField('Nome de Usuário', validators=[DataRequired()])
@@ -68,6 +70,7 @@ class TransactionForm(FlaskForm):
         if self.transaction_type.data == 'transfer':
             if not field.data:
                 raise ValidationError('Número da conta de destino é obrigatório para transferências')
-            account = Account.query.filter_by(account_number=field.data).first()
-            if not account:
+            if len(field.data) == 10 and not is_valid_account_number(field.data):
+                raise ValidationError('Número de conta inválido')
+            if not storage.get_account_by_number(field.data):
                 raise ValidationError('Conta de destino não encontrada')
\ No newline at end of file
@@ -0,0 +1,39 @@
+"""Configuração do gunicorn, lida automaticamente a partir deste diretório.
+
+Com preload_app o mestre importa e monta a aplicação uma única vez e os
+workers herdam essa memória via fork, em vez de cada um repetir o trabalho
+de inicialização. GUNICORN_PRELOAD=0 desativa (necessário com --reload).
+"""
+import gc
+import multiprocessing
+import os
+
+wsgi_app = 'main:app'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    # Objects created during startup never die; moving them out of the
+    # collector's reach keeps GC passes from touching (and copying) shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared between workers
+    from app import dispose_engines
+    from main import flask_app
+    dispose_engines(flask_app)
+    if flask_app.config['RISK_ENABLED']:
+        # Debit windows are built in the background as the worker starts, not on its first debit
+        from risk import start_in_thread as start_risk
+        start_risk(flask_app)
+    if flask_app.config['RECURRING_IN_PROCESS']:
+        # Every worker runs a scheduler thread; claims keep their batches apart
+        from recurring import start_in_thread
+        start_in_thread(flask_app)
+    if flask_app.config['OUTBOX_IN_PROCESS']:
+        # Same for the outbox: each worker's dispatcher claims its own batches
+        from outbox import start_in_thread as start_dispatcher
+        start_dispatcher(flask_app)
@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingService:
+    """Executa hash e verificação de senhas fora da thread da requisição.
+
+    Com `workers=0` tudo roda na própria thread (útil em desenvolvimento).
+    O número de operações pendentes é limitado por `max_pending`; acima disso
+    a chamada falha na hora com 429 em vez de enfileirar. Uma operação que
+    estoura `timeout` responde 503, mas ocupa a vaga até sair do pool.
+    """
+
+    def __init__(self, method: str = 'scrypt', workers: int = 2,
+                 max_pending: Optional[int] = None, timeout: float = 5):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending or max(workers, 1) * 4)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # One pool per process: gunicorn workers forked after the first use
+        # must not share the parent's executor. 'spawn' keeps the children
+        # free of locks held by request threads at fork time.
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        # A child that died (OOM kill, segfault) breaks the pool for good;
+        # the next call starts a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise TooManyRequests('Muitas tentativas simultâneas, tente novamente em instantes')
+        try:
+            pool = self._pool()
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._discard(pool)
+            raise ServiceUnavailable('Serviço de autenticação indisponível, tente novamente')
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the job leaves the pool, not until the caller
+        # gives up: otherwise timed-out jobs pile up behind max_pending
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Only succeeds while the job is still queued; a running one holds its slot to the end
+            future.cancel()
+            raise ServiceUnavailable('Serviço de autenticação sobrecarregado')
+        except BrokenProcessPool:
+            self._discard(pool)
+            raise ServiceUnavailable('Serviço de autenticação indisponível, tente novamente')
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """Indica se o hash foi gerado com parâmetros diferentes dos configurados"""
+        if self._prefix is None:
+            # werkzeug expands the configured method (e.g. 'scrypt' ->
+            # 'scrypt:32768:8:1'), so derive the stored prefix once.
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def get_hashing_service(app) -> HashingService:
+    service = app.extensions.get('hashing')
+    if service is None:
+        service = HashingService(
+            method=app.config.get('PASSWORD_HASH_METHOD', 'scrypt'),
+            workers=app.config.get('HASH_WORKERS', 2),
+            max_pending=app.config.get('HASH_MAX_PENDING'),
+            timeout=app.config.get('HASH_TIMEOUT', 5)
+        )
+        app.extensions['hashing'] = service
+    return service
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import random
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Optional, Tuple
+import click
+from flask import current_app, g, request
+from flask.cli import AppGroup
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest, Conflict, HTTPException, UnprocessableEntity
+from cache import LocalCache
+from models import IdempotencyKey
+from app import db
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+PURGE_BATCH = 1000
+
+idempotency_cli = AppGroup('idempotency', help='Chaves de idempotência')
+
+# Completed responses only; a key is immutable once it has a response
+_responses = LocalCache(maxsize=10000, ttl=300)
+
+
+def request_fingerprint(path: str, body: bytes) -> str:
+    return hashlib.sha256(path.encode() + b'\n' + body).hexdigest()
+
+
+def _processing_lease() -> timedelta:
+    return timedelta(seconds=current_app.config.get('IDEMPOTENCY_PROCESSING_SECONDS', 120))
+
+
+def lookup(user_id: int, key: str, fingerprint: str) -> Optional[Tuple[dict, int]]:
+    """Resposta gravada para a chave, None se ainda não existe, expirou ou se a reserva venceu"""
+    cached = _responses.get(f'{user_id}:{key}')
+    if cached is None:
+        record = db.session.scalar(
+            select(IdempotencyKey).where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+        )
+        now = datetime.utcnow()
+        if record is None or record.expires_at < now:
+            return None
+        if record.status_code is None:
+            if record.request_hash != fingerprint:
+                raise UnprocessableEntity('Chave de idempotência já usada com outro corpo de requisição')
+            # Keys claimed before the lease existed fall back to their creation time
+            if (record.claimed_until or record.created_at + _processing_lease()) < now:
+                # The request holding it died without finishing; claim() takes it over
+                return None
+            raise Conflict('Uma requisição com esta chave de idempotência ainda está em processamento')
+        cached = (record.request_hash, json.loads(record.response_body), record.status_code)
+        _responses.set(f'{user_id}:{key}', cached)
+    if cached[0] != fingerprint:
+        raise UnprocessableEntity('Chave de idempotência já usada com outro corpo de requisição')
+    return cached[1], cached[2]
+
+
+def claim(user_id: int, key: str, fingerprint: str) -> bool:
+    """Reserva a chave antes de executar a operação; False se outra requisição já a reservou.
+
+    Uma reserva sem resposta cuja validade venceu (o processo morreu no meio da
+    requisição) passa para esta requisição, se o corpo for o mesmo.
+    """
+    now = datetime.utcnow()
+    lease = _processing_lease()
+    expires_at = now + timedelta(seconds=current_app.config.get('IDEMPOTENCY_TTL', 86400))
+    db.session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.expires_at < now
+    ))
+    # The lease is compared in the UPDATE, so two retries cannot both take over
+    taken = db.session.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key,
+               IdempotencyKey.request_hash == fingerprint, IdempotencyKey.status_code.is_(None),
+               or_(IdempotencyKey.claimed_until < now,
+                   and_(IdempotencyKey.claimed_until.is_(None), IdempotencyKey.created_at < now - lease)))
+        .values(claimed_until=now + lease, created_at=now, expires_at=expires_at)
+    ).rowcount
+    if taken:
+        db.session.commit()
+        return True
+    db.session.add(IdempotencyKey(
+        user_id=user_id,
+        key=key,
+        request_hash=fingerprint,
+        claimed_until=now + lease,
+        created_at=now,
+        expires_at=expires_at
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    if random.random() < current_app.config.get('IDEMPOTENCY_PURGE_PROBABILITY', 0.01):
+        purge_expired(PURGE_BATCH)
+    return True
+
+
+def completion_statement(user_id: int, key: str, body: dict, status_code: int):
+    """Grava a resposta da chave; não mexe numa chave já concluída"""
+    return (
+        update(IdempotencyKey)
+        .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None))
+        .values(status_code=status_code, response_body=json.dumps(body))
+    )
+
+
+def stage(body: dict, status_code: int) -> None:
+    """Grava a resposta da requisição em curso na transação aberta, para concluir a chave no mesmo commit
+    da operação; sem Idempotency-Key, não faz nada"""
+    active = g.get('idempotency_key')
+    if active is not None:
+        db.session.execute(completion_statement(*active, body, status_code))
+
+
+def complete(user_id: int, key: str, fingerprint: str, body: dict, status_code: int) -> None:
+    written = db.session.execute(completion_statement(user_id, key, body, status_code)).rowcount
+    db.session.commit()
+    # Nothing written: stage() already completed the key with the operation's commit.
+    # lookup() reads that response from the database, so the cache only takes this one.
+    if written:
+        _responses.set(f'{user_id}:{key}', (fingerprint, body, status_code))
+
+
+def release(user_id: int, key: str) -> None:
+    """Libera a chave após um erro inesperado para que o cliente possa tentar de novo"""
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+    ))
+    db.session.commit()
+
+
+def purge_expired(limit: int) -> int:
+    """Remove até `limit` chaves expiradas (usa o índice em expires_at)"""
+    expired = select(IdempotencyKey.id).where(
+        IdempotencyKey.expires_at < datetime.utcnow()
+    ).limit(limit).scalar_subquery()
+    deleted = db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.id.in_(expired))).rowcount
+    db.session.commit()
+    return deleted
+
+
+def begin(user_id: int, key: str, fingerprint: str) -> Optional[Tuple[dict, int]]:
+    """Resposta a repetir, ou None depois de reservar a chave para esta requisição"""
+    if len(key) > MAX_KEY_LENGTH:
+        raise BadRequest(f'{HEADER} deve ter no máximo {MAX_KEY_LENGTH} caracteres')
+    stored = lookup(user_id, key, fingerprint)
+    if stored is None and not claim(user_id, key, fingerprint):
+        stored = lookup(user_id, key, fingerprint)
+        if stored is None:
+            raise Conflict('Uma requisição com esta chave de idempotência ainda está em processamento')
+    return stored
+
+
+def idempotent(fn):
+    """Repete a resposta gravada quando o cliente reenvia a mesma Idempotency-Key.
+
+    Deve ficar abaixo de @jwt_required(): as chaves são por usuário. Rotas que
+    gravam no banco chamam stage() antes do seu commit, para que a operação e
+    a resposta da chave sejam confirmadas juntas; erros 5xx liberam a chave.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return fn(*args, **kwargs)
+        user_id = int(get_jwt_identity())
+        fingerprint = request_fingerprint(request.path, request.get_data())
+        stored = begin(user_id, key, fingerprint)
+        if stored is not None:
+            return stored[0], stored[1], {'Idempotent-Replayed': 'true'}
+
+        g.idempotency_key = (user_id, key)
+        try:
+            result = fn(*args, **kwargs)
+        except HTTPException as e:
+            if e.code >= 500:
+                release(user_id, key)
+                raise
+            complete(user_id, key, fingerprint, {'message': e.description}, e.code)
+            raise
+        except Exception:
+            release(user_id, key)
+            raise
+        finally:
+            g.pop('idempotency_key', None)
+        body, status_code = result[0], result[1]
+        complete(user_id, key, fingerprint, body, status_code)
+        return result
+    return wrapper
+
+
+@idempotency_cli.command('purge')
+@click.option('--batch-size', type=int, default=PURGE_BATCH)
+def purge(batch_size: int):
+    """Remove todas as chaves expiradas, em lotes."""
+    total = 0
+    while True:
+        deleted = purge_expired(batch_size)
+        total += deleted
+        if deleted < batch_size:
+            break
+    click.echo(f'{total} chaves expiradas removidas')
@@ -0,0 +1,118 @@
+"""Contexto de identidade no JWT: contas do usuário e versão, para checar posse sem o banco.
+
+O token do login leva as claims `accounts` (ids das contas do usuário) e
+`accounts_version`. A versão é um contador por usuário em
+user_account_versions, incrementado no mesmo commit que cria ou remove uma
+conta; o valor atual fica no cache (user:<id>:accounts_version).
+
+Enquanto a versão do token for a atual, a lista de contas é completa e a
+posse de uma conta se decide pelas claims, sem consulta. Com versão
+diferente, ou num token sem claims, elas são ignoradas e a checagem volta ao
+banco; o cliente recupera o caminho rápido com um novo token (devolvido ao
+criar uma conta, ou no login).
+"""
+from typing import List, Optional
+from flask import current_app
+from flask_jwt_extended import get_jwt
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+from models import Account, UserAccountVersion
+from cache import invalidate_on_commit
+from storage import storage
+from app import db
+
+ACCOUNTS_CLAIM = 'accounts'
+VERSION_CLAIM = 'accounts_version'
+
+
+def version_key(user_id) -> str:
+    return f'user:{user_id}:accounts_version'
+
+
+def version_statement(user_id: int):
+    return select(UserAccountVersion.version).where(UserAccountVersion.user_id == user_id)
+
+
+def account_ids_statement(user_id: int):
+    return select(Account.id).where(Account.user_id == user_id).order_by(Account.id)
+
+
+def accounts_version(user_id: int) -> int:
+    key = version_key(user_id)
+    version = storage.cache.get(key)
+    if version is None:
+        version = db.session.scalar(version_statement(user_id)) or 0
+        storage.cache.set(key, version)
+    return version
+
+
+def claims_for(account_ids: List[int], version: int) -> dict:
+    if len(account_ids) > current_app.config['IDENTITY_MAX_ACCOUNTS']:
+        # Keeps the token small; these users always take the database path
+        return {}
+    return {ACCOUNTS_CLAIM: account_ids, VERSION_CLAIM: version}
+
+
+def identity_claims(user_id: int) -> dict:
+    """Claims adicionais do token: contas do usuário e a versão que elas refletem"""
+    version = accounts_version(user_id)
+    return claims_for(list(db.session.scalars(account_ids_statement(user_id))), version)
+
+
+def claims_own(claims: dict, account_id: int, version: int) -> Optional[bool]:
+    """Posse da conta segundo as claims; None se o token não as tem ou a versão mudou"""
+    if ACCOUNTS_CLAIM not in claims or claims.get(VERSION_CLAIM) != version:
+        return None
+    return int(account_id) in claims[ACCOUNTS_CLAIM]
+
+
+def owns_account(user_id, account_id: int) -> Optional[bool]:
+    """claims_own para o token da requisição atual"""
+    claims = get_jwt()
+    if ACCOUNTS_CLAIM not in claims:
+        return None
+    return claims_own(claims, account_id, accounts_version(int(user_id)))
+
+
+def bump_statement(dialect: str, user_ids):
+    """INSERT ... ON CONFLICT que incrementa as versões; None se o dialeto não suportar upsert"""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(UserAccountVersion).values([{'user_id': user_id, 'version': 1} for user_id in user_ids])
+    return stmt.on_conflict_do_update(
+        index_elements=[UserAccountVersion.user_id],
+        set_={'version': UserAccountVersion.version + 1}
+    )
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_account_versions(session, flush_context):
+    user_ids = set()
+    for instance in session.new | session.deleted:
+        if isinstance(instance, Account):
+            user_ids.add(instance.user_id)
+    for instance in session.dirty:
+        if isinstance(instance, Account):
+            # An account moved to another user changes both sets
+            history = inspect(instance).attrs.user_id.history
+            user_ids.update(history.added or ())
+            user_ids.update(history.deleted or ())
+    user_ids.discard(None)
+    if not user_ids:
+        return
+    connection = session.connection()
+    stmt = bump_statement(connection.dialect.name, sorted(user_ids))
+    if stmt is not None:
+        connection.execute(stmt)
+    else:
+        for user_id in sorted(user_ids):
+            if not connection.execute(
+                update(UserAccountVersion).where(UserAccountVersion.user_id == user_id)
+                .values(version=UserAccountVersion.version + 1)
+            ).rowcount:
+                connection.execute(UserAccountVersion.__table__.insert().values(user_id=user_id, version=1))
+    invalidate_on_commit(session, [version_key(user_id) for user_id in user_ids])
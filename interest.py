@@ -0,0 +1,300 @@
+"""Juros diários das contas remuneradas, lançados em lote no fim do dia.
+
+`flask interest accrue --date AAAA-MM-DD` (padrão: ontem, em UTC) credita em
+cada conta com taxa em INTEREST_RATES o juro de um dia sobre o saldo no fim
+desse dia: saldo × taxa anual / 365, arredondado ao centavo pela regra do
+banqueiro (ROUND_HALF_EVEN), como Decimal.quantize faria. O cálculo é feito
+em centavos inteiros, com NumPy quando instalado e em Python puro caso
+contrário, com o mesmo resultado.
+
+O saldo do fim do dia é o último saldo diário (account_daily_balances) até a
+data, como em snapshots.balance_before; conta sem nenhum (antes de `flask
+snapshots backfill`) é tratada como saldo zero. Assim uma execução retomada
+ou de um dia passado paga sobre o saldo daquele dia, não sobre o de hoje.
+
+As contas são divididas em faixas de id de INTEREST_CHUNK_SIZE, processadas
+por INTEREST_WORKERS processos. Cada faixa trava as contas, calcula os
+juros e grava, num único commit, os saldos, as transações (depósitos com a
+descrição "Juros de DD/MM/AAAA"), os lançamentos do razão, os eventos do
+outbox, os saldos diários e o checkpoint da faixa. Uma execução
+interrompida recomeça das faixas sem checkpoint, e nenhuma faixa recebe os
+juros do mesmo dia duas vezes: a chave primária do checkpoint recusa o
+segundo commit.
+"""
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, case, func, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from models import Account, AccountDailyBalance, InterestCheckpoint, LedgerEntry, OutboxEvent, Transaction
+from cache import account_keys, invalidate_on_commit
+from snapshots import record_daily_balances
+from ledger import ledger_legs
+import outbox
+from app import db, dispose_engines
+
+logger = logging.getLogger(__name__)
+
+interest_cli = AppGroup('interest', help='Juros diários das contas remuneradas')
+
+DAYS_PER_YEAR = 365
+# Accounts per UPDATE: the CASE with one branch per account stays small
+UPDATE_BATCH = 1000
+
+
+def parse_rates(rates: Dict[str, str]) -> Dict[str, Tuple[int, int]]:
+    """Taxas anuais positivas por tipo de conta, como frações (numerador, denominador)"""
+    parsed = {}
+    for account_type, rate in rates.items():
+        value = Decimal(str(rate or 0))
+        if value < 0:
+            raise ValueError(f'Taxa de juros negativa para {account_type}: {rate}')
+        if value:
+            parsed[account_type] = value.as_integer_ratio()
+    return parsed
+
+
+def _numpy():
+    try:
+        import numpy  # optional dependency, only needed for vectorized accrual
+    except ImportError:
+        return None
+    return numpy
+
+
+def daily_interest(cents: List[int], rate: Tuple[int, int]) -> List[int]:
+    """Juro de um dia, em centavos, para cada saldo em centavos.
+
+    round_half_even(cents × num / (den × 365)) em inteiros: o mesmo valor de
+    (saldo × taxa / 365).quantize(Decimal('0.01'), ROUND_HALF_EVEN).
+    """
+    numerator, denominator = rate
+    denominator *= DAYS_PER_YEAR
+    np = _numpy()
+    # int64 holds cents × numerator only up to 2**63; larger chunks go through Python ints
+    if np is not None and cents and max(cents) * numerator < 2 ** 63 and denominator < 2 ** 62:
+        quotient, remainder = np.divmod(np.asarray(cents, dtype=np.int64) * numerator, denominator)
+        twice = remainder * 2
+        quotient += (twice > denominator) | ((twice == denominator) & (quotient % 2 == 1))
+        return quotient.tolist()
+    result = []
+    for value in cents:
+        quotient, remainder = divmod(value * numerator, denominator)
+        if remainder * 2 > denominator or (remainder * 2 == denominator and quotient % 2):
+            quotient += 1
+        result.append(quotient)
+    return result
+
+
+def description_for(day: date) -> str:
+    return f'Juros de {day:%d/%m/%Y}'
+
+
+def accrue_range(day: date, start: int, end: int, rates: Dict[str, Tuple[int, int]]) -> Tuple[int, int]:
+    """Lança os juros de `day` das contas com id em [start, end); devolve (contas, centavos)"""
+    now = datetime.utcnow()
+    # First, so a second run of the same range fails here instead of after the work
+    db.session.execute(insert(InterestCheckpoint).values(
+        accrual_date=day, range_start=start, range_end=end, completed_at=now))
+    # End-of-day balance: each account's latest daily balance up to `day`
+    closing_day = (
+        select(AccountDailyBalance.account_id, func.max(AccountDailyBalance.day).label('day'))
+        .where(AccountDailyBalance.account_id >= start, AccountDailyBalance.account_id < end,
+               AccountDailyBalance.day <= day)
+        .group_by(AccountDailyBalance.account_id)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(Account.id, Account.account_type, AccountDailyBalance.balance)
+        .join(closing_day, closing_day.c.account_id == Account.id)
+        .join(AccountDailyBalance, and_(AccountDailyBalance.account_id == closing_day.c.account_id,
+                                        AccountDailyBalance.day == closing_day.c.day))
+        .where(Account.id >= start, Account.id < end, Account.account_type.in_(list(rates)),
+               AccountDailyBalance.balance > 0)
+        .order_by(Account.id)
+        .with_for_update(of=Account)
+    ).all()
+
+    credits: Dict[int, Decimal] = {}
+    for account_type, rate in rates.items():
+        accounts = [row for row in rows if row.account_type == account_type]
+        accrued = daily_interest([int(row.balance * 100) for row in accounts], rate)
+        credits.update((row.id, Decimal(cents).scaleb(-2)) for row, cents in zip(accounts, accrued) if cents)
+
+    total = sum(credits.values(), Decimal('0'))
+    if credits:
+        ids = sorted(credits)
+        updated = {}
+        for offset in range(0, len(ids), UPDATE_BATCH):
+            batch = {account_id: credits[account_id] for account_id in ids[offset:offset + UPDATE_BATCH]}
+            updated.update(db.session.execute(
+                update(Account)
+                .where(Account.id.in_(list(batch)))
+                .values(balance=Account.balance + case(batch, value=Account.id))
+                .returning(Account.id, Account.balance)
+                .execution_options(synchronize_session=False)
+            ).all())
+        description = description_for(day)
+        transaction_ids = db.session.scalars(
+            insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True),
+            [{'account_id': account_id, 'transaction_type': 'deposit', 'amount': credits[account_id],
+              'description': description, 'to_account_id': None, 'created_at': now} for account_id in ids]
+        ).all()
+        db.session.execute(insert(LedgerEntry), [
+            dict(leg, transaction_id=transaction_id, created_at=now)
+            for account_id, transaction_id in zip(ids, transaction_ids)
+            for leg in ledger_legs('deposit', account_id, credits[account_id])
+        ])
+        if outbox.enabled():
+            db.session.execute(insert(OutboxEvent), [
+                outbox.transaction_event(transaction_id, account_id, 'deposit', credits[account_id],
+                                         description, None, now, now)
+                for account_id, transaction_id in zip(ids, transaction_ids)
+            ])
+        record_daily_balances(updated, now.date())
+        invalidate_on_commit(db.session, [key for account_id in ids for key in account_keys(account_id)])
+
+    db.session.execute(
+        update(InterestCheckpoint)
+        .where(InterestCheckpoint.accrual_date == day, InterestCheckpoint.range_start == start)
+        .values(accounts=len(credits), total=total)
+    )
+    db.session.commit()
+    return len(credits), int(total * 100)
+
+
+def account_ranges(chunk_size: int, rates) -> List[Tuple[int, int]]:
+    """Faixas [início, fim) alinhadas em múltiplos de chunk_size que cobrem as contas remuneradas"""
+    first, last = db.session.execute(
+        select(func.min(Account.id), func.max(Account.id)).where(Account.account_type.in_(list(rates)))
+    ).one()
+    if first is None:
+        return []
+    return [(start, start + chunk_size) for start in range(first // chunk_size * chunk_size, last + 1, chunk_size)]
+
+
+_worker_app = None
+
+
+def _init_worker(app):
+    global _worker_app
+    # Connections inherited from the parent must not be shared
+    dispose_engines(app)
+    _worker_app = app
+
+
+def _run_range(day: date, start: int, end: int, rates) -> tuple:
+    """(início, contas, centavos, segundos, erro) de uma faixa, num processo do pool"""
+    started = time.perf_counter()
+    with _worker_app.app_context():
+        try:
+            accounts, cents = accrue_range(day, start, end, rates)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            # Exceptions from the driver do not always pickle; the message does
+            return start, 0, 0, time.perf_counter() - started, str(e).splitlines()[0]
+        finally:
+            db.session.remove()
+    return start, accounts, cents, time.perf_counter() - started, None
+
+
+def run_accrual(app, day: date, ranges: List[Tuple[int, int]], rates, workers: int, report=None) -> List[tuple]:
+    """Processa as faixas; com workers=0, no próprio processo"""
+    if workers <= 0:
+        _init_worker(app)
+        results = []
+        for start, end in ranges:
+            results.append(_run_range(day, start, end, rates))
+            if report:
+                report(results[-1])
+        return results
+    # Forked workers inherit the configured app; no request threads to worry about in a CLI job
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_worker, initargs=(app,)) as pool:
+        futures = [pool.submit(_run_range, day, start, end, rates) for start, end in ranges]
+        results = []
+        for future in as_completed(futures):
+            results.append(future.result())
+            if report:
+                report(results[-1])
+    return results
+
+
+def pending_ranges(day: date, chunk_size: int, rates) -> List[Tuple[int, int]]:
+    done = db.session.execute(
+        select(InterestCheckpoint.range_start, InterestCheckpoint.range_end)
+        .where(InterestCheckpoint.accrual_date == day)
+    ).all()
+    widths = {end - start for start, end in done}
+    if widths and widths != {chunk_size}:
+        # Different boundaries would overlap ranges already paid
+        raise ValueError(f'{day} foi iniciado com faixas de {widths.pop()} contas; use --chunk-size com esse valor')
+    finished = {start for start, _ in done}
+    return [(start, end) for start, end in account_ranges(chunk_size, rates) if start not in finished]
+
+
+@interest_cli.command('accrue')
+@click.option('--date', 'day', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Dia dos juros (padrão: ontem, em UTC)')
+@click.option('--workers', type=int, default=None, help='Processos (padrão: INTEREST_WORKERS; 0 roda aqui)')
+@click.option('--chunk-size', type=int, default=None, help='Contas por faixa (padrão: INTEREST_CHUNK_SIZE)')
+def accrue(day: Optional[datetime], workers: Optional[int], chunk_size: Optional[int]):
+    """Credita os juros de um dia encerrado nas contas remuneradas."""
+    config = current_app.config
+    today = datetime.utcnow().date()
+    day = day.date() if day else today - timedelta(days=1)
+    if day >= today:
+        raise click.ClickException(f'{day} ainda não terminou')
+    workers = config['INTEREST_WORKERS'] if workers is None else workers
+    chunk_size = chunk_size or config['INTEREST_CHUNK_SIZE']
+    try:
+        rates = parse_rates(config['INTEREST_RATES'])
+        if not rates:
+            raise ValueError('Nenhuma taxa de juros positiva em INTEREST_RATES')
+        ranges = pending_ranges(day, chunk_size, rates)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    # Nothing open in this process while the workers write
+    db.session.remove()
+    if not ranges:
+        click.echo(f'Juros de {day} já lançados')
+        return
+
+    failed = []
+
+    def report(result):
+        start, accounts, cents, elapsed, error = result
+        if error:
+            failed.append(start)
+            logger.error(f"Faixa {start} dos juros de {day} falhou: {error}")
+
+    started = time.perf_counter()
+    results = run_accrual(current_app._get_current_object(), day, ranges, rates, workers, report)
+    elapsed = time.perf_counter() - started
+    accounts = sum(result[1] for result in results)
+    total = Decimal(sum(result[2] for result in results)).scaleb(-2)
+    click.echo(f'{accounts} contas creditadas, {total} em juros, {len(results) - len(failed)}/{len(ranges)} faixas '
+               f'em {elapsed:.1f}s ({accounts / elapsed:.0f} contas/s)')
+    if failed:
+        raise click.ClickException(f'{len(failed)} faixas falharam; rode de novo para retomar')
+
+
+@interest_cli.command('status')
+@click.option('--date', 'day', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Dia dos juros (padrão: ontem, em UTC)')
+def status(day: Optional[datetime]):
+    """Mostra quantas faixas de um dia já foram lançadas."""
+    day = day.date() if day else datetime.utcnow().date() - timedelta(days=1)
+    done, accounts, total = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(InterestCheckpoint.accounts), 0),
+               func.coalesce(func.sum(InterestCheckpoint.total), 0))
+        .where(InterestCheckpoint.accrual_date == day)
+    ).one()
+    click.echo(f'{day}: {done} faixas lançadas, {accounts} contas, {total} em juros')
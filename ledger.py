@@ -0,0 +1,105 @@
+from decimal import Decimal
+from typing import List, Optional
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, func, insert, select, update
+from models import Account, LedgerEntry, Transaction
+from app import db
+
+ledger_cli = AppGroup('ledger', help='Razão de partidas dobradas')
+
+
+def ledger_legs(transaction_type: str, account_id: int, amount: Decimal,
+                to_account_id: Optional[int] = None) -> List[dict]:
+    """Débito e crédito de uma transação (account_id None = caixa do banco)"""
+    if transaction_type == 'deposit':
+        debit, credit = None, account_id
+    elif transaction_type == 'withdrawal':
+        debit, credit = account_id, None
+    else:
+        debit, credit = account_id, to_account_id
+    return [
+        {'account_id': debit, 'entry_type': 'debit', 'amount': amount},
+        {'account_id': credit, 'entry_type': 'credit', 'amount': amount},
+    ]
+
+
+def signed_amount():
+    return case((LedgerEntry.entry_type == 'credit', LedgerEntry.amount), else_=-LedgerEntry.amount)
+
+
+def ledger_balances():
+    """Saldo derivado do razão por conta (subquery account_id, balance)"""
+    return (
+        select(LedgerEntry.account_id, func.sum(signed_amount()).label('balance'))
+        .where(LedgerEntry.account_id.is_not(None))
+        .group_by(LedgerEntry.account_id)
+        .subquery()
+    )
+
+
+@ledger_cli.command('backfill')
+@click.option('--batch-size', type=int, default=1000)
+def backfill(batch_size: int):
+    """Gera os lançamentos das transações que ainda não têm nenhum."""
+    missing = (
+        select(Transaction.id, Transaction.transaction_type, Transaction.account_id,
+               Transaction.to_account_id, Transaction.amount, Transaction.created_at)
+        .where(~select(LedgerEntry.id).where(LedgerEntry.transaction_id == Transaction.id).exists())
+        .order_by(Transaction.id)
+    )
+    total = 0
+    while True:
+        rows = db.session.execute(missing.limit(batch_size)).all()
+        if not rows:
+            break
+        db.session.execute(insert(LedgerEntry), [
+            dict(leg, transaction_id=row.id, created_at=row.created_at)
+            for row in rows
+            for leg in ledger_legs(row.transaction_type, row.account_id, row.amount, row.to_account_id)
+        ])
+        db.session.commit()
+        total += len(rows)
+    click.echo(f'Lançamentos gerados para {total} transações')
+
+
+@ledger_cli.command('verify')
+@click.option('--chunk-size', type=int, default=1000, help='Linhas lidas por vez do cursor')
+def verify(chunk_size: int):
+    """Confere o saldo de todas as contas contra o razão em uma única leitura."""
+    ledger = ledger_balances()
+    rows = db.session.execute(
+        select(Account.id, Account.balance, func.coalesce(ledger.c.balance, 0).label('ledger_balance'))
+        .outerjoin(ledger, ledger.c.account_id == Account.id)
+        .order_by(Account.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    checked = mismatches = 0
+    for row in rows:
+        checked += 1
+        if Decimal(row.balance) != Decimal(row.ledger_balance):
+            mismatches += 1
+            click.echo(f'conta {row.id}: saldo {row.balance}, razão {row.ledger_balance}')
+    click.echo(f'{checked} contas verificadas, {mismatches} divergências')
+    if mismatches:
+        raise SystemExit(1)
+
+
+@ledger_cli.command('rebuild-balances')
+@click.option('--account-id', type=int, default=None, help='Recalcula apenas esta conta')
+def rebuild_balances(account_id: Optional[int]):
+    """Recalcula accounts.balance a partir do razão."""
+    total = (
+        select(func.coalesce(func.sum(signed_amount()), 0))
+        .where(LedgerEntry.account_id == Account.id)
+        .scalar_subquery()
+    )
+    stmt = update(Account).values(balance=total).execution_options(synchronize_session=False)
+    if account_id is not None:
+        stmt = stmt.where(Account.id == account_id)
+    updated = db.session.execute(stmt).rowcount
+    db.session.commit()
+
+    from storage import storage
+    storage.cache.clear()
+    click.echo(f'{updated} saldos recalculados')
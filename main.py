@@ -1,4 +1,19 @@
-from app import app
+import os
+from app import create_app
+
+flask_app = create_app()
+app = flask_app
+
+# SERVER_MODE=async serves the REST API from the ASGI app in asgi.py
+# (run it with uvicorn or gunicorn -k uvicorn.workers.UvicornWorker; dependencies
+# in the 'async' extra of pyproject.toml).
+if os.environ.get('SERVER_MODE') == 'async':
+    from asgi import create_asgi_app
+    app = create_asgi_app(flask_app)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if os.environ.get('SERVER_MODE') == 'async':
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=5000)
+    else:
+        app.run(host="0.0.0.0", port=5000, debug=True)
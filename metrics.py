@@ -0,0 +1,292 @@
+"""Instrumentação por requisição: tempo, consultas SQL, tempo de banco e espera do pool.
+
+Os números ficam em memória, por processo, e saem em formato Prometheus em
+/metrics. Com vários workers (gunicorn), cada processo expõe os próprios
+contadores; o Prometheus soma por instância.
+
+Consultas acima de SLOW_QUERY_MS são registradas no log com o endpoint de
+origem, e cada resposta leva um cabeçalho Server-Timing com o tempo total e
+o de banco.
+"""
+import logging
+import threading
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Dict, Iterable, Optional, Tuple
+
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+RECURRING_LAG_BUCKETS = (1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 21600.0, 86400.0)
+OUTBOX_LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 30.0, 300.0, 3600.0)
+CACHE_GAUGES = ('size', 'maxsize')
+
+
+class RequestStats:
+    __slots__ = ('statements', 'db_time', 'slow')
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.slow = 0
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, str, str], int] = {}
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.statements: Dict[Tuple[str, str], int] = {}
+        self.db_time: Dict[Tuple[str, str], float] = {}
+        self.slow_queries: Dict[Tuple[str, str], int] = {}
+        self.pool_wait = Histogram(POOL_WAIT_BUCKETS)
+        self.recurring: Dict[Tuple[str], int] = {}
+        self.recurring_lag = Histogram(RECURRING_LAG_BUCKETS)
+        self.risk_rejections: Dict[Tuple[str], int] = {}
+        self.outbox: Dict[Tuple[str], int] = {}
+        self.outbox_lag = Histogram(OUTBOX_LAG_BUCKETS)
+
+    def record_request(self, group, endpoint, method, status, elapsed, stats: RequestStats):
+        labels = (group, endpoint)
+        with self._lock:
+            key = (group, endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get(labels)
+            if histogram is None:
+                histogram = self.latency[labels] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(elapsed)
+            self.statements[labels] = self.statements.get(labels, 0) + stats.statements
+            self.db_time[labels] = self.db_time.get(labels, 0.0) + stats.db_time
+            if stats.slow:
+                self.slow_queries[labels] = self.slow_queries.get(labels, 0) + stats.slow
+
+    def record_pool_wait(self, elapsed: float) -> None:
+        with self._lock:
+            self.pool_wait.observe(elapsed)
+
+    def record_recurring(self, status: str, lag: float) -> None:
+        """Uma ocorrência de transferência programada e o atraso em relação ao horário previsto"""
+        with self._lock:
+            self.recurring[(status,)] = self.recurring.get((status,), 0) + 1
+            self.recurring_lag.observe(lag)
+
+    def record_outbox(self, status: str, count: int, lags: Iterable[float] = ()) -> None:
+        """Eventos do outbox por resultado; `lags` é o tempo entre o commit e a entrega"""
+        with self._lock:
+            self.outbox[(status,)] = self.outbox.get((status,), 0) + count
+            for lag in lags:
+                self.outbox_lag.observe(lag)
+
+    def record_risk_rejection(self, window: str) -> None:
+        """Um débito recusado pelo limite de velocidade da janela"""
+        with self._lock:
+            self.risk_rejections[(window,)] = self.risk_rejections.get((window,), 0) + 1
+
+    def render(self, cache_stats: Optional[dict] = None) -> str:
+        lines = []
+        with self._lock:
+            _counter(lines, 'pybank_http_requests_total', 'Requisições atendidas',
+                     ('group', 'endpoint', 'method', 'status'), self.requests)
+            lines += [
+                '# HELP pybank_http_request_duration_seconds Tempo de resposta',
+                '# TYPE pybank_http_request_duration_seconds histogram',
+            ]
+            for labels, histogram in sorted(self.latency.items()):
+                _histogram(lines, 'pybank_http_request_duration_seconds',
+                           _labels(('group', 'endpoint'), labels), histogram)
+            _counter(lines, 'pybank_db_statements_total', 'Instruções SQL executadas',
+                     ('group', 'endpoint'), self.statements)
+            _counter(lines, 'pybank_db_time_seconds_total', 'Tempo gasto no banco',
+                     ('group', 'endpoint'), self.db_time)
+            _counter(lines, 'pybank_db_slow_queries_total', 'Consultas acima de SLOW_QUERY_MS',
+                     ('group', 'endpoint'), self.slow_queries)
+            lines += [
+                '# HELP pybank_db_pool_checkout_seconds Espera por uma conexão do pool',
+                '# TYPE pybank_db_pool_checkout_seconds histogram',
+            ]
+            _histogram(lines, 'pybank_db_pool_checkout_seconds', '', self.pool_wait)
+            _counter(lines, 'pybank_recurring_runs_total', 'Ocorrências de transferências programadas',
+                     ('status',), self.recurring)
+            lines += [
+                '# HELP pybank_recurring_lag_seconds Atraso da execução em relação ao horário previsto',
+                '# TYPE pybank_recurring_lag_seconds histogram',
+            ]
+            _histogram(lines, 'pybank_recurring_lag_seconds', '', self.recurring_lag)
+            _counter(lines, 'pybank_outbox_events_total', 'Eventos do outbox por resultado da entrega',
+                     ('status',), self.outbox)
+            lines += [
+                '# HELP pybank_outbox_lag_seconds Tempo entre o commit do evento e a entrega',
+                '# TYPE pybank_outbox_lag_seconds histogram',
+            ]
+            _histogram(lines, 'pybank_outbox_lag_seconds', '', self.outbox_lag)
+            _counter(lines, 'pybank_risk_rejections_total', 'Débitos recusados por limite de velocidade',
+                     ('window',), self.risk_rejections)
+        for name, value in (cache_stats or {}).items():
+            if name in CACHE_GAUGES:
+                lines += [f'# TYPE pybank_cache_{name} gauge', f'pybank_cache_{name} {value}']
+            elif isinstance(value, (int, float)):
+                lines += [f'# TYPE pybank_cache_{name}_total counter', f'pybank_cache_{name}_total {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values) -> str:
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _counter(lines, name, help_text, label_names, values):
+    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+    for labels, value in sorted(values.items()):
+        lines.append(f'{name}{{{_labels(label_names, labels)}}} {value}')
+
+
+def _histogram(lines, name, labels, histogram: Histogram):
+    prefix = labels + ',' if labels else ''
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {histogram.sum}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+
+
+registry = Registry()
+
+
+class PoolPressure:
+    """Média móvel da espera por conexão; sem checkouts recentes, vale zero"""
+    __slots__ = ('average', 'updated', 'alpha', 'stale')
+
+    def __init__(self, alpha: float = 0.2, stale: float = 1.0):
+        self.average = 0.0
+        self.updated = 0.0
+        self.alpha = alpha
+        self.stale = stale
+
+    def observe(self, wait: float) -> None:
+        self.average += self.alpha * (wait - self.average)
+        self.updated = perf_counter()
+
+    def current(self) -> float:
+        # Shedding stops checkouts, so an old average must not keep shedding
+        return self.average if perf_counter() - self.updated < self.stale else 0.0
+
+
+pool_pressure = PoolPressure()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool que mede quanto cada checkout esperou por uma conexão livre"""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = perf_counter() - started
+            registry.record_pool_wait(elapsed)
+            pool_pressure.observe(elapsed)
+
+
+_slow_query_seconds = None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_started'].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+    if _slow_query_seconds is not None and elapsed >= _slow_query_seconds:
+        if stats is not None:
+            stats.slow += 1
+        logger.warning(f"Consulta lenta ({elapsed * 1000:.1f} ms) em "
+                       f"{request.endpoint if stats is not None else '-'}: {' '.join(statement.split())[:500]}")
+
+
+def init_app(app, api=None):
+    """Registra os hooks de requisição e a rota /metrics"""
+    global _slow_query_seconds
+    if app.config.get('SLOW_QUERY_MS'):
+        _slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+    groups: Dict[str, str] = {}
+
+    def group_of(endpoint: Optional[str]) -> str:
+        # restx resources are grouped by namespace, everything else by blueprint
+        if endpoint not in groups:
+            view_class = getattr(app.view_functions.get(endpoint), 'view_class', None)
+            namespaces = {
+                resource.resource: ns.name
+                for ns in (api.namespaces if api is not None else ())
+                for resource in ns.resources
+            }
+            groups[endpoint] = namespaces.get(view_class) or request.blueprint or 'app'
+        return groups[endpoint]
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = perf_counter()
+        g.metrics_stats = RequestStats()
+        _current.set(g.metrics_stats)
+
+    @app.after_request
+    def record(response):
+        stats = g.pop('metrics_stats', None)
+        if stats is None:
+            return response
+        elapsed = perf_counter() - g.pop('metrics_started')
+        endpoint = request.endpoint or 'not_found'
+        registry.record_request(group_of(endpoint), endpoint, request.method,
+                                str(response.status_code), elapsed, stats)
+        response.headers['Server-Timing'] = (
+            f'app;dur={elapsed * 1000:.1f}, db;dur={stats.db_time * 1000:.1f};desc="{stats.statements} sql"'
+        )
+        return response
+
+    @app.teardown_request
+    def clear_stats(exc):
+        _current.set(None)
+
+    def metrics_view():
+        from storage import storage
+        return Response(registry.render(storage.cache.stats()), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
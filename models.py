@@ -1,6 +1,6 @@
-from datetime import datetime
+from datetime import date, datetime
 from flask_login import UserMixin
-from sqlalchemy import String, Numeric, ForeignKey
+from sqlalchemy import BigInteger, Integer, String, Numeric, ForeignKey, Index, Text, UniqueConstraint, event
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from app import db
 from decimal import Decimal
@@ -21,8 +21,13 @@ class User(UserMixin, db.Model):
         return str(self.id)
 
     def check_password(self, password):
-        from utils import verify_password
-        return verify_password(self.password_hash, password)
+        """Verifica a senha e, se o hash usa parâmetros antigos, gera um novo (o commit fica com quem chamou)"""
+        from utils import verify_password, password_needs_rehash, hash_password
+        if not verify_password(self.password_hash, password):
+            return False
+        if password_needs_rehash(self.password_hash):
+            self.password_hash = hash_password(password)
+        return True
 
 class Account(db.Model):
     __tablename__ = 'accounts'
@@ -30,7 +35,7 @@ class Account(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     account_number: Mapped[str] = mapped_column(String(20), unique=True, nullable=False)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
-    balance: Mapped[Decimal] = mapped_column(Numeric(precision=10, scale=2), default=Decimal('0'))
+    balance: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2), default=Decimal('0'))
     account_type: Mapped[str] = mapped_column(String(20))
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
@@ -46,15 +51,195 @@ class Account(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        # Keyset pagination of an account's history walks one of these per side
+        Index('ix_transactions_account_created', 'account_id', 'created_at', 'id'),
+        Index('ix_transactions_to_account_created', 'to_account_id', 'created_at', 'id'),
+        # Date-range scans across all accounts (analytics rollup job)
+        Index('ix_transactions_created', 'created_at'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'))
     transaction_type: Mapped[str] = mapped_column(String(20))
-    amount: Mapped[Decimal] = mapped_column(Numeric(precision=10, scale=2))
+    amount: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2))
     description: Mapped[str] = mapped_column(String(200))
     to_account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'), nullable=True)
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
     # Relationships
     account = relationship("Account", foreign_keys=[account_id], back_populates="transactions_from")
-    to_account = relationship("Account", foreign_keys=[to_account_id], back_populates="transactions_to")
\ No newline at end of file
+    to_account = relationship("Account", foreign_keys=[to_account_id], back_populates="transactions_to")
+    ledger_entries = relationship("LedgerEntry", back_populates="transaction")
+
+class RecurringTransfer(db.Model):
+    """Transferência programada; o agendador executa cada ocorrência vencida.
+
+    claimed_by/claimed_until formam a concessão de um worker sobre a linha;
+    com claimed_until no futuro e claimed_by NULL, a ocorrência aguarda nova
+    tentativa.
+    """
+    __tablename__ = 'recurring_transfers'
+    __table_args__ = (
+        # The scheduler's claim scans due instructions in this order
+        Index('ix_recurring_transfers_due', 'active', 'next_run_at'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'), index=True)
+    to_account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'))
+    amount: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2))
+    description: Mapped[str] = mapped_column(String(200))
+    frequency: Mapped[str] = mapped_column(String(10))
+    # Day of month the monthly instruction was set up for (31 -> last day)
+    anchor_day: Mapped[int] = mapped_column()
+    next_run_at: Mapped[datetime] = mapped_column()
+    end_at: Mapped[datetime] = mapped_column(nullable=True)
+    active: Mapped[bool] = mapped_column(default=True)
+    claimed_by: Mapped[str] = mapped_column(String(64), nullable=True)
+    claimed_until: Mapped[datetime] = mapped_column(nullable=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    last_run_at: Mapped[datetime] = mapped_column(nullable=True)
+    last_status: Mapped[str] = mapped_column(String(10), nullable=True)
+    last_message: Mapped[str] = mapped_column(String(200), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+class InterestCheckpoint(db.Model):
+    """Faixa de ids de conta cujos juros do dia já foram lançados, no mesmo commit dos lançamentos"""
+    __tablename__ = 'interest_checkpoints'
+
+    accrual_date: Mapped[date] = mapped_column(primary_key=True)
+    range_start: Mapped[int] = mapped_column(primary_key=True)
+    range_end: Mapped[int] = mapped_column()
+    accounts: Mapped[int] = mapped_column(default=0)
+    total: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2), default=Decimal('0'))
+    completed_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+class TransactionArchive(db.Model):
+    """Mês de transações copiado para um arquivo fora do banco (ver partitions.py).
+
+    dropped_at NULL: o arquivo já vale para leitura, mas as linhas ainda
+    estão em transactions, esperando os caches do catálogo expirarem.
+    """
+    __tablename__ = 'transaction_archives'
+
+    month: Mapped[date] = mapped_column(primary_key=True)
+    file: Mapped[str] = mapped_column(String(200))
+    format: Mapped[str] = mapped_column(String(10))
+    row_count: Mapped[int] = mapped_column()
+    sha256: Mapped[str] = mapped_column(String(64))
+    archived_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    dropped_at: Mapped[datetime] = mapped_column(nullable=True)
+
+class OutboxEvent(db.Model):
+    """Evento gravado no mesmo commit da transação; o despachante o entrega aos destinos.
+
+    Pendente enquanto status = 'pending': available_at é quando pode ser
+    reivindicado de novo (concessão do worker ou espera entre tentativas).
+    """
+    __tablename__ = 'outbox_events'
+    __table_args__ = (
+        Index('ix_outbox_events_due', 'status', 'available_at'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    event_type: Mapped[str] = mapped_column(String(40))
+    aggregate_id: Mapped[int] = mapped_column(nullable=True)
+    payload: Mapped[str] = mapped_column(Text)
+    status: Mapped[str] = mapped_column(String(10), default='pending')
+    available_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    attempts: Mapped[int] = mapped_column(default=0)
+    claimed_by: Mapped[str] = mapped_column(String(64), nullable=True)
+    dispatched_at: Mapped[datetime] = mapped_column(nullable=True)
+    last_error: Mapped[str] = mapped_column(String(200), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+class UserAccountVersion(db.Model):
+    """Versão do conjunto de contas de um usuário; muda a cada conta criada ou removida"""
+    __tablename__ = 'user_account_versions'
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
+    version: Mapped[int] = mapped_column(default=0)
+
+class AccountDailyBalance(db.Model):
+    """Saldo de fim de dia de uma conta; só existe linha para dias com movimento"""
+    __tablename__ = 'account_daily_balances'
+
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'), primary_key=True)
+    day: Mapped[date] = mapped_column(primary_key=True)
+    balance: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2))
+
+class AccountFlowRollup(db.Model):
+    """Entradas e saídas de uma conta num período fechado (dia, semana ou mês)"""
+    __tablename__ = 'account_flow_rollups'
+
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'), primary_key=True)
+    grain: Mapped[str] = mapped_column(String(5), primary_key=True)
+    period_start: Mapped[date] = mapped_column(primary_key=True)
+    deposits: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2), default=Decimal('0'))
+    deposit_count: Mapped[int] = mapped_column(default=0)
+    withdrawals: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2), default=Decimal('0'))
+    withdrawal_count: Mapped[int] = mapped_column(default=0)
+    transfers_in: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2), default=Decimal('0'))
+    transfer_in_count: Mapped[int] = mapped_column(default=0)
+    transfers_out: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2), default=Decimal('0'))
+    transfer_out_count: Mapped[int] = mapped_column(default=0)
+
+class RollupWatermark(db.Model):
+    """Até onde (exclusive) um rollup já foi calculado"""
+    __tablename__ = 'rollup_watermarks'
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    closed_until: Mapped[date] = mapped_column()
+
+class AccountNumberSequence(db.Model):
+    """Contador de números de conta; cada processo reserva um bloco por vez"""
+    __tablename__ = 'account_number_sequence'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    next_value: Mapped[int] = mapped_column(BigInteger)
+
+class IdempotencyKey(db.Model):
+    """Resposta gravada de uma requisição com cabeçalho Idempotency-Key"""
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'key', name='uq_idempotency_keys_user_key'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
+    key: Mapped[str] = mapped_column(String(255))
+    request_hash: Mapped[str] = mapped_column(String(64))
+    # NULL while the original request is still being processed
+    status_code: Mapped[int] = mapped_column(nullable=True)
+    response_body: Mapped[str] = mapped_column(Text, nullable=True)
+    # Lease of the request processing the key; once past, a retry takes the key over
+    claimed_until: Mapped[datetime] = mapped_column(nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+
+class LedgerEntry(db.Model):
+    """Lançamento de partida dobrada; só aceita inserção.
+
+    Cada Transaction gera um débito e um crédito de mesmo valor. account_id
+    NULL representa a conta de caixa do banco (depósitos e saques). O saldo
+    de uma conta é a soma dos créditos menos a soma dos débitos.
+    """
+    __tablename__ = 'ledger_entries'
+    __table_args__ = (
+        Index('ix_ledger_entries_account', 'account_id', 'id'),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    transaction_id: Mapped[int] = mapped_column(ForeignKey('transactions.id'), index=True)
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id'), nullable=True)
+    entry_type: Mapped[str] = mapped_column(String(6))
+    amount: Mapped[Decimal] = mapped_column(Numeric(precision=18, scale=2))
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+    transaction = relationship("Transaction", back_populates="ledger_entries")
+
+@event.listens_for(LedgerEntry, 'before_update')
+@event.listens_for(LedgerEntry, 'before_delete')
+def _ledger_is_append_only(mapper, connection, target):
+    raise ValueError('Lançamentos do razão não podem ser alterados ou removidos')
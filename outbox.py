@@ -0,0 +1,420 @@
+"""Outbox transacional de eventos e o despachante que os entrega.
+
+Cada Transaction gravada pelo ORM gera um evento `transaction.created` em
+outbox_events no mesmo flush, então o evento existe se e somente se a
+transação foi commitada; o caminho em massa de batch.py grava os seus
+eventos junto com as linhas. O commit só ganha um INSERT: nenhum efeito
+colateral roda na requisição.
+
+O despachante (`flask outbox run`, ou uma thread por worker do gunicorn com
+OUTBOX_IN_PROCESS=1) reivindica lotes com UPDATE ... RETURNING (FOR UPDATE
+SKIP LOCKED no Postgres), entrega o lote a cada destino de OUTBOX_SINKS e
+marca os eventos como enviados. Se um destino recusa o lote, os eventos são
+enviados um a um para isolar os que falham; esses voltam à fila com espera
+exponencial (OUTBOX_BACKOFF_SECONDS, dobrando até OUTBOX_MAX_BACKOFF_SECONDS)
+e, após OUTBOX_MAX_ATTEMPTS, ficam com status 'dead' (`flask outbox
+requeue` os devolve).
+
+A entrega é pelo menos uma vez: um worker que morre depois de entregar e
+antes de marcar, ou um destino que aceita parte do lote, faz o evento ser
+entregue de novo. Os destinos devem descartar repetidos pelo `id` do evento.
+
+Destinos (OUTBOX_SINKS, separados por vírgula): `ndjson:caminho` acrescenta
+uma linha JSON por evento ao arquivo (relativo à pasta instance);
+`webhook:url` faz POST de {"events": [...]}; `queue` coloca os eventos em
+outbox.local_queue, para consumidores no mesmo processo.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import statistics
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+import metrics
+from models import OutboxEvent, Transaction
+from app import db
+
+logger = logging.getLogger(__name__)
+
+outbox_cli = AppGroup('outbox', help='Outbox de eventos das transações')
+
+TRANSACTION_CREATED = 'transaction.created'
+# In the one-by-one fallback, a sink failing this many times in a row is taken as down
+MAX_CONSECUTIVE_FAILURES = 3
+
+local_queue: queue.Queue = queue.Queue(maxsize=100000)
+
+
+def transaction_event(transaction_id: int, account_id: int, transaction_type: str, amount, description: str,
+                      to_account_id: Optional[int], created_at: datetime, now: datetime) -> dict:
+    """Linha de outbox_events para uma transação gravada"""
+    payload = {
+        'transaction_id': transaction_id,
+        'account_id': account_id,
+        'to_account_id': to_account_id,
+        'transaction_type': transaction_type,
+        'amount': str(amount),
+        'description': description,
+        'created_at': created_at.isoformat(),
+    }
+    return {'event_type': TRANSACTION_CREATED, 'aggregate_id': transaction_id, 'payload': json.dumps(payload),
+            'status': 'pending', 'available_at': now, 'attempts': 0, 'created_at': now}
+
+
+def enabled() -> bool:
+    return has_app_context() and current_app.config.get('OUTBOX_ENABLED', True)
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_transactions(session, flush_context):
+    transactions = [instance for instance in session.new if isinstance(instance, Transaction)]
+    if not transactions or not enabled():
+        return
+    now = datetime.utcnow()
+    session.connection().execute(insert(OutboxEvent.__table__), [
+        transaction_event(t.id, t.account_id, t.transaction_type, t.amount, t.description,
+                          t.to_account_id, t.created_at or now, now)
+        for t in transactions
+    ])
+
+
+class NDJSONSink:
+    """Uma linha JSON por evento, com fsync antes de confirmar o lote"""
+    name = 'ndjson'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def send(self, events: List[dict]) -> None:
+        lines = ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in events)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class WebhookSink:
+    """POST do lote para uma URL; qualquer resposta fora de 2xx é falha"""
+    name = 'webhook'
+
+    def __init__(self, url: str, timeout: float = 5):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, events: List[dict]) -> None:
+        request = urllib.request.Request(
+            self.url, data=json.dumps({'events': events}).encode(), method='POST',
+            headers={'Content-Type': 'application/json'}
+        )
+        # urlopen raises HTTPError for 4xx/5xx
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if not 200 <= response.status < 300:
+                raise RuntimeError(f'webhook respondeu {response.status}')
+
+
+class QueueSink:
+    """Fila em memória do processo; cheia, o lote falha e é tentado de novo"""
+    name = 'queue'
+
+    def __init__(self, target: queue.Queue = None):
+        self.queue = local_queue if target is None else target
+
+    def send(self, events: List[dict]) -> None:
+        for item in events:
+            self.queue.put_nowait(item)
+
+
+def create_sinks(spec: str, base_path: str = '.') -> list:
+    """'ndjson:eventos.ndjson,webhook:http://...,queue' -> destinos"""
+    sinks = []
+    for part in filter(None, (part.strip() for part in (spec or '').split(','))):
+        kind, _, target = part.partition(':')
+        if kind == 'ndjson' and target:
+            sinks.append(NDJSONSink(os.path.join(base_path, target)))
+        elif kind == 'webhook' and target:
+            sinks.append(WebhookSink(target))
+        elif kind == 'queue' and not target:
+            sinks.append(QueueSink())
+        else:
+            raise ValueError(f"Destino inválido {part!r}; use ndjson:caminho, webhook:url ou queue")
+    return sinks
+
+
+def claim_statement(worker: str, batch_size: int, now: datetime, lease: timedelta):
+    """UPDATE que reivindica até `batch_size` eventos pendentes, do mais antigo ao mais novo"""
+    due = (
+        select(OutboxEvent.id)
+        .where(OutboxEvent.status == 'pending', OutboxEvent.available_at <= now)
+        .order_by(OutboxEvent.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return (
+        update(OutboxEvent)
+        .where(OutboxEvent.id.in_(due.scalar_subquery()))
+        .values(claimed_by=worker, available_at=now + lease)
+        .returning(OutboxEvent.id, OutboxEvent.event_type, OutboxEvent.payload, OutboxEvent.created_at,
+                   OutboxEvent.attempts)
+        .execution_options(synchronize_session=False)
+    )
+
+
+class DispatchResult:
+    __slots__ = ('claimed', 'sent', 'retried', 'dead', 'lost', 'elapsed', 'lags')
+
+    def __init__(self):
+        self.claimed = self.sent = self.retried = self.dead = self.lost = 0
+        self.elapsed = 0.0
+        self.lags: List[float] = []
+
+
+class Dispatcher:
+    """Reivindica lotes de eventos pendentes e os entrega aos destinos"""
+
+    def __init__(self, sinks: list, worker: Optional[str] = None, batch_size: int = 500,
+                 lease_seconds: float = 60, max_attempts: int = 10, backoff_seconds: float = 1,
+                 max_backoff_seconds: float = 600):
+        self.sinks = sinks
+        self.worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    @classmethod
+    def from_config(cls, app, **overrides) -> 'Dispatcher':
+        config = app.config
+        options = dict(
+            sinks=create_sinks(config.get('OUTBOX_SINKS', ''), app.instance_path),
+            batch_size=config.get('OUTBOX_BATCH_SIZE', 500),
+            lease_seconds=config.get('OUTBOX_LEASE_SECONDS', 60),
+            max_attempts=config.get('OUTBOX_MAX_ATTEMPTS', 10),
+            backoff_seconds=config.get('OUTBOX_BACKOFF_SECONDS', 1),
+            max_backoff_seconds=config.get('OUTBOX_MAX_BACKOFF_SECONDS', 600),
+        )
+        options.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**options)
+
+    def backoff(self, attempts: int) -> timedelta:
+        """Espera antes da tentativa seguinte: dobra a cada falha, com variação para espalhar os retornos"""
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** max(attempts - 1, 0))
+        return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+    def deliver(self, events: List[dict]) -> Tuple[List[int], Dict[int, str], List[int]]:
+        """Entrega a todos os destinos; devolve (enviados, falhas por id, não tentados)"""
+        try:
+            for sink in self.sinks:
+                sink.send(events)
+            return [item['id'] for item in events], {}, []
+        except Exception as e:
+            if len(events) == 1:
+                return [], {events[0]['id']: f'{sink.name}: {e}'}, []
+            logger.warning(f"Destino {sink.name} recusou um lote de {len(events)} eventos ({e}); enviando um a um")
+
+        # One at a time isolates the events a sink rejects
+        sent, failed = [], {}
+        consecutive = 0
+        for position, item in enumerate(events):
+            try:
+                for sink in self.sinks:
+                    sink.send([item])
+            except Exception as e:
+                failed[item['id']] = f'{sink.name}: {e}'
+                consecutive += 1
+                if consecutive >= MAX_CONSECUTIVE_FAILURES:
+                    # The sink looks down: the rest waits without spending an attempt
+                    return sent, failed, [later['id'] for later in events[position + 1:]]
+            else:
+                sent.append(item['id'])
+                consecutive = 0
+        return sent, failed, []
+
+    def run_batch(self) -> DispatchResult:
+        result = DispatchResult()
+        started = time.perf_counter()
+        try:
+            rows = db.session.execute(claim_statement(self.worker, self.batch_size, datetime.utcnow(),
+                                                      self.lease)).all()
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        result.claimed = len(rows)
+        if not rows:
+            return result
+
+        events = [{'id': row.id, 'type': row.event_type, 'created_at': row.created_at.isoformat(),
+                   'data': json.loads(row.payload)} for row in rows]
+        sent, failed, untried = self.deliver(events)
+        now = datetime.utcnow()
+        by_id = {row.id: row for row in rows}
+        owned = OutboxEvent.claimed_by == self.worker
+        try:
+            if sent:
+                result.sent = db.session.execute(
+                    update(OutboxEvent).where(OutboxEvent.id.in_(sent), owned)
+                    .values(status='sent', dispatched_at=now, claimed_by=None)
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+                # Fewer rows: the lease expired mid-batch and another worker has them
+                result.lost = len(sent) - result.sent
+                result.lags = [(now - by_id[event_id].created_at).total_seconds() for event_id in sent]
+            for event_id, error in failed.items():
+                attempts = by_id[event_id].attempts + 1
+                values = dict(attempts=attempts, claimed_by=None, last_error=error[:200])
+                if attempts >= self.max_attempts:
+                    logger.error(f"Evento {event_id} descartado após {attempts} tentativas: {error}")
+                    values['status'] = 'dead'
+                    result.dead += 1
+                else:
+                    values['available_at'] = now + self.backoff(attempts)
+                    result.retried += 1
+                db.session.execute(update(OutboxEvent).where(OutboxEvent.id == event_id, owned).values(**values)
+                                   .execution_options(synchronize_session=False))
+            for event_id in untried:
+                db.session.execute(
+                    update(OutboxEvent).where(OutboxEvent.id == event_id, owned)
+                    .values(claimed_by=None, available_at=now + self.backoff(by_id[event_id].attempts + 1))
+                    .execution_options(synchronize_session=False)
+                )
+            result.retried += len(untried)
+            db.session.commit()
+        except SQLAlchemyError:
+            # Unmarked events are claimed again when the lease ends: delivered twice, never lost
+            db.session.rollback()
+            raise
+        metrics.registry.record_outbox('sent', result.sent, result.lags)
+        if result.retried:
+            metrics.registry.record_outbox('retried', result.retried)
+        if result.dead:
+            metrics.registry.record_outbox('dead', result.dead)
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    def run(self, stop: Optional[threading.Event] = None, poll_seconds: float = 1,
+            drain: bool = False, report=None) -> List[DispatchResult]:
+        """Entrega lotes até `stop`; com `drain`, para quando não houver nada pendente"""
+        if not self.sinks:
+            raise ValueError('Nenhum destino configurado em OUTBOX_SINKS')
+        stop = stop or threading.Event()
+        results = []
+        while not stop.is_set():
+            try:
+                batch = self.run_batch()
+            except SQLAlchemyError as e:
+                logger.error(f"Erro ao despachar eventos do outbox: {str(e)}")
+                batch = DispatchResult()
+            finally:
+                db.session.remove()
+            if batch.claimed:
+                results.append(batch)
+                if report:
+                    report(batch)
+            elif drain:
+                break
+            if batch.claimed < self.batch_size:
+                stop.wait(0 if drain else poll_seconds)
+        return results
+
+
+def start_in_thread(app) -> threading.Event:
+    """Roda o despachante numa thread daemon do processo; devolve o evento que o para"""
+    stop = threading.Event()
+
+    def target():
+        with app.app_context():
+            Dispatcher.from_config(app).run(stop, app.config.get('OUTBOX_POLL_SECONDS', 1))
+
+    threading.Thread(target=target, name='outbox-dispatcher', daemon=True).start()
+    return stop
+
+
+def summarize(results: List[DispatchResult], elapsed: float) -> str:
+    sent = sum(batch.sent for batch in results)
+    lags = sorted(lag for batch in results for lag in batch.lags)
+    if not results:
+        return 'Nenhum evento pendente'
+    text = (f"{sent} eventos entregues em {elapsed:.1f}s ({sent / elapsed:.0f}/s); "
+            f"{sum(batch.retried for batch in results)} para nova tentativa, "
+            f"{sum(batch.dead for batch in results)} descartados, {sum(batch.lost for batch in results)} perdidos")
+    if lags:
+        p95 = statistics.quantiles(lags, n=20, method='inclusive')[18] if len(lags) > 1 else lags[0]
+        text += f"; atraso p50 {statistics.median(lags):.2f}s, p95 {p95:.2f}s, máx {lags[-1]:.2f}s"
+    return text
+
+
+@outbox_cli.command('run')
+@click.option('--batch-size', type=int, default=None, help='Eventos reivindicados por lote')
+@click.option('--worker', default=None, help='Identificador deste worker (padrão: host:pid)')
+@click.option('--forever', is_flag=True, help='Continua consultando a fila em vez de parar quando ela esvaziar')
+def run(batch_size: Optional[int], worker: Optional[str], forever: bool):
+    """Entrega os eventos pendentes aos destinos de OUTBOX_SINKS."""
+    try:
+        dispatcher = Dispatcher.from_config(current_app, batch_size=batch_size, worker=worker)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    def report(batch: DispatchResult):
+        click.echo(f"lote: {batch.sent} entregues ({batch.retried} para nova tentativa, {batch.dead} descartados) "
+                   f"em {batch.elapsed:.2f}s, atraso máx {max(batch.lags, default=0):.2f}s")
+
+    started = time.perf_counter()
+    try:
+        results = dispatcher.run(poll_seconds=current_app.config.get('OUTBOX_POLL_SECONDS', 1),
+                                 drain=not forever, report=report)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(summarize(results, time.perf_counter() - started))
+
+
+@outbox_cli.command('status')
+def status():
+    """Mostra quantos eventos há em cada estado e a idade do pendente mais antigo."""
+    counts = dict(db.session.execute(
+        select(OutboxEvent.status, func.count()).group_by(OutboxEvent.status)
+    ).all())
+    oldest = db.session.scalar(select(func.min(OutboxEvent.created_at)).where(OutboxEvent.status == 'pending'))
+    for name in ('pending', 'sent', 'dead'):
+        click.echo(f'{name}: {counts.get(name, 0)}')
+    if oldest is not None:
+        click.echo(f'pendente mais antigo: {(datetime.utcnow() - oldest).total_seconds():.0f}s')
+
+
+@outbox_cli.command('requeue')
+def requeue():
+    """Devolve à fila os eventos descartados após esgotar as tentativas."""
+    count = db.session.execute(
+        update(OutboxEvent).where(OutboxEvent.status == 'dead')
+        .values(status='pending', attempts=0, available_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    click.echo(f'{count} eventos devolvidos à fila')
+
+
+@outbox_cli.command('purge')
+@click.option('--days', type=int, default=7, show_default=True, help='Idade mínima dos eventos removidos')
+def purge(days: int):
+    """Remove eventos entregues ou descartados há mais de N dias."""
+    count = db.session.execute(
+        delete(OutboxEvent).where(OutboxEvent.status.in_(('sent', 'dead')),
+                                  OutboxEvent.created_at < datetime.utcnow() - timedelta(days=days))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    click.echo(f'{count} eventos removidos')
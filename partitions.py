@@ -0,0 +1,362 @@
+"""Particionamento mensal de transactions e arquivamento dos meses fechados.
+
+No Postgres, `flask partitions convert` transforma transactions numa tabela
+particionada por intervalo de created_at, uma partição por mês
+(transactions_pAAAA_MM) mais uma partição padrão para o que cair fora delas.
+`flask partitions ensure` cria as dos próximos PARTITIONS_AHEAD meses (rodar
+mensalmente; o `archive` também cria). Consultas com limites em created_at
+(extrato, exportação, analytics, busca por período e páginas do histórico
+depois da primeira) só leem as partições do intervalo. A chave primária
+passa a ser (id, created_at), e ledger_entries perde a chave estrangeira
+para transactions, que o Postgres não aceita sem created_at.
+
+No SQLite a tabela continua única: o catálogo de meses arquivados faz o
+roteamento das leituras, e arquivar um mês apaga as linhas pelo índice de
+created_at em vez de descartar uma partição.
+
+`flask partitions archive` copia cada mês fechado anterior aos
+TRANSACTIONS_HOT_MONTHS mais recentes para um arquivo em ARCHIVE_PATH
+(archive.py) e o registra em transaction_archives; a partir daí extrato e
+exportação leem o mês do arquivo. Depois de CACHE_TTL segundos, quando
+nenhum processo pode ter o catálogo antigo em cache, confere o arquivo e
+remove o mês do banco. Só arquiva meses já consolidados por `flask
+analytics rollup`, de onde o analytics passa a lê-los. `flask partitions
+restore` devolve ao banco o último mês arquivado.
+"""
+import os
+from datetime import date, datetime, time
+from time import sleep
+from typing import List, Optional
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.schema import CreateIndex
+from models import Transaction, TransactionArchive
+from analytics import _bucket, closed_until, period_end
+from cache import invalidate_on_commit
+from search import POSTGRES_DDL as SEARCH_DDL
+import archive
+from app import db
+
+partitions_cli = AppGroup('partitions', help='Partições mensais e arquivo de transações')
+
+TABLE = 'transactions'
+DEFAULT_PARTITION = 'transactions_default'
+LEGACY_TABLE = 'transactions_unpartitioned'
+RESTORE_CHUNK = 5000
+
+
+def partition_name(month: date) -> str:
+    return f'{TABLE}_p{month:%Y_%m}'
+
+
+def month_range(month: date):
+    return datetime.combine(month, time.min), datetime.combine(period_end('month', month), time.min)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def months_between(first: date, last: date) -> List[date]:
+    """Meses de `first` a `last`, inclusive"""
+    months = []
+    while first <= last:
+        months.append(first)
+        first = period_end('month', first)
+    return months
+
+
+def partition_ddl(month: date) -> str:
+    start, end = month_range(month)
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {TABLE} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+
+
+def is_partitioned(connection) -> bool:
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.scalar(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table AND pg_table_is_visible(c.oid)"
+    ), {'table': TABLE}) is not None
+
+
+def existing_partitions(connection) -> set:
+    return set(connection.scalars(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:table AS regclass)"
+    ), {'table': TABLE}))
+
+
+def convert_statements(sequence: str, months: List[date]) -> List[str]:
+    """DDL que troca a tabela única por uma particionada com os mesmos dados (uma transação)"""
+    dialect = db.session.get_bind().dialect
+    statements = [
+        f'LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE',
+        f'ALTER TABLE {TABLE} RENAME TO {LEGACY_TABLE}',
+        # Index names are schema-wide: the old primary key must free its name
+        f'ALTER TABLE {LEGACY_TABLE} RENAME CONSTRAINT {TABLE}_pkey TO {LEGACY_TABLE}_pkey',
+        # Otherwise dropping the old table drops the id sequence with it
+        f'ALTER SEQUENCE {sequence} OWNED BY NONE',
+        f'CREATE TABLE {TABLE} (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)',
+        f'ALTER TABLE {TABLE} ALTER COLUMN created_at SET NOT NULL',
+        # A unique constraint on a partitioned table must include the partition key
+        f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, created_at)',
+        f'ALTER TABLE {TABLE} ADD FOREIGN KEY (account_id) REFERENCES accounts (id)',
+        f'ALTER TABLE {TABLE} ADD FOREIGN KEY (to_account_id) REFERENCES accounts (id)',
+    ]
+    statements += [partition_ddl(month) for month in months]
+    statements += [
+        f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT',
+        f'INSERT INTO {TABLE} SELECT * FROM {LEGACY_TABLE}',
+        # CASCADE removes ledger_entries' foreign key, which cannot point at (id) any more
+        f'DROP TABLE {LEGACY_TABLE} CASCADE',
+        f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id',
+    ]
+    # Indexes on the parent are created on every partition, present and future
+    statements += [str(CreateIndex(index).compile(dialect=dialect)) for index in Transaction.__table__.indexes]
+    statements += SEARCH_DDL
+    statements.append(f'ANALYZE {TABLE}')
+    return statements
+
+
+def ensure_statements(connection, months: List[date]) -> List[str]:
+    """DDL que cria as partições que faltam; linhas já caídas na partição padrão são movidas"""
+    existing = existing_partitions(connection)
+    statements = []
+    for month in months:
+        if partition_name(month) in existing:
+            continue
+        start, end = month_range(month)
+        bounds = f"created_at >= '{start.isoformat()}' AND created_at < '{end.isoformat()}'"
+        stray = DEFAULT_PARTITION in existing and connection.scalar(
+            text(f'SELECT 1 FROM {DEFAULT_PARTITION} WHERE {bounds} LIMIT 1')) is not None
+        if not stray:
+            statements.append(partition_ddl(month))
+            continue
+        # Postgres refuses a new partition while the default one holds rows of its range
+        statements += [
+            f'ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}',
+            partition_ddl(month),
+            f'INSERT INTO {TABLE} SELECT * FROM {DEFAULT_PARTITION} WHERE {bounds}',
+            f'DELETE FROM {DEFAULT_PARTITION} WHERE {bounds}',
+            f'ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT',
+        ]
+    return statements
+
+
+def _execute(statements: List[str], dry_run: bool) -> None:
+    for statement in statements:
+        if dry_run:
+            click.echo(statement + ';')
+        else:
+            db.session.execute(text(statement))
+    if not dry_run:
+        db.session.commit()
+
+
+def _current_month() -> date:
+    return archive.month_of(datetime.utcnow())
+
+
+@partitions_cli.command('convert')
+@click.option('--dry-run', is_flag=True, help='Só mostra o DDL')
+def convert(dry_run: bool):
+    """Converte transactions numa tabela particionada por mês (Postgres)."""
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        raise click.ClickException('Particionamento nativo só no Postgres; no SQLite a tabela continua única')
+    if is_partitioned(connection):
+        raise click.ClickException(f'{TABLE} já é particionada; use `flask partitions ensure`')
+    sequence = db.session.scalar(text(f"SELECT pg_get_serial_sequence('{TABLE}', 'id')"))
+    first = db.session.scalar(select(func.min(Transaction.created_at)))
+    current = _current_month()
+    months = months_between(archive.month_of(first) if first else current,
+                            add_months(current, current_app.config['PARTITIONS_AHEAD']))
+    _execute(convert_statements(sequence, months), dry_run)
+    if not dry_run:
+        click.echo(f'{TABLE} particionada: {len(months)} partições mensais e {DEFAULT_PARTITION}')
+
+
+@partitions_cli.command('ensure')
+@click.option('--ahead', type=int, default=None, help='Meses à frente (padrão: PARTITIONS_AHEAD)')
+@click.option('--dry-run', is_flag=True, help='Só mostra o DDL')
+def ensure(ahead: Optional[int], dry_run: bool):
+    """Cria as partições do mês atual e dos próximos."""
+    connection = db.session.connection()
+    if not is_partitioned(connection):
+        click.echo(f'{TABLE} não é particionada; nada a fazer')
+        return
+    current = _current_month()
+    ahead = current_app.config['PARTITIONS_AHEAD'] if ahead is None else ahead
+    statements = ensure_statements(connection, months_between(current, add_months(current, ahead)))
+    _execute(statements, dry_run)
+    if not dry_run:
+        click.echo(f'{sum(s.startswith("CREATE") for s in statements)} partições criadas')
+
+
+@partitions_cli.command('status')
+def status():
+    """Mostra cada mês: linhas no banco, partição e arquivo."""
+    connection = db.session.connection()
+    month = _bucket(connection.dialect.name, 'month', Transaction.created_at).label('month')
+    hot = {archive.month_of(row.month): row.count for row in db.session.execute(
+        select(month, func.count().label('count')).group_by(month)
+    )}
+    archived = {row.month: row for row in db.session.scalars(select(TransactionArchive))}
+    partitions = existing_partitions(connection) if is_partitioned(connection) else set()
+    for key in sorted(set(hot) | set(archived)):
+        line = f'{key:%Y-%m}  banco: {hot.get(key, 0):>9}'
+        if partitions:
+            line += f'  {partition_name(key) if partition_name(key) in partitions else DEFAULT_PARTITION}'
+        if key in archived:
+            entry = archived[key]
+            state = 'removido do banco' if entry.dropped_at else 'aguardando remoção'
+            line += f'  arquivo: {entry.row_count} ({entry.file}, {state})'
+        click.echo(line)
+    ahead = sorted(name for name in partitions if name > partition_name(max(hot, default=date.min)))
+    if ahead:
+        click.echo(f'partições vazias à frente: {", ".join(ahead)}')
+
+
+def _partitions(statement):
+    # Lazy: the incoming copy's query only runs once the month's file is written
+    yield from db.session.execute(statement).partitions()
+
+
+def copy_month(month: date, fmt: str) -> Optional[TransactionArchive]:
+    """Grava o mês num arquivo e o registra no catálogo; None se o mês não tiver linhas"""
+    start, end = month_range(month)
+    name = archive.file_name(month, fmt)
+    rows = (
+        select(*(Transaction.__table__.c[column] for column in archive.COLUMNS))
+        .where(Transaction.created_at >= start, Transaction.created_at < end)
+        .execution_options(yield_per=archive.BLOCK_ROWS)
+    )
+    received = (
+        rows.where(Transaction.to_account_id.is_not(None), Transaction.to_account_id != Transaction.account_id)
+        .order_by(Transaction.to_account_id, Transaction.created_at, Transaction.id)
+    )
+    path = archive.file_path(name)
+    count, digest = archive.write_month(
+        _partitions(rows.order_by(Transaction.account_id, Transaction.created_at, Transaction.id)),
+        _partitions(received), path, fmt
+    )
+    if not count:
+        os.remove(path)
+        return None
+    entry = TransactionArchive(month=month, file=name, format=fmt, row_count=count, sha256=digest)
+    db.session.add(entry)
+    invalidate_on_commit(db.session, [archive.CATALOG_KEY])
+    db.session.commit()
+    return entry
+
+
+def drop_month(entry: TransactionArchive, partitioned: bool, partitions: set) -> int:
+    """Confere o arquivo contra o banco e remove as linhas do mês; devolve quantas"""
+    start, end = month_range(entry.month)
+    path = archive.file_path(entry.file)
+    if archive.file_digest(path) != entry.sha256:
+        raise click.ClickException(f'{entry.file} não confere com o catálogo; o mês fica no banco')
+    in_database = db.session.scalar(select(func.count()).select_from(Transaction).where(
+        Transaction.created_at >= start, Transaction.created_at < end))
+    if in_database != entry.row_count:
+        raise click.ClickException(f'{entry.month:%Y-%m}: {in_database} linhas no banco e {entry.row_count} '
+                                   'no arquivo; rode o archive de novo depois de `restore`')
+    name = partition_name(entry.month)
+    if partitioned and name in partitions:
+        db.session.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION {name}'))
+        db.session.execute(text(f'DROP TABLE {name}'))
+    else:
+        db.session.execute(delete(Transaction).where(Transaction.created_at >= start, Transaction.created_at < end)
+                           .execution_options(synchronize_session=False))
+    entry.dropped_at = datetime.utcnow()
+    db.session.commit()
+    return in_database
+
+
+@partitions_cli.command('archive')
+@click.option('--before', type=click.DateTime(['%Y-%m']), default=None,
+              help='Arquiva os meses anteriores a este (padrão: mantém TRANSACTIONS_HOT_MONTHS no banco)')
+@click.option('--grace', type=float, default=None,
+              help='Segundos entre publicar o arquivo e remover as linhas (padrão: CACHE_TTL)')
+def archive_months(before: Optional[datetime], grace: Optional[float]):
+    """Move os meses fechados antigos para arquivos em ARCHIVE_PATH."""
+    config = current_app.config
+    connection = db.session.connection()
+    partitioned = is_partitioned(connection)
+    if connection.dialect.name == 'postgresql' and not partitioned:
+        # ledger_entries' foreign key would refuse the delete; the conversion drops it
+        raise click.ClickException(f'Converta {TABLE} antes de arquivar: `flask partitions convert`')
+    try:
+        fmt = archive.archive_format(config)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    current = _current_month()
+    cutoff = archive.month_of(before) if before else add_months(current, -config['TRANSACTIONS_HOT_MONTHS'])
+    watermark = closed_until()
+    if watermark is None:
+        raise click.ClickException('Rode `flask analytics rollup` antes: o analytics lê os meses arquivados '
+                                   'dos rollups')
+    # Only months the rollups fully cover; the current month never closes here
+    cutoff = min(cutoff, archive.month_of(watermark), current)
+    if partitioned:
+        upcoming = months_between(current, add_months(current, config['PARTITIONS_AHEAD']))
+        _execute(ensure_statements(connection, upcoming), dry_run=False)
+
+    cataloged = set(db.session.scalars(select(TransactionArchive.month)))
+    first = db.session.scalar(select(func.min(Transaction.created_at)).where(
+        Transaction.created_at < datetime.combine(cutoff, time.min)))
+    copied = 0
+    for month in months_between(archive.month_of(first), add_months(cutoff, -1)) if first else []:
+        if month in cataloged:
+            continue
+        entry = copy_month(month, fmt)
+        if entry is not None:
+            copied += 1
+            click.echo(f'{month:%Y-%m}: {entry.row_count} linhas em {entry.file}')
+
+    pending = db.session.scalars(
+        select(TransactionArchive).where(TransactionArchive.dropped_at.is_(None)).order_by(TransactionArchive.month)
+    ).all()
+    if not pending:
+        click.echo(f'Nenhum mês a arquivar antes de {cutoff:%Y-%m}')
+        return
+    wait = config.get('CACHE_TTL', 60) if grace is None else grace
+    if copied and wait > 0:
+        # Until every cached catalog expires, readers may still take these months from the database
+        click.echo(f'Aguardando {wait:.0f}s para os caches do catálogo expirarem')
+        db.session.commit()
+        sleep(wait)
+    partitions = existing_partitions(connection) if partitioned else set()
+    removed = sum(drop_month(entry, partitioned, partitions) for entry in pending)
+    click.echo(f'{len(pending)} meses arquivados; {removed} linhas removidas do banco')
+
+
+@partitions_cli.command('restore')
+def restore():
+    """Devolve ao banco o último mês arquivado."""
+    entry = db.session.scalars(
+        select(TransactionArchive).order_by(TransactionArchive.month.desc()).limit(1)
+    ).first()
+    if entry is None:
+        raise click.ClickException('Nenhum mês arquivado')
+    restored = 0
+    if entry.dropped_at is not None:
+        connection = db.session.connection()
+        if is_partitioned(connection):
+            db.session.execute(text(partition_ddl(entry.month)))
+        rows = archive.read_file(archive.file_path(entry.file), entry.format)
+        for offset in range(0, len(rows), RESTORE_CHUNK):
+            # Core insert: the outbox hook only fires for new transactions, not restored ones
+            db.session.execute(insert(Transaction.__table__),
+                               [row._asdict() for row in rows[offset:offset + RESTORE_CHUNK]])
+        restored = len(rows)
+    db.session.delete(entry)
+    invalidate_on_commit(db.session, [archive.CATALOG_KEY])
+    db.session.commit()
+    click.echo(f'{entry.month:%Y-%m}: {restored} linhas devolvidas ao banco; {entry.file} mantido em ARCHIVE_PATH')
@@ -0,0 +1,218 @@
+"""Limite de taxa por cliente e controle de admissão global.
+
+Cada rota marcada com @rate_limited(regra) tem um balde de fichas por
+cliente: a identidade do JWT (ou do login por sessão) quando houver, senão o
+IP. A regra define a vazão e o tamanho do balde, no formato "10/minute".
+Sem fichas a resposta é 429 com Retry-After.
+
+Backends (RATE_LIMIT_BACKEND): `local` guarda os baldes no processo (cada
+worker tem o seu limite); `shared` usa o servidor de CACHE_URL (um script
+Lua mantém a operação atômica) ou, sem CACHE_URL, o substituto local de
+cache.py; `none` desliga os limites.
+
+A admissão vale para todas as rotas menos /metrics: com a espera média por
+conexão do pool acima de ADMISSION_POOL_WAIT_MS, ou com mais de
+ADMISSION_MAX_INFLIGHT requisições em andamento no processo, a requisição é
+recusada na hora com 503 em vez de entrar na fila do pool.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+import metrics
+from cache import local_shared_store
+from database import request_identity
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+EXEMPT_ENDPOINTS = ('metrics', 'static')
+
+
+def parse_rate(spec: str) -> Tuple[float, float]:
+    """'10/minute' -> (capacidade do balde, fichas por segundo)"""
+    count, _, period = spec.partition('/')
+    if period not in PERIODS or not count.isdigit() or int(count) <= 0:
+        raise ValueError(f"Limite inválido {spec!r}; use N/second, N/minute, N/hour ou N/day")
+    return float(count), int(count) / PERIODS[period]
+
+
+def _refill(tokens: float, updated: float, now: float, capacity: float, rate: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class LocalRateLimiter:
+    """Baldes em processo, com descarte LRU acima de `maxsize` chaves"""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: float, rate: float) -> Tuple[bool, float]:
+        """Consome uma ficha; devolve (permitido, fichas restantes)"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = capacity if bucket is None else _refill(bucket[0], bucket[1], now, capacity, rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                # The least recently used bucket is the most likely to be full
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+class SharedRateLimiter:
+    """Baldes num servidor compartilhado entre processos (mesma regra para todos os workers)"""
+
+    def __init__(self, client, prefix: str = 'pybank:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        # redis runs the bucket update as one script; the local stand-in
+        # offers an atomic read-modify-write instead
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT) if hasattr(client, 'register_script') else None
+
+    def take(self, key: str, capacity: float, rate: float) -> Tuple[bool, float]:
+        now = time.time()
+        if self._script is not None:
+            allowed, tokens = self._script(keys=[self.prefix + key], args=[capacity, rate, now])
+            return bool(allowed), float(tokens)
+
+        def update(bucket):
+            tokens = capacity if bucket is None else _refill(bucket[0], bucket[1], now, capacity, rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            return (tokens, now), (allowed, tokens)
+        return self.client.update(self.prefix + key, update, ex=math.ceil(capacity / rate))
+
+
+class RateLimiter:
+    """Aplica as regras de RATE_LIMITS sobre um backend"""
+
+    def __init__(self, backend, rules: Dict[str, str]):
+        self.backend = backend
+        self.rules = {name: parse_rate(spec) for name, spec in rules.items() if spec}
+
+    def check(self, rule: str, route: str, client: str) -> Optional[float]:
+        """Consome uma ficha do cliente na rota; 429 se o balde estiver vazio.
+
+        Devolve as fichas restantes (None se a regra estiver desligada).
+        """
+        if self.backend is None or rule not in self.rules:
+            return None
+        capacity, rate = self.rules[rule]
+        allowed, tokens = self.backend.take(f'{rule}:{route}:{client}', capacity, rate)
+        if not allowed:
+            raise TooManyRequests('Limite de requisições excedido, tente novamente em instantes',
+                                  retry_after=math.ceil((1 - tokens) / rate))
+        return tokens
+
+
+def create_rate_limiter(config) -> RateLimiter:
+    """Monta o limitador a partir de RATE_LIMIT_BACKEND (local, shared ou none)"""
+    backend = config.get('RATE_LIMIT_BACKEND', 'local')
+    if backend == 'none':
+        store = None
+    elif backend == 'shared':
+        url = config.get('CACHE_URL')
+        if url:
+            import redis  # optional dependency, only needed for a real shared store
+            store = SharedRateLimiter(redis.Redis.from_url(url))
+        else:
+            store = SharedRateLimiter(local_shared_store)
+    else:
+        store = LocalRateLimiter(config.get('RATE_LIMIT_MAXSIZE', 100000))
+    return RateLimiter(store, config.get('RATE_LIMITS', {}))
+
+
+def get_rate_limiter(app) -> RateLimiter:
+    limiter = app.extensions.get('ratelimit')
+    if limiter is None:
+        limiter = app.extensions['ratelimit'] = create_rate_limiter(app.config)
+    return limiter
+
+
+def rate_limited(rule: str, methods=None):
+    """Limita a rota pela regra `rule`; use depois de @jwt_required para chavear pelo usuário"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if methods is None or request.method in methods:
+                client = request_identity() or request.remote_addr or '-'
+                get_rate_limiter(current_app).check(rule, request.endpoint, client)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Admission:
+    """Recusa requisições quando o processo já está saturado"""
+
+    def __init__(self, max_pool_wait: float = 0, max_inflight: int = 0):
+        self.max_pool_wait = max_pool_wait
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def enter(self) -> None:
+        with self._lock:
+            if self.max_inflight and self.inflight >= self.max_inflight:
+                raise ServiceUnavailable('Servidor sobrecarregado, tente novamente em instantes',
+                                         retry_after=1)
+            self.inflight += 1
+        if self.max_pool_wait and metrics.pool_pressure.current() > self.max_pool_wait:
+            self.leave()
+            raise ServiceUnavailable('Servidor sobrecarregado, tente novamente em instantes',
+                                     retry_after=1)
+
+    def leave(self) -> None:
+        with self._lock:
+            self.inflight -= 1
+
+
+def init_app(app):
+    """Registra o controle de admissão para todas as requisições"""
+    admission = Admission(app.config.get('ADMISSION_POOL_WAIT_MS', 0) / 1000,
+                          app.config.get('ADMISSION_MAX_INFLIGHT', 0))
+    app.extensions['admission'] = admission
+    if not (admission.max_pool_wait or admission.max_inflight):
+        return
+
+    @app.before_request
+    def admit():
+        if request.endpoint not in EXEMPT_ENDPOINTS:
+            admission.enter()
+            g.admitted = True
+
+    @app.teardown_request
+    def release(exc):
+        if g.pop('admitted', False):
+            admission.leave()
@@ -0,0 +1,320 @@
+"""Transferências programadas e o agendador que as executa em lotes.
+
+Cada instrução tem a próxima ocorrência em next_run_at. O agendador
+(`flask recurring run`, ou a thread iniciada pelo gunicorn com
+RECURRING_IN_PROCESS=1) reivindica um lote de instruções vencidas com um
+único UPDATE ... RETURNING que grava uma concessão (claimed_by,
+claimed_until): no Postgres a seleção usa FOR UPDATE SKIP LOCKED, então
+workers simultâneos pegam lotes disjuntos sem esperar uns pelos outros; no
+SQLite as escritas já são serializadas e a concessão basta. Se um worker
+morrer, suas instruções voltam à fila quando a concessão expira.
+
+Cada ocorrência passa por utils.process_transaction; o avanço de
+next_run_at vai no mesmo commit da transferência, então uma ocorrência
+nunca é executada duas vezes. Falhas (saldo insuficiente, conta removida)
+são tentadas de novo após RECURRING_RETRY_SECONDS, até
+RECURRING_MAX_ATTEMPTS; depois a ocorrência é pulada.
+"""
+import calendar
+import logging
+import os
+import socket
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, Optional, Tuple
+import click
+from flask.cli import AppGroup
+from sqlalchemy import or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+import metrics
+from models import Account, RecurringTransfer
+from storage import storage
+from utils import process_transaction
+from app import db
+
+logger = logging.getLogger(__name__)
+
+recurring_cli = AppGroup('recurring', help='Transferências programadas')
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+
+def next_occurrence(current: datetime, frequency: str, anchor_day: int) -> datetime:
+    """Ocorrência seguinte; mensais voltam ao dia de origem quando o mês permite"""
+    if frequency == 'daily':
+        return current + timedelta(days=1)
+    if frequency == 'weekly':
+        return current + timedelta(days=7)
+    year, month = (current.year + 1, 1) if current.month == 12 else (current.year, current.month + 1)
+    return current.replace(year=year, month=month, day=min(anchor_day, calendar.monthrange(year, month)[1]))
+
+
+def create_recurring(account: Account, to_account_number: str, amount: Decimal, description: str,
+                     frequency: str, start_at: Optional[datetime] = None,
+                     end_at: Optional[datetime] = None) -> RecurringTransfer:
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"Frequência inválida; use {', '.join(FREQUENCIES)}")
+    to_account = storage.get_account_by_number(to_account_number)
+    if to_account is None:
+        raise ValueError("Conta de destino não encontrada")
+    if to_account.id == account.id:
+        raise ValueError("A conta de destino deve ser diferente da de origem")
+    now = datetime.utcnow()
+    start_at = start_at or now
+    # A past start would make the scheduler replay every missed occurrence at once
+    if start_at < now - timedelta(minutes=1):
+        raise ValueError("A primeira execução não pode estar no passado")
+    if end_at is not None and end_at < start_at:
+        raise ValueError("A data final deve ser posterior à inicial")
+    recurring = RecurringTransfer(
+        account_id=account.id,
+        to_account_id=to_account.id,
+        amount=amount,
+        description=description,
+        frequency=frequency,
+        anchor_day=start_at.day,
+        next_run_at=start_at,
+        end_at=end_at,
+        active=True,
+    )
+    db.session.add(recurring)
+    db.session.commit()
+    return recurring
+
+
+def account_recurring(account_id: int) -> List[Tuple[RecurringTransfer, str]]:
+    """Instruções ativas da conta com o número da conta de destino"""
+    return db.session.execute(
+        select(RecurringTransfer, Account.account_number)
+        .join(Account, Account.id == RecurringTransfer.to_account_id)
+        .where(RecurringTransfer.account_id == account_id, RecurringTransfer.active.is_(True))
+        .order_by(RecurringTransfer.next_run_at, RecurringTransfer.id)
+    ).all()
+
+
+def cancel_recurring(account_id: int, recurring_id: int) -> bool:
+    result = db.session.execute(
+        update(RecurringTransfer)
+        .where(RecurringTransfer.id == recurring_id, RecurringTransfer.account_id == account_id,
+               RecurringTransfer.active.is_(True))
+        .values(active=False)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def claim_statement(worker: str, batch_size: int, now: datetime, lease: timedelta,
+                    shard: Optional[Tuple[int, int]] = None):
+    """UPDATE que reivindica até `batch_size` instruções vencidas e as devolve"""
+    due = select(RecurringTransfer.id).where(
+        RecurringTransfer.active.is_(True),
+        RecurringTransfer.next_run_at <= now,
+        or_(RecurringTransfer.claimed_until.is_(None), RecurringTransfer.claimed_until < now),
+    )
+    if shard is not None:
+        index, count = shard
+        due = due.where(RecurringTransfer.id % count == index)
+    # SKIP LOCKED on Postgres; SQLite renders no FOR UPDATE and serializes writers
+    due = due.order_by(RecurringTransfer.next_run_at).limit(batch_size).with_for_update(skip_locked=True)
+    return (
+        update(RecurringTransfer)
+        .where(RecurringTransfer.id.in_(due.scalar_subquery()))
+        .values(claimed_by=worker, claimed_until=now + lease)
+        .returning(RecurringTransfer.id, RecurringTransfer.account_id, RecurringTransfer.to_account_id,
+                   RecurringTransfer.amount, RecurringTransfer.description, RecurringTransfer.frequency,
+                   RecurringTransfer.anchor_day, RecurringTransfer.next_run_at, RecurringTransfer.end_at,
+                   RecurringTransfer.attempts)
+        .execution_options(synchronize_session=False)
+    )
+
+
+class BatchResult:
+    __slots__ = ('claimed', 'succeeded', 'failed', 'lost', 'elapsed', 'lags')
+
+    def __init__(self):
+        self.claimed = self.succeeded = self.failed = self.lost = 0
+        self.elapsed = 0.0
+        self.lags: List[float] = []
+
+
+class Scheduler:
+    """Reivindica e executa lotes de ocorrências vencidas"""
+
+    def __init__(self, worker: Optional[str] = None, batch_size: int = 100, lease_seconds: float = 300,
+                 max_attempts: int = 3, retry_seconds: float = 3600,
+                 shard: Optional[Tuple[int, int]] = None):
+        self.worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.retry = timedelta(seconds=retry_seconds)
+        self.shard = shard
+
+    @classmethod
+    def from_config(cls, config, **overrides) -> 'Scheduler':
+        options = dict(
+            batch_size=config.get('RECURRING_BATCH_SIZE', 100),
+            lease_seconds=config.get('RECURRING_LEASE_SECONDS', 300),
+            max_attempts=config.get('RECURRING_MAX_ATTEMPTS', 3),
+            retry_seconds=config.get('RECURRING_RETRY_SECONDS', 3600),
+        )
+        options.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**options)
+
+    def run_batch(self) -> BatchResult:
+        result = BatchResult()
+        started = time.perf_counter()
+        try:
+            rows = db.session.execute(
+                claim_statement(self.worker, self.batch_size, datetime.utcnow(), self.lease, self.shard)
+            ).all()
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        result.claimed = len(rows)
+        if rows:
+            # One query for every destination number in the batch
+            numbers = dict(db.session.execute(
+                select(Account.id, Account.account_number)
+                .where(Account.id.in_({row.to_account_id for row in rows}))
+            ).all())
+            for row in sorted(rows, key=lambda row: (row.next_run_at, row.id)):
+                status = self._execute(row, numbers.get(row.to_account_id), result)
+                setattr(result, status, getattr(result, status) + 1)
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    def _execute(self, row, to_account_number: Optional[str], result: BatchResult) -> str:
+        now = datetime.utcnow()
+        lag = (now - row.next_run_at).total_seconds()
+        following = next_occurrence(row.next_run_at, row.frequency, row.anchor_day)
+        active = row.end_at is None or following <= row.end_at
+        owned = (RecurringTransfer.id == row.id, RecurringTransfer.claimed_by == self.worker)
+        try:
+            # Runs inside the transfer's own transaction: committed with it, or
+            # rolled back with it. Zero rows means our lease expired and the
+            # instruction was claimed by someone else.
+            advanced = db.session.execute(
+                update(RecurringTransfer).where(*owned).values(
+                    next_run_at=following, active=active, claimed_by=None, claimed_until=None,
+                    attempts=0, last_run_at=now, last_status='ok', last_message=None,
+                ).execution_options(synchronize_session=False)
+            ).rowcount
+            if advanced != 1:
+                db.session.rollback()
+                return 'lost'
+            account = storage.get_account(row.account_id)
+            if account is None:
+                success, message = False, "Conta não encontrada"
+            else:
+                success, message, _ = process_transaction(
+                    account, 'transfer', row.amount, row.description, to_account_number
+                )
+        except SQLAlchemyError as e:
+            logger.error(f"Erro na transferência programada {row.id}: {str(e)}")
+            success, message = False, "Erro ao processar a transferência"
+        result.lags.append(lag)
+        metrics.registry.record_recurring('succeeded' if success else 'failed', lag)
+        if success:
+            return 'succeeded'
+
+        db.session.rollback()
+        attempts = row.attempts + 1
+        if attempts < self.max_attempts:
+            # Released, but not due again until the retry delay has passed
+            values = dict(claimed_until=now + self.retry, attempts=attempts)
+        else:
+            logger.warning(f"Transferência programada {row.id}: ocorrência de "
+                           f"{row.next_run_at.isoformat()} pulada após {attempts} tentativas ({message})")
+            values = dict(next_run_at=following, active=active, claimed_until=None, attempts=0)
+        db.session.execute(
+            update(RecurringTransfer).where(*owned).values(
+                claimed_by=None, last_run_at=now, last_status='failed', last_message=message[:200], **values
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return 'failed'
+
+    def run(self, stop: Optional[threading.Event] = None, poll_seconds: float = 30,
+            drain: bool = False, report=None) -> List[BatchResult]:
+        """Executa lotes até `stop`; com `drain`, para quando não houver nada vencido"""
+        stop = stop or threading.Event()
+        results = []
+        while not stop.is_set():
+            try:
+                batch = self.run_batch()
+            except SQLAlchemyError as e:
+                logger.error(f"Erro ao reivindicar transferências programadas: {str(e)}")
+                batch = BatchResult()
+            finally:
+                db.session.remove()
+            if batch.claimed:
+                results.append(batch)
+                if report:
+                    report(batch)
+            elif drain:
+                break
+            if batch.claimed < self.batch_size:
+                stop.wait(0 if drain else poll_seconds)
+        return results
+
+
+def start_in_thread(app) -> threading.Event:
+    """Roda o agendador numa thread daemon do processo; devolve o evento que o para"""
+    stop = threading.Event()
+
+    def target():
+        with app.app_context():
+            Scheduler.from_config(app.config).run(stop, app.config.get('RECURRING_POLL_SECONDS', 30))
+
+    threading.Thread(target=target, name='recurring-scheduler', daemon=True).start()
+    return stop
+
+
+def summarize(results: List[BatchResult], elapsed: float) -> str:
+    executed = sum(batch.succeeded + batch.failed for batch in results)
+    lags = sorted(lag for batch in results for lag in batch.lags)
+    if not lags:
+        return 'Nenhuma ocorrência vencida'
+    p95 = statistics.quantiles(lags, n=20, method='inclusive')[18] if len(lags) > 1 else lags[0]
+    return (f"{executed} ocorrências em {elapsed:.1f}s ({executed / elapsed:.0f}/s): "
+            f"{sum(batch.succeeded for batch in results)} ok, {sum(batch.failed for batch in results)} falhas, "
+            f"{sum(batch.lost for batch in results)} perdidas; atraso p50 {statistics.median(lags):.1f}s, "
+            f"p95 {p95:.1f}s, máx {lags[-1]:.1f}s")
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    index, _, count = value.partition('/')
+    if not (index.isdigit() and count.isdigit() and int(index) < int(count)):
+        raise click.BadParameter('use I/N, com 0 <= I < N')
+    return int(index), int(count)
+
+
+@recurring_cli.command('run')
+@click.option('--batch-size', type=int, default=None, help='Ocorrências reivindicadas por lote')
+@click.option('--worker', default=None, help='Identificador deste worker (padrão: host:pid)')
+@click.option('--shard', default=None, callback=_parse_shard,
+              help='I/N: só instruções com id % N == I (divisão fixa entre workers)')
+@click.option('--forever', is_flag=True, help='Continua consultando a fila em vez de parar quando ela esvaziar')
+def run(batch_size: Optional[int], worker: Optional[str], shard, forever: bool):
+    """Executa as transferências programadas vencidas."""
+    from flask import current_app
+    scheduler = Scheduler.from_config(current_app.config, batch_size=batch_size, worker=worker, shard=shard)
+
+    def report(batch: BatchResult):
+        executed = batch.succeeded + batch.failed
+        click.echo(f"lote: {executed} executadas ({batch.failed} falhas, {batch.lost} perdidas) em "
+                   f"{batch.elapsed:.2f}s, {executed / batch.elapsed:.0f}/s, "
+                   f"atraso máx {max(batch.lags, default=0):.1f}s")
+
+    started = time.perf_counter()
+    results = scheduler.run(poll_seconds=current_app.config.get('RECURRING_POLL_SECONDS', 30),
+                            drain=not forever, report=report)
+    click.echo(summarize(results, time.perf_counter() - started))
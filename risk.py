@@ -0,0 +1,424 @@
+"""Limites de velocidade por conta, checados em memória antes de cada débito.
+
+Para cada conta com débitos recentes (saques e transferências enviadas) o
+motor guarda a quantidade e o valor debitado em três janelas deslizantes: 1
+minuto, 1 hora e 24 horas. Cada janela é um anel de fatias (10 s, 5 min e
+1 h) com uma fatia a mais que o necessário, então cobre de W a W + uma fatia
+e o limite nunca fica mais frouxo que o configurado. Os anéis de todas as
+contas ficam em arrays contíguos (array.array) indexados pelo slot da conta;
+a checagem soma 45 posições e não consulta o banco.
+
+Os limites são por tipo de conta (RISK_LIMITS_CHECKING, RISK_LIMITS_SAVINGS)
+no formato "1m=10/5000,1h=60/20000,24h=200/50000": quantidade/valor em reais
+por janela; uma parte vazia desliga aquele limite.
+
+O motor é montado quando o processo sobe (post_fork do gunicorn, lifespan
+do modo ASGI; em outros servidores, a partir do primeiro débito), numa
+thread própria, com os débitos das últimas 25 horas (índice
+ix_transactions_created). A mesma thread, a cada RISK_SYNC_SECONDS, lê as
+transações gravadas por outros processos: ids acima do maior já visto e os
+ids que ficaram para trás por transações ainda abertas. As requisições só
+leem os arrays; enquanto a montagem não termina, esperam até
+RISK_READY_TIMEOUT segundos. Entre duas leituras, débitos em outros workers
+passam sem ser vistos; RISK_SYNC_SECONDS=0 considera só os débitos do
+próprio processo.
+
+Memória por conta com débito nas últimas 24 horas: 45 fatias × 12 bytes
+(centavos em int64 e quantidade em uint32) e 3 marcas de 8 bytes, 564 bytes
+nos arrays, mais a entrada conta -> slot do dicionário (~150 bytes): cerca de
+0,7 GB por milhão de contas ativas (medido em benchmarks/bench_risk.py).
+O tipo de cada conta ocupa 1 byte por id, 1 MB por milhão de contas. Slots
+de contas sem débito há mais de 24 horas são reaproveitados.
+"""
+import logging
+import os
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from flask import current_app
+from sqlalchemy import func, or_, select
+from models import Account, Transaction
+import metrics
+from app import db
+
+DEBIT_TYPES = ('withdrawal', 'transfer')
+# (name, length, slice width) in seconds
+WINDOWS = (('1m', 60, 10), ('1h', 3600, 300), ('24h', 86400, 3600))
+SIZES = tuple(length // width + 1 for _, length, width in WINDOWS)
+OFFSETS = tuple(sum(SIZES[:i]) for i in range(len(WINDOWS)))
+SLICES = sum(SIZES)
+HISTORY = timedelta(seconds=max(length + width for _, length, width in WINDOWS))
+# Ids skipped by a sync are asked for again for this long (transactions still open)
+HOLE_SECONDS = 60
+MAX_HOLES = 10000
+SWEEP_SECONDS = 3600
+EPOCH = datetime(1970, 1, 1)
+# Pause before retrying a failed rebuild or sync
+RETRY_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+_ZERO_AMOUNTS = tuple(array('q', bytes(8 * size)) for size in SIZES)
+_ZERO_COUNTS = tuple(array('I', bytes(4 * size)) for size in SIZES)
+_ZERO_SLOT = (array('q', bytes(8 * SLICES)), array('I', bytes(4 * SLICES)), array('q', bytes(8 * len(WINDOWS))))
+
+
+def to_cents(amount) -> int:
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def parse_limits(spec: str) -> Tuple[Tuple[int, int], ...]:
+    """'1m=10/5000,24h=/20000' -> (quantidade, centavos) por janela de WINDOWS; 0 desliga"""
+    limits = {name: (0, 0) for name, _, _ in WINDOWS}
+    for part in filter(None, (part.strip() for part in (spec or '').split(','))):
+        name, _, value = part.partition('=')
+        count, _, amount = value.partition('/')
+        try:
+            if name not in limits or (count and not count.isdigit()):
+                raise ValueError(part)
+            limits[name] = (int(count or 0), to_cents(amount) if amount else 0)
+        except (ValueError, ArithmeticError):
+            raise ValueError(f"Limite inválido {part!r}; use janela=quantidade/valor com janelas 1m, 1h e 24h")
+    return tuple(limits[name] for name, _, _ in WINDOWS)
+
+
+def debit_columns():
+    return select(Transaction.id, Transaction.account_id, Transaction.transaction_type,
+                  Transaction.amount, Transaction.created_at, Account.account_type
+                  ).join(Account, Account.id == Transaction.account_id)
+
+
+def rebuild_statement(now: datetime):
+    return debit_columns().where(Transaction.created_at >= now - HISTORY,
+                                 Transaction.transaction_type.in_(DEBIT_TYPES))
+
+
+def max_id_statement():
+    return select(func.max(Transaction.id))
+
+
+def sync_statement(after_id: int, holes: Iterable[int]):
+    # Every type is read: an id missing from the answer is a transaction not yet committed
+    condition = Transaction.id > after_id
+    holes = sorted(holes)
+    if holes:
+        condition = or_(condition, Transaction.id.in_(holes))
+    return debit_columns().where(condition)
+
+
+def account_type_statement(account_id: int):
+    return select(Account.account_type).where(Account.id == account_id)
+
+
+class Reservation:
+    """Débito já contado nas janelas; desfeito se a transação não for gravada"""
+    __slots__ = ('engine', 'account_id', 'at', 'cents')
+
+    def __init__(self, engine, account_id: int, at: float, cents: int):
+        self.engine = engine
+        self.account_id = account_id
+        self.at = at
+        self.cents = cents
+
+    def release(self) -> None:
+        if self.engine is not None:
+            self.engine.release(self)
+            self.engine = None
+
+    def confirm(self, transaction_id: int) -> None:
+        if self.engine is not None:
+            self.engine.confirm(self, transaction_id)
+            self.engine = None
+
+
+NO_RESERVATION = Reservation(None, 0, 0.0, 0)
+
+
+class RiskEngine:
+    """Janelas de débito de todas as contas em arrays compactos; seguro entre threads"""
+
+    def __init__(self, limits: Dict[str, str], sync_seconds: float = 1.0):
+        self.limits = {account_type: parse_limits(spec) for account_type, spec in limits.items()}
+        self.sync_seconds = sync_seconds
+        self.ready = False
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        # Account type per account id: code into _type_limits, 0 while unknown
+        self._types = bytearray()
+        self._type_codes: Dict[str, int] = {}
+        self._type_limits: List[Optional[tuple]] = [None]
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+        self._amounts = array('q')
+        self._counts = array('I')
+        self._marks = array('q')
+        self._max_id = 0
+        self._holes: Dict[int, float] = {}
+        self._own: set = set()
+        self._applied: Dict[int, float] = {}
+        self._swept = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    # Slot layout: SLICES amounts and counts, one mark per window (newest slice index)
+
+    def _slot(self, account_id: int) -> int:
+        slot = self._slots.get(account_id)
+        if slot is None:
+            if self._free:
+                # A freed slot is more than 24h old: the next advance clears it
+                slot = self._free.pop()
+            else:
+                slot = len(self._marks) // len(WINDOWS)
+                self._amounts.extend(_ZERO_SLOT[0])
+                self._counts.extend(_ZERO_SLOT[1])
+                self._marks.extend(_ZERO_SLOT[2])
+            self._slots[account_id] = slot
+        return slot
+
+    def _advance(self, slot: int, window: int, index: int) -> int:
+        """Gira o anel até a fatia `index`; devolve a posição do anel no array"""
+        base = slot * SLICES + OFFSETS[window]
+        mark = slot * len(WINDOWS) + window
+        last, size = self._marks[mark], SIZES[window]
+        if index > last:
+            if index - last >= size:
+                self._amounts[base:base + size] = _ZERO_AMOUNTS[window]
+                self._counts[base:base + size] = _ZERO_COUNTS[window]
+            else:
+                for i in range(last + 1, index + 1):
+                    self._amounts[base + i % size] = 0
+                    self._counts[base + i % size] = 0
+            self._marks[mark] = index
+        return base
+
+    def _add(self, slot: int, at: float, cents: int, count: int) -> None:
+        for window, (_, _, width) in enumerate(WINDOWS):
+            index = int(at // width)
+            base = self._advance(slot, window, index)
+            if index > self._marks[slot * len(WINDOWS) + window] - SIZES[window]:
+                position = base + index % SIZES[window]
+                self._amounts[position] += cents
+                self._counts[position] += count
+
+    def _code(self, account_type: str) -> int:
+        code = self._type_codes.get(account_type)
+        if code is None:
+            limits = self.limits.get(account_type)
+            code = self._type_codes[account_type] = len(self._type_limits)
+            self._type_limits.append(limits if limits and any(c or a for c, a in limits) else None)
+        return code
+
+    def _set_type(self, account_id: int, account_type: str) -> None:
+        if account_id >= len(self._types):
+            self._types.extend(bytes(account_id + 1 - len(self._types)))
+        self._types[account_id] = self._code(account_type)
+
+    def _apply(self, row) -> None:
+        transaction_id, account_id, transaction_type, amount, created_at, account_type = row
+        self._set_type(account_id, account_type)
+        if transaction_type in DEBIT_TYPES and self._type_limits[self._types[account_id]] is not None:
+            self._add(self._slot(account_id), (created_at - EPOCH).total_seconds(), to_cents(amount), 1)
+
+    def knows(self, account_id: int) -> bool:
+        return account_id < len(self._types) and self._types[account_id] != 0
+
+    def set_account_type(self, account_id: int, account_type: str) -> None:
+        with self._lock:
+            self._set_type(account_id, account_type)
+
+    def totals(self, account_id: int, now: Optional[float] = None) -> Dict[str, Tuple[int, int]]:
+        """(quantidade, centavos) debitados por janela"""
+        now = time.time() if now is None else now
+        with self._lock:
+            slot = self._slots.get(account_id)
+            result = {}
+            for window, (name, _, width) in enumerate(WINDOWS):
+                if slot is None:
+                    result[name] = (0, 0)
+                    continue
+                base = self._advance(slot, window, int(now // width))
+                end = base + SIZES[window]
+                result[name] = (sum(self._counts[base:end]), sum(self._amounts[base:end]))
+        return result
+
+    def reserve(self, account_id: int, amount, now: Optional[float] = None) -> Tuple[Optional[str], Reservation]:
+        """Checa o débito contra os limites do tipo da conta e o conta nas janelas.
+
+        Devolve (janela excedida, NO_RESERVATION) ou (None, reserva).
+        """
+        now = time.time() if now is None else now
+        cents = to_cents(amount)
+        with self._lock:
+            limits = self._type_limits[self._types[account_id] if account_id < len(self._types) else 0]
+            if limits is None:
+                return None, NO_RESERVATION
+            slot = self._slot(account_id)
+            for window, (name, _, width) in enumerate(WINDOWS):
+                max_count, max_cents = limits[window]
+                if not (max_count or max_cents):
+                    continue
+                base = self._advance(slot, window, int(now // width))
+                end = base + SIZES[window]
+                if max_count and sum(self._counts[base:end]) >= max_count:
+                    return name, NO_RESERVATION
+                if max_cents and sum(self._amounts[base:end]) + cents > max_cents:
+                    return name, NO_RESERVATION
+            self._add(slot, now, cents, 1)
+        return None, Reservation(self, account_id, now, cents)
+
+    def release(self, reservation: Reservation) -> None:
+        with self._lock:
+            slot = self._slots.get(reservation.account_id)
+            if slot is not None:
+                self._add(slot, reservation.at, -reservation.cents, -1)
+
+    def confirm(self, reservation: Reservation, transaction_id: int) -> None:
+        if not self.sync_seconds:
+            return
+        with self._lock:
+            if transaction_id in self._applied:
+                # A sync in another thread already counted the committed row
+                slot = self._slots.get(reservation.account_id)
+                if slot is not None:
+                    self._add(slot, reservation.at, -reservation.cents, -1)
+            else:
+                self._own.add(transaction_id)
+
+    def load(self, rows, max_id: Optional[int]) -> None:
+        """Monta as janelas com os débitos de rebuild_statement; ignorado se outra thread já montou"""
+        with self._lock:
+            if self.ready:
+                return
+            for row in rows:
+                self._apply(row)
+            self._max_id = max_id or 0
+            self.ready = True
+            self._loaded.set()
+
+    def wait_ready(self, timeout: float) -> bool:
+        return self._loaded.wait(timeout)
+
+    def sync_statement(self):
+        with self._lock:
+            return sync_statement(self._max_id, self._holes)
+
+    def sync(self, rows) -> None:
+        """Aplica as transações lidas com sync_statement"""
+        now = time.monotonic()
+        with self._lock:
+            previous, seen = self._max_id, set()
+            for row in rows:
+                transaction_id = row[0]
+                seen.add(transaction_id)
+                self._holes.pop(transaction_id, None)
+                if transaction_id in self._own:
+                    self._own.discard(transaction_id)
+                elif transaction_id not in self._applied:
+                    self._applied[transaction_id] = now
+                    self._apply(row)
+            top = max(seen, default=previous)
+            if top > previous:
+                if top - previous <= MAX_HOLES:
+                    self._holes.update((i, now) for i in range(previous + 1, top) if i not in seen)
+                self._max_id = top
+            for recent in (self._holes, self._applied):
+                for transaction_id in [i for i, at in recent.items() if now - at > HOLE_SECONDS]:
+                    del recent[transaction_id]
+            if now - self._swept > SWEEP_SECONDS:
+                self._sweep()
+
+    def _sweep(self) -> None:
+        """Libera os slots de contas sem débito dentro da maior janela"""
+        window = len(WINDOWS) - 1
+        current = int(time.time() // WINDOWS[window][2])
+        for account_id, slot in list(self._slots.items()):
+            if current - self._marks[slot * len(WINDOWS) + window] >= SIZES[window]:
+                del self._slots[account_id]
+                self._free.append(slot)
+        self._swept = time.monotonic()
+
+
+def get_risk_engine(app) -> Optional[RiskEngine]:
+    if not app.config.get('RISK_ENABLED'):
+        return None
+    engine = app.extensions.get('risk')
+    if engine is None:
+        engine = app.extensions.setdefault(
+            'risk', RiskEngine(app.config.get('RISK_LIMITS', {}), app.config.get('RISK_SYNC_SECONDS', 1.0)))
+    return engine
+
+
+_start_lock = threading.Lock()
+
+
+def start_in_thread(app) -> None:
+    """Monta as janelas e as mantém sincronizadas numa thread daemon; uma por processo e motor"""
+    engine = get_risk_engine(app)
+    if engine is None:
+        return
+    with _start_lock:
+        # Forked workers do not inherit the parent's thread
+        if engine._thread_pid == os.getpid():
+            return
+        engine._thread_pid = os.getpid()
+    threading.Thread(target=_maintain, args=(app, engine), name='risk-sync', daemon=True).start()
+
+
+def _maintain(app, engine: RiskEngine) -> None:
+    with app.app_context():
+        # Ends when the engine is replaced (tests, reconfiguration)
+        while app.extensions.get('risk') is engine:
+            try:
+                if not engine.ready:
+                    rows = db.session.execute(rebuild_statement(datetime.utcnow())).all()
+                    engine.load(rows, db.session.scalar(max_id_statement()))
+                elif engine.sync_seconds:
+                    engine.sync(db.session.execute(engine.sync_statement()).all())
+                else:
+                    return
+                pause = engine.sync_seconds
+            except Exception:
+                logger.exception('Falha ao atualizar as janelas de débito')
+                pause = RETRY_SECONDS
+            finally:
+                db.session.remove()
+            time.sleep(pause)
+
+
+def ensure_ready(app, engine: RiskEngine) -> bool:
+    """Garante a thread de montagem e espera as janelas; False se não ficaram prontas a tempo"""
+    if engine.ready:
+        return True
+    start_in_thread(app)
+    return engine.wait_ready(app.config.get('RISK_READY_TIMEOUT', 10))
+
+
+NOT_READY = "Limites de débito ainda em carga; tente novamente em instantes"
+
+
+def refusal(window: str) -> str:
+    metrics.registry.record_risk_rejection(window)
+    return f"Limite de débitos da conta excedido (janela de {window})"
+
+
+def check_debit(account_id: int, amount: Decimal) -> Tuple[Optional[str], Reservation]:
+    """Checa um débito pela sessão atual; devolve (mensagem de recusa, reserva)"""
+    engine = get_risk_engine(current_app)
+    if engine is None:
+        return None, NO_RESERVATION
+    # The windows are built and synced by the risk-sync thread; requests only read them
+    if not ensure_ready(current_app._get_current_object(), engine):
+        return NOT_READY, NO_RESERVATION
+    if not engine.knows(account_id):
+        account_type = db.session.scalar(account_type_statement(account_id))
+        if account_type is None:
+            return None, NO_RESERVATION
+        engine.set_account_type(account_id, account_type)
+    window, reservation = engine.reserve(account_id, amount)
+    return (refusal(window) if window else None), reservation
@@ -1,13 +1,28 @@
+from flask import Response, current_app, request, stream_with_context
 from flask_restx import Resource, Namespace, fields
 from flask_jwt_extended import (
     create_access_token, jwt_required, get_jwt_identity
 )
-from werkzeug.exceptions import BadRequest, NotFound, Unauthorized
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable, TooManyRequests, Unauthorized
 from models import User, Account, Transaction
-from schemas import UserSchema, LoginSchema, AccountSchema, TransactionSchema
-from storage import storage
-from utils import hash_password, verify_password, process_transaction
+from schemas import UserSchema, LoginSchema, AccountSchema, TransactionSchema, RecurringTransferSchema
+from batch import process_batch
+from account_numbers import allocate_account_number
+from idempotency import idempotent, stage
+from database import read_replica
+from ratelimit import rate_limited
+from identity import identity_claims, owns_account
+from storage import storage, DEFAULT_PAGE_SIZE
+from utils import hash_password, process_transaction
+from app import db
+from snapshots import build_statement
+from export import FORMATS as EXPORT_FORMATS, stream_csv, stream_ndjson, stream_ofx
+from analytics import GRAINS, flow_summary, user_account_ids
+from search import search_statement
+from recurring import FREQUENCIES, account_recurring, cancel_recurring, create_recurring
+from datetime import date, datetime, time, timedelta
 from decimal import Decimal
+from sqlalchemy.exc import SQLAlchemyError
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,13 +32,15 @@ def initialize_routes(api):
     auth_ns = api.namespace('auth', description='Operações de autenticação')
     account_ns = api.namespace('accounts', description='Operações de conta')
     transaction_ns = api.namespace('transactions', description='Operações de transação')
+    analytics_ns = api.namespace('analytics', description='Agregados de movimentação')
 
     # Add namespaces explicitly to the API
     api.add_namespace(auth_ns)
     api.add_namespace(account_ns)
     api.add_namespace(transaction_ns)
+    api.add_namespace(analytics_ns)
 
-    logger.info("Namespaces registrados: auth, accounts, transactions")
+    logger.info("Namespaces registrados: auth, accounts, transactions, analytics")
 
     # Define models for swagger documentation
     user_model = api.model('User', {
@@ -51,8 +68,60 @@ def initialize_routes(api):
         'to_account_id': fields.String(required=False, description='ID da conta de destino (para transferências)')
     })
 
+    recurring_model = api.model('RecurringTransfer', {
+        'to_account_id': fields.String(required=True, description='Número da conta de destino'),
+        'amount': fields.Float(required=True, description='Valor de cada transferência'),
+        'description': fields.String(required=True, description='Descrição das transferências'),
+        'frequency': fields.String(required=True, description='Frequência', enum=list(FREQUENCIES)),
+        'start_at': fields.DateTime(required=False, description='Primeira execução (UTC), padrão: agora'),
+        'end_at': fields.DateTime(required=False, description='Última data permitida (UTC)')
+    })
+
+    batch_operation_model = api.inherit('BatchOperation', transaction_model, {
+        'account_id': fields.Integer(required=True, description='ID da conta de origem')
+    })
+
+    batch_model = api.model('TransactionBatch', {
+        'operations': fields.List(fields.Nested(batch_operation_model), required=True,
+                                  description='Operações, processadas na ordem enviada')
+    })
+
+    idempotency_header = {
+        'Idempotency-Key': {
+            'in': 'header',
+            'description': 'Chave única da operação; reenvios com a mesma chave devolvem a resposta original'
+        }
+    }
+
+    analytics_params = {
+        'grain': f"Período: {', '.join(GRAINS)} (padrão month)",
+        'from': 'Data inicial (AAAA-MM-DD), padrão: um ano antes de `to`',
+        'to': 'Data final (AAAA-MM-DD), padrão: hoje'
+    }
+
+    def analytics_range():
+        grain = request.args.get('grain', 'month')
+        end = date.fromisoformat(request.args['to']) if 'to' in request.args else datetime.utcnow().date()
+        start = (date.fromisoformat(request.args['from']) if 'from' in request.args
+                 else end - timedelta(days=365))
+        if start > end:
+            raise BadRequest('A data inicial deve ser anterior à final')
+        if grain == 'day' and (end - start).days >= current_app.config['ANALYTICS_MAX_DAYS']:
+            raise BadRequest(f"Máximo de {current_app.config['ANALYTICS_MAX_DAYS']} dias por consulta diária")
+        return grain, start, end
+
+    def require_account(account_id, user_id):
+        """404 se a conta não for do usuário; decide pelas claims do token quando estão atualizadas"""
+        owned = owns_account(user_id, account_id)
+        if owned is None:
+            account = storage.get_account(account_id)
+            owned = account is not None and str(account.user_id) == str(user_id)
+        if not owned:
+            raise NotFound('Conta não encontrada')
+
     @auth_ns.route('/register')
     class Register(Resource):
+        @rate_limited('auth')
         @api.expect(user_model)
         @api.response(201, 'Usuário registrado com sucesso')
         @api.response(400, 'Dados inválidos')
@@ -72,10 +141,13 @@ def initialize_routes(api):
                 return {'message': 'Usuário registrado com sucesso'}, 201
             except Exception as e:
                 logger.error(f"Erro no registro: {str(e)}")
+                if isinstance(e, (TooManyRequests, ServiceUnavailable)):
+                    raise
                 raise BadRequest(str(e))
 
     @auth_ns.route('/login')
     class Login(Resource):
+        @rate_limited('auth')
         @api.expect(login_model)
         @api.response(200, 'Login realizado com sucesso')
         @api.response(401, 'Credenciais inválidas')
@@ -84,18 +156,23 @@ def initialize_routes(api):
                 data = LoginSchema().load(api.payload)
                 user = storage.get_user_by_username(data['username'])
 
-                if not user or not verify_password(user.password_hash, data['password']):
+                if not user or not user.check_password(data['password']):
                     raise Unauthorized('Credenciais inválidas')
+                db.session.commit()
 
-                access_token = create_access_token(identity=user.id)
+                access_token = create_access_token(identity=str(user.id),
+                                                   additional_claims=identity_claims(user.id))
                 return {'access_token': access_token}, 200
             except Exception as e:
                 logger.error(f"Erro no login: {str(e)}")
+                if isinstance(e, (TooManyRequests, ServiceUnavailable)):
+                    raise
                 raise Unauthorized(str(e))
 
     @account_ns.route('')
     class AccountList(Resource):
         @jwt_required()
+        @rate_limited('write')
         @api.expect(account_model)
         @api.response(201, 'Conta criada com sucesso')
         @api.response(400, 'Dados inválidos')
@@ -105,18 +182,27 @@ def initialize_routes(api):
                 data = AccountSchema().load(api.payload)
 
                 account = Account(
-                    id='',  # Will be set by storage
-                    user_id=user_id,
+                    account_number=allocate_account_number(),
+                    user_id=int(user_id),
                     balance=Decimal('0'),
                     account_type=data['account_type']
                 )
                 storage.create_account(account)
-                return {'message': 'Conta criada com sucesso', 'account_id': account.id}, 201
+                # The new account bumped the version: this token carries the current list
+                access_token = create_access_token(identity=user_id,
+                                                   additional_claims=identity_claims(int(user_id)))
+                return {
+                    'message': 'Conta criada com sucesso',
+                    'account_id': account.id,
+                    'access_token': access_token
+                }, 201
             except Exception as e:
                 logger.error(f"Erro na criação da conta: {str(e)}")
                 raise BadRequest(str(e))
 
         @jwt_required()
+        @rate_limited('read')
+        @read_replica
         @api.response(200, 'Lista de contas')
         def get(self):
             try:
@@ -134,14 +220,16 @@ def initialize_routes(api):
     @account_ns.route('/<int:account_id>')
     class AccountResource(Resource):
         @jwt_required()
+        @rate_limited('read')
         @api.response(200, 'Conta encontrada')
         @api.response(404, 'Conta não encontrada')
         def get(self, account_id):
             try:
                 user_id = get_jwt_identity()
+                require_account(account_id, user_id)
                 account = storage.get_account(account_id)
 
-                if not account or str(account.user_id) != user_id:
+                if not account:
                     raise NotFound('Conta não encontrada')
 
                 return {
@@ -155,47 +243,169 @@ def initialize_routes(api):
                     raise
                 raise BadRequest(str(e))
 
+    @account_ns.route('/<int:account_id>/statement')
+    class AccountStatement(Resource):
+        @jwt_required()
+        @rate_limited('read')
+        @api.doc(params={
+            'from': 'Data inicial (AAAA-MM-DD), padrão: início do mês de `to`',
+            'to': 'Data final (AAAA-MM-DD), padrão: hoje'
+        })
+        @api.response(200, 'Extrato do período')
+        @api.response(404, 'Conta não encontrada')
+        def get(self, account_id):
+            try:
+                user_id = get_jwt_identity()
+                account = storage.get_account(account_id)
+
+                if not account or str(account.user_id) != str(user_id):
+                    raise NotFound('Conta não encontrada')
+
+                end = date.fromisoformat(request.args['to']) if 'to' in request.args else datetime.utcnow().date()
+                start = (date.fromisoformat(request.args['from']) if 'from' in request.args
+                         else end.replace(day=1))
+                if start > end:
+                    raise BadRequest('A data inicial deve ser anterior à final')
+
+                return build_statement(account.id, start, end), 200
+            except Exception as e:
+                logger.error(f"Erro ao gerar extrato: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
+    def serialize_recurring(recurring, to_account_number):
+        return {
+            'id': recurring.id,
+            'to_account_id': to_account_number,
+            'amount': str(recurring.amount),
+            'description': recurring.description,
+            'frequency': recurring.frequency,
+            'next_run_at': recurring.next_run_at.isoformat(),
+            'end_at': recurring.end_at.isoformat() if recurring.end_at else None,
+            'last_status': recurring.last_status,
+            'last_message': recurring.last_message
+        }
+
+    @account_ns.route('/<int:account_id>/recurring')
+    class RecurringTransferList(Resource):
+        @jwt_required()
+        @rate_limited('write')
+        @api.expect(recurring_model)
+        @api.response(201, 'Transferência programada criada')
+        @api.response(400, 'Dados inválidos')
+        @api.response(404, 'Conta não encontrada')
+        def post(self, account_id):
+            try:
+                user_id = get_jwt_identity()
+                account = storage.get_account(account_id)
+
+                if not account or str(account.user_id) != user_id:
+                    raise NotFound('Conta não encontrada')
+
+                data = RecurringTransferSchema().load(api.payload)
+                recurring = create_recurring(
+                    account,
+                    data['to_account_id'],
+                    Decimal(str(data['amount'])),
+                    data['description'],
+                    data['frequency'],
+                    data.get('start_at'),
+                    data.get('end_at')
+                )
+                return serialize_recurring(recurring, data['to_account_id']), 201
+            except Exception as e:
+                logger.error(f"Erro ao programar transferência: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
+        @jwt_required()
+        @rate_limited('read')
+        @api.response(200, 'Transferências programadas ativas da conta')
+        @api.response(404, 'Conta não encontrada')
+        def get(self, account_id):
+            try:
+                user_id = get_jwt_identity()
+                account = storage.get_account(account_id)
+
+                if not account or str(account.user_id) != user_id:
+                    raise NotFound('Conta não encontrada')
+
+                return [serialize_recurring(recurring, number)
+                        for recurring, number in account_recurring(account.id)], 200
+            except Exception as e:
+                logger.error(f"Erro ao listar transferências programadas: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
+    @account_ns.route('/<int:account_id>/recurring/<int:recurring_id>')
+    class RecurringTransferResource(Resource):
+        @jwt_required()
+        @rate_limited('write')
+        @api.response(204, 'Transferência programada cancelada')
+        @api.response(404, 'Transferência programada não encontrada')
+        def delete(self, account_id, recurring_id):
+            try:
+                user_id = get_jwt_identity()
+                account = storage.get_account(account_id)
+
+                if not account or str(account.user_id) != user_id:
+                    raise NotFound('Conta não encontrada')
+                if not cancel_recurring(account.id, recurring_id):
+                    raise NotFound('Transferência programada não encontrada')
+                return '', 204
+            except Exception as e:
+                logger.error(f"Erro ao cancelar transferência programada: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
     @transaction_ns.route('/<int:account_id>')
     class TransactionResource(Resource):
         @jwt_required()
+        @rate_limited('write')
+        @idempotent
+        @api.doc(params=idempotency_header)
         @api.expect(transaction_model)
         @api.response(200, 'Transação realizada com sucesso')
         @api.response(400, 'Dados inválidos ou saldo insuficiente')
+        @api.response(503, 'Banco de dados indisponível; nada foi aplicado')
         @api.response(404, 'Conta não encontrada')
         def post(self, account_id):
             try:
                 user_id = get_jwt_identity()
-                account = storage.get_account(account_id)
-
-                if not account or str(account.user_id) != user_id:
-                    raise NotFound('Conta não encontrada')
+                require_account(account_id, user_id)
+                # Only the id is needed; the new balance comes back from the update
+                account = storage.account_reference(account_id)
 
                 data = TransactionSchema().load(api.payload)
-                success, message = process_transaction(
+                response = {}
+
+                def respond(transaction, message, balances):
+                    response.update(message=message, transaction_id=transaction.id,
+                                    new_balance=str(balances[account.id]))
+                    # The idempotency key completes in the same commit as the transaction
+                    stage(response, 200)
+
+                success, message, _ = process_transaction(
                     account,
                     data['transaction_type'],
                     Decimal(str(data['amount'])),
                     data['description'],
-                    data.get('to_account_id')
+                    data.get('to_account_id'),
+                    before_commit=respond
                 )
 
                 if not success:
                     raise BadRequest(message)
 
-                transaction = Transaction(
-                    account_id=account_id,
-                    transaction_type=data['transaction_type'],
-                    amount=Decimal(str(data['amount'])),
-                    description=data['description'],
-                    to_account_id=data.get('to_account_id')
-                )
-                storage.create_transaction(transaction)
-
-                return {
-                    'message': message,
-                    'transaction_id': transaction.id,
-                    'new_balance': str(account.balance)
-                }, 200
+                return response, 200
+            except SQLAlchemyError as e:
+                # Nothing was applied; a 5xx releases the idempotency key for the retry
+                logger.error(f"Erro do banco na transação: {str(e)}")
+                raise ServiceUnavailable('Banco de dados indisponível no momento; tente novamente')
             except Exception as e:
                 logger.error(f"Erro na transação: {str(e)}")
                 if isinstance(e, NotFound):
@@ -203,17 +413,25 @@ def initialize_routes(api):
                 raise BadRequest(str(e))
 
         @jwt_required()
+        @rate_limited('read')
+        @read_replica
+        @api.doc(params={
+            'limit': f'Quantidade de transações por página (padrão {DEFAULT_PAGE_SIZE})',
+            'cursor': 'Cursor retornado no cabeçalho X-Next-Cursor da página anterior'
+        })
         @api.response(200, 'Lista de transações')
         @api.response(404, 'Conta não encontrada')
         def get(self, account_id):
             try:
                 user_id = get_jwt_identity()
-                account = storage.get_account(account_id)
-
-                if not account or account.user_id != user_id:
-                    raise NotFound('Conta não encontrada')
+                require_account(account_id, user_id)
 
-                transactions = storage.get_account_transactions(account_id)
+                transactions, next_cursor = storage.get_account_transactions(
+                    account_id,
+                    limit=request.args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+                    cursor=request.args.get('cursor')
+                )
+                headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
                 return [{
                     'id': t.id,
                     'type': t.transaction_type,
@@ -221,14 +439,207 @@ def initialize_routes(api):
                     'description': t.description,
                     'created_at': t.created_at.isoformat(),
                     'to_account_id': t.to_account_id
-                } for t in transactions], 200
+                } for t in transactions], 200, headers
             except Exception as e:
                 logger.error(f"Erro na listagem de transações: {str(e)}")
                 if isinstance(e, NotFound):
                     raise
                 raise BadRequest(str(e))
 
-    # Log registered routes
-    logger.info("Rotas registradas:")
-    for rule in api.app.url_map.iter_rules():
-        logger.info(f"  {rule.endpoint}: {rule.rule}")
\ No newline at end of file
+    @transaction_ns.route('/search')
+    class TransactionSearch(Resource):
+        @jwt_required()
+        @rate_limited('read')
+        @read_replica
+        @api.doc(params={
+            'q': 'Palavras da descrição (todas precisam aparecer; aceita início de palavra)',
+            'account_id': 'Restringe a uma conta do usuário',
+            'type': 'deposit, withdrawal ou transfer',
+            'min_amount': 'Valor mínimo',
+            'max_amount': 'Valor máximo',
+            'from': 'Data inicial (AAAA-MM-DD)',
+            'to': 'Data final (AAAA-MM-DD)',
+            'counterparty': 'Número da conta do outro lado da transferência',
+            'limit': f'Quantidade de transações por página (padrão {DEFAULT_PAGE_SIZE})',
+            'cursor': 'Cursor retornado no cabeçalho X-Next-Cursor da página anterior'
+        })
+        @api.response(200, 'Transações encontradas, mais recentes primeiro')
+        @api.response(404, 'Conta não encontrada')
+        def get(self):
+            try:
+                user_id = get_jwt_identity()
+                args = request.args
+                if 'account_id' in args:
+                    account = storage.get_account(args.get('account_id', type=int) or 0)
+                    if not account or str(account.user_id) != str(user_id):
+                        raise NotFound('Conta não encontrada')
+                    account_ids = [account.id]
+                else:
+                    account_ids = [account.id for account in storage.get_user_accounts(user_id)]
+
+                counterparty_id = None
+                if 'counterparty' in args:
+                    counterparty = storage.get_account_by_number(args['counterparty'])
+                    if counterparty is None:
+                        return [], 200
+                    counterparty_id = counterparty.id
+                if not account_ids:
+                    return [], 200
+
+                stmt, limit = search_statement(
+                    account_ids,
+                    limit=args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+                    cursor=args.get('cursor'),
+                    query=args.get('q'),
+                    transaction_type=args.get('type'),
+                    min_amount=Decimal(args['min_amount']) if 'min_amount' in args else None,
+                    max_amount=Decimal(args['max_amount']) if 'max_amount' in args else None,
+                    start=(datetime.combine(date.fromisoformat(args['from']), time.min)
+                           if 'from' in args else None),
+                    end=(datetime.combine(date.fromisoformat(args['to']) + timedelta(days=1), time.min)
+                         if 'to' in args else None),
+                    counterparty_id=counterparty_id
+                )
+                transactions, next_cursor = storage.split_page(db.session.scalars(stmt).all(), limit)
+                headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+                return [{
+                    'id': t.id,
+                    'account_id': t.account_id,
+                    'type': t.transaction_type,
+                    'amount': str(t.amount),
+                    'description': t.description,
+                    'created_at': t.created_at.isoformat(),
+                    'to_account_id': t.to_account_id
+                } for t in transactions], 200, headers
+            except Exception as e:
+                logger.error(f"Erro na busca de transações: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
+    @transaction_ns.route('/<int:account_id>/export')
+    class TransactionExport(Resource):
+        @jwt_required()
+        @rate_limited('read')
+        @read_replica
+        @api.doc(params={
+            'format': 'csv (padrão), ndjson ou ofx',
+            'from': 'Data inicial (AAAA-MM-DD), opcional',
+            'to': 'Data final (AAAA-MM-DD), opcional'
+        })
+        @api.response(200, 'Histórico completo, enviado em partes')
+        @api.response(404, 'Conta não encontrada')
+        def get(self, account_id):
+            try:
+                user_id = get_jwt_identity()
+                account = storage.get_account(account_id)
+
+                if not account or str(account.user_id) != str(user_id):
+                    raise NotFound('Conta não encontrada')
+
+                export_format = request.args.get('format', 'csv')
+                if export_format not in EXPORT_FORMATS:
+                    raise BadRequest('Formato inválido; use csv, ndjson ou ofx')
+                start = (datetime.combine(date.fromisoformat(request.args['from']), time.min)
+                         if 'from' in request.args else None)
+                end = (datetime.combine(date.fromisoformat(request.args['to']) + timedelta(days=1), time.min)
+                       if 'to' in request.args else None)
+            except Exception as e:
+                logger.error(f"Erro na exportação de transações: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
+            if export_format == 'csv':
+                rows = stream_csv(account.id, start, end)
+            elif export_format == 'ndjson':
+                rows = stream_ndjson(account.id, start, end)
+            else:
+                rows = stream_ofx(account, start, end)
+            mimetype, extension = EXPORT_FORMATS[export_format]
+            return Response(
+                stream_with_context(rows),
+                mimetype=mimetype,
+                headers={
+                    'Content-Disposition': f'attachment; filename=conta-{account.account_number}.{extension}'
+                }
+            )
+
+    @analytics_ns.route('/accounts/<int:account_id>')
+    class AccountAnalytics(Resource):
+        @jwt_required()
+        @rate_limited('read')
+        @read_replica
+        @api.doc(params=analytics_params)
+        @api.response(200, 'Entradas, saídas, contagens e saldo líquido por período')
+        @api.response(404, 'Conta não encontrada')
+        def get(self, account_id):
+            try:
+                user_id = get_jwt_identity()
+                account = storage.get_account(account_id)
+
+                if not account or str(account.user_id) != str(user_id):
+                    raise NotFound('Conta não encontrada')
+
+                grain, start, end = analytics_range()
+                return dict(flow_summary([account.id], grain, start, end), account_id=account.id), 200
+            except Exception as e:
+                logger.error(f"Erro nos agregados da conta: {str(e)}")
+                if isinstance(e, NotFound):
+                    raise
+                raise BadRequest(str(e))
+
+    @analytics_ns.route('/summary')
+    class UserAnalytics(Resource):
+        @jwt_required()
+        @rate_limited('read')
+        @read_replica
+        @api.doc(params=analytics_params)
+        @api.response(200, 'Agregados somando todas as contas do usuário')
+        def get(self):
+            try:
+                user_id = int(get_jwt_identity())
+                grain, start, end = analytics_range()
+                return dict(flow_summary(user_account_ids(user_id), grain, start, end), user_id=user_id), 200
+            except Exception as e:
+                logger.error(f"Erro nos agregados do usuário: {str(e)}")
+                raise BadRequest(str(e))
+
+    @transaction_ns.route('/batch')
+    class TransactionBatch(Resource):
+        @jwt_required()
+        @rate_limited('write')
+        @idempotent
+        @api.doc(params=idempotency_header)
+        @api.expect(batch_model)
+        @api.response(200, 'Lote processado; veja o resultado de cada operação')
+        @api.response(400, 'Dados inválidos')
+        def post(self):
+            try:
+                user_id = int(get_jwt_identity())
+                operations = (api.payload or {}).get('operations')
+                if not isinstance(operations, list) or not operations:
+                    raise BadRequest('Informe a lista de operações')
+                if len(operations) > current_app.config['BATCH_MAX_OPERATIONS']:
+                    raise BadRequest(
+                        f"Máximo de {current_app.config['BATCH_MAX_OPERATIONS']} operações por lote"
+                    )
+
+                def summary(results):
+                    succeeded = sum(1 for r in results if r['success'])
+                    return {
+                        'succeeded': succeeded,
+                        'failed': len(results) - succeeded,
+                        'results': results
+                    }
+
+                results = process_batch(user_id, operations, current_app.config['BATCH_CHUNK_SIZE'],
+                                        before_commit=lambda results: stage(summary(results), 200))
+                return summary(results), 200
+            except SQLAlchemyError as e:
+                # Raised only before any operation was committed; a 5xx releases the idempotency key
+                logger.error(f"Erro do banco no lote de transações: {str(e)}")
+                raise ServiceUnavailable('Banco de dados indisponível no momento; tente novamente')
+            except Exception as e:
+                logger.error(f"Erro no lote de transações: {str(e)}")
+                raise BadRequest(str(e))
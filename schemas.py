@@ -33,3 +33,24 @@ class TransactionSchema(Schema):
     def validate_amount(self, value):
         if value <= Decimal('0'):
             raise ValidationError('Amount must be greater than 0')
+
+class BatchTransactionSchema(TransactionSchema):
+    account_id = fields.Int(required=True)
+
+class RecurringTransferSchema(Schema):
+    to_account_id = fields.Str(required=True)
+    amount = fields.Decimal(required=True)
+    description = fields.Str(required=True)
+    frequency = fields.Str(required=True)
+    start_at = fields.DateTime(required=False)
+    end_at = fields.DateTime(required=False)
+
+    @validates('frequency')
+    def validate_frequency(self, value):
+        if value not in ['daily', 'weekly', 'monthly']:
+            raise ValidationError('Invalid frequency')
+
+    @validates('amount')
+    def validate_amount(self, value):
+        if value <= Decimal('0'):
+            raise ValidationError('Amount must be greater than 0')
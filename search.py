@@ -0,0 +1,188 @@
+"""Busca de transações por descrição e filtros, com paginação por cursor.
+
+O texto usa o índice de busca do banco: no SQLite, a tabela FTS5
+transactions_fts (mantida por triggers); no Postgres, um índice GIN de
+trigramas (pg_trgm) em transactions.description, usado por ILIKE. Os dois
+são criados junto com a tabela transactions; em bancos já existentes, use
+`flask search reindex`. Sem índice de texto, a busca cai para LIKE.
+
+O escopo são as contas do usuário: para cada conta, cada lado (enviadas e
+recebidas) percorre o índice (conta, created_at, id) em ordem decrescente e
+para na página, como o histórico; o custo depende do tamanho da página e da
+seletividade dos filtros, não do tamanho da tabela.
+"""
+import re
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Optional
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DDL, and_, column, event, select, table, text, tuple_, union_all
+from models import Transaction
+from storage import MAX_PAGE_SIZE
+from utils import decode_cursor
+from app import db
+
+search_cli = AppGroup('search', help='Índice de busca de transações')
+
+FTS_TABLE = 'transactions_fts'
+TRANSACTION_TYPES = ('deposit', 'withdrawal', 'transfer')
+
+# External-content FTS5 table: stores only the index, rows stay in transactions
+SQLITE_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "description, content='transactions', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON transactions BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON transactions BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF description ON transactions BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); "
+    f"INSERT INTO {FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+]
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_transactions_description_trgm "
+    "ON transactions USING gin (description gin_trgm_ops)",
+]
+
+
+def _sqlite_has_fts5(ddl, target, bind, **kw) -> bool:
+    return bind.dialect.name == 'sqlite' and any(
+        row[0] == 'ENABLE_FTS5' for row in bind.exec_driver_sql('PRAGMA compile_options')
+    )
+
+
+for _statement in SQLITE_DDL:
+    event.listen(Transaction.__table__, 'after_create', DDL(_statement).execute_if(callable_=_sqlite_has_fts5))
+for _statement in POSTGRES_DDL:
+    event.listen(Transaction.__table__, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+event.listen(Transaction.__table__, 'before_drop',
+             DDL(f'DROP TABLE IF EXISTS {FTS_TABLE}').execute_if(dialect='sqlite'))
+
+# The FTS table is not mapped; its hidden column named after the table takes MATCH
+_fts = table(FTS_TABLE, column('rowid'), column(FTS_TABLE))
+_fts_ready: Dict[str, bool] = {}
+
+
+def _has_fts() -> bool:
+    """Se a tabela FTS existe neste banco (verificado uma vez por processo)"""
+    engine = db.engine
+    key = engine.url.render_as_string()
+    if key not in _fts_ready:
+        if engine.dialect.name != 'sqlite':
+            _fts_ready[key] = False
+        else:
+            with engine.connect() as conn:
+                _fts_ready[key] = conn.scalar(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {'name': FTS_TABLE}
+                ) is not None
+    return _fts_ready[key]
+
+
+def search_terms(query: str) -> List[str]:
+    return re.findall(r'\w+', query or '')
+
+
+def text_condition(query: str):
+    """Condição sobre Transaction.description; todas as palavras precisam aparecer"""
+    terms = search_terms(query)
+    if not terms:
+        return None
+    if _has_fts():
+        # Quoted prefix terms: user input never reaches the FTS5 query syntax
+        match = ' '.join(f'"{term}"*' for term in terms)
+        # One CTE shared by every branch: the match set is built once per query
+        matches = select(_fts.c.rowid).where(_fts.c[FTS_TABLE].op('MATCH')(match)).cte('fts_matches')
+        return Transaction.id.in_(select(matches.c.rowid))
+    # ILIKE on Postgres, served by the trigram index
+    conditions = [Transaction.description.icontains(term, autoescape=True) for term in terms]
+    return and_(*conditions)
+
+
+def search_statement(account_ids: List[int], limit: int, cursor: Optional[str] = None,
+                     query: Optional[str] = None, transaction_type: Optional[str] = None,
+                     min_amount: Optional[Decimal] = None, max_amount: Optional[Decimal] = None,
+                     start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     counterparty_id: Optional[int] = None):
+    """Consulta de uma página (limit + 1 linhas) das transações das contas que casam com os filtros"""
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    if transaction_type is not None and transaction_type not in TRANSACTION_TYPES:
+        raise ValueError(f"Tipo inválido; use {', '.join(TRANSACTION_TYPES)}")
+
+    filters = []
+    if transaction_type is not None:
+        filters.append(Transaction.transaction_type == transaction_type)
+    if min_amount is not None:
+        filters.append(Transaction.amount >= min_amount)
+    if max_amount is not None:
+        filters.append(Transaction.amount <= max_amount)
+    if start is not None:
+        filters.append(Transaction.created_at >= start)
+    if end is not None:
+        filters.append(Transaction.created_at < end)
+    if cursor:
+        after = decode_cursor(cursor)
+        # The plain bound lets Postgres skip the monthly partitions newer than the cursor
+        filters += [tuple_(Transaction.created_at, Transaction.id) < tuple_(*after), Transaction.created_at <= after[0]]
+    matches = text_condition(query)
+    if matches is not None:
+        filters.append(matches)
+
+    # One branch per account and side: an IN list would sort every match,
+    # a single account walks its index backwards and stops at limit + 1
+    branches = []
+    for account_id in account_ids:
+        outgoing = [Transaction.account_id == account_id]
+        # Transfers between the user's own accounts are listed once, as outgoing
+        incoming = [Transaction.to_account_id == account_id, Transaction.account_id.not_in(account_ids)]
+        if counterparty_id is not None:
+            outgoing.append(Transaction.to_account_id == counterparty_id)
+            incoming.append(Transaction.account_id == counterparty_id)
+        branches.append(outgoing)
+        if transaction_type in (None, 'transfer'):
+            branches.append(incoming)
+
+    selects = [
+        select(
+            select(Transaction.id, Transaction.created_at)
+            .where(*condition, *filters)
+            .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+            .limit(limit + 1)
+            .subquery()
+        )
+        for condition in branches
+    ]
+    page = (union_all(*selects) if len(selects) > 1 else selects[0]).subquery()
+    page_ids = (
+        select(page.c.id)
+        .order_by(page.c.created_at.desc(), page.c.id.desc())
+        .limit(limit + 1)
+        .subquery()
+    )
+    stmt = (
+        select(Transaction)
+        .join(page_ids, Transaction.id == page_ids.c.id)
+        .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+    )
+    return stmt, limit
+
+
+@search_cli.command('reindex')
+def reindex():
+    """Cria o índice de texto (se faltar) e o reconstrói a partir de transactions."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for statement in SQLITE_DDL:
+            db.session.execute(text(statement))
+        db.session.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        for statement in POSTGRES_DDL:
+            db.session.execute(text(statement))
+    else:
+        raise click.ClickException(f'Sem índice de texto para o banco {dialect}; a busca usa LIKE')
+    db.session.commit()
+    _fts_ready.clear()
+    click.echo('Índice de busca reconstruído')
@@ -0,0 +1,188 @@
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, select, union_all
+from models import Account, AccountDailyBalance, Transaction
+from app import db
+import archive
+
+snapshots_cli = AppGroup('snapshots', help='Saldos diários materializados')
+
+
+def record_daily_balances(balances: Dict[int, Decimal], day: date) -> None:
+    """Grava o saldo atual como saldo de fim de dia, na mesma transação do lançamento"""
+    upsert_daily_balances([
+        {'account_id': account_id, 'day': day, 'balance': balance}
+        for account_id, balance in balances.items()
+    ])
+
+
+def daily_balances_statement(dialect: str, rows: List[dict]):
+    """INSERT ... ON CONFLICT que grava os saldos; None se o dialeto não suportar upsert"""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(AccountDailyBalance).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[AccountDailyBalance.account_id, AccountDailyBalance.day],
+        set_={'balance': stmt.excluded.balance}
+    )
+
+
+def upsert_daily_balances(rows: List[dict]) -> None:
+    if not rows:
+        return
+    stmt = daily_balances_statement(db.session.get_bind().dialect.name, rows)
+    if stmt is None:
+        for row in rows:
+            db.session.merge(AccountDailyBalance(**row))
+        return
+    db.session.execute(stmt)
+
+
+def account_movements(account_id: Optional[int] = None,
+                      start: Optional[datetime] = None,
+                      end: Optional[datetime] = None,
+                      account_ids=None):
+    """Movimentos com sinal por conta: (account_id, transaction_id, created_at, amount)
+
+    `account_ids` (lista ou subconsulta de ids) restringe a várias contas de uma vez.
+    """
+    outgoing = select(
+        Transaction.account_id.label('account_id'),
+        Transaction.id.label('transaction_id'),
+        Transaction.created_at.label('created_at'),
+        case((Transaction.transaction_type == 'deposit', Transaction.amount),
+             else_=-Transaction.amount).label('amount')
+    )
+    incoming = select(
+        Transaction.to_account_id.label('account_id'),
+        Transaction.id.label('transaction_id'),
+        Transaction.created_at.label('created_at'),
+        Transaction.amount.label('amount')
+    ).where(Transaction.transaction_type == 'transfer', Transaction.to_account_id.is_not(None))
+    # Filters go inside each branch so both can use their (account, created_at) index
+    if account_id is not None:
+        outgoing = outgoing.where(Transaction.account_id == account_id)
+        incoming = incoming.where(Transaction.to_account_id == account_id)
+    if account_ids is not None:
+        outgoing = outgoing.where(Transaction.account_id.in_(account_ids))
+        incoming = incoming.where(Transaction.to_account_id.in_(account_ids))
+    if start is not None:
+        outgoing = outgoing.where(Transaction.created_at >= start)
+        incoming = incoming.where(Transaction.created_at >= start)
+    if end is not None:
+        outgoing = outgoing.where(Transaction.created_at < end)
+        incoming = incoming.where(Transaction.created_at < end)
+    return union_all(outgoing, incoming).subquery()
+
+
+def balance_before(account_id: int, day: date) -> Decimal:
+    """Saldo no fim do dia anterior a `day`, a partir do snapshot mais próximo"""
+    balance = db.session.scalar(
+        select(AccountDailyBalance.balance)
+        .where(AccountDailyBalance.account_id == account_id, AccountDailyBalance.day < day)
+        .order_by(AccountDailyBalance.day.desc())
+        .limit(1)
+    )
+    return balance if balance is not None else Decimal('0')
+
+
+def build_statement(account_id: int, start: date, end: date) -> dict:
+    """Extrato do período: parte do snapshot mais próximo e lê só as transações do intervalo"""
+    opening = balance_before(account_id, start)
+    start_at = datetime.combine(start, time.min)
+    end_at = datetime.combine(end + timedelta(days=1), time.min)
+    rows = []
+    months = archive.catalog()
+    edge = archive.boundary(months)
+    if edge is not None and start_at < edge:
+        # Archived months come from their files; the database only after them
+        rows = [row._replace(amount=archive.signed_amount(row, account_id))
+                for row in archive.account_history(account_id, months, start_at, end_at)]
+        start_at = edge
+    if start_at < end_at:
+        movements = account_movements(account_id, start=start_at, end=end_at)
+        rows += db.session.execute(
+            select(
+                Transaction.id, Transaction.transaction_type, Transaction.description,
+                Transaction.to_account_id, Transaction.created_at, movements.c.amount
+            )
+            .join(movements, Transaction.id == movements.c.transaction_id)
+            .order_by(movements.c.created_at, movements.c.transaction_id)
+        ).all()
+
+    balance = opening
+    transactions = []
+    for row in rows:
+        balance += row.amount
+        transactions.append({
+            'id': row.id,
+            'type': row.transaction_type,
+            'amount': str(row.amount),
+            'balance': str(balance),
+            'description': row.description,
+            'created_at': row.created_at.isoformat(),
+            'to_account_id': row.to_account_id
+        })
+    return {
+        'account_id': account_id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'opening_balance': str(opening),
+        'closing_balance': str(balance),
+        'transactions': transactions
+    }
+
+
+@snapshots_cli.command('backfill')
+@click.option('--account-id', type=int, default=None, help='Reconstrói apenas esta conta')
+@click.option('--chunk-size', type=int, default=1000, help='Linhas lidas e gravadas por vez')
+def backfill(account_id: Optional[int], chunk_size: int):
+    """Reconstrói os saldos diários a partir do histórico de transações."""
+    movements = account_movements(account_id)
+    current = select(Account.id, Account.balance)
+    if account_id is not None:
+        current = current.where(Account.id == account_id)
+    balances = dict(db.session.execute(current).all())
+
+    pending: List[dict] = []
+    written = 0
+
+    def flush_account(account, per_day):
+        # Anchor the replay on the current balance so the newest snapshot
+        # always matches accounts.balance.
+        if account not in balances:
+            return
+        balance = balances[account] - sum(per_day.values(), Decimal('0'))
+        for day in sorted(per_day):
+            balance += per_day[day]
+            pending.append({'account_id': account, 'day': day, 'balance': balance})
+
+    rows = db.session.execute(
+        select(movements.c.account_id, movements.c.created_at, movements.c.amount)
+        .order_by(movements.c.account_id, movements.c.created_at, movements.c.transaction_id)
+        .execution_options(yield_per=chunk_size)
+    )
+    last_account, per_day = None, {}
+    for row in rows:
+        if row.account_id != last_account:
+            flush_account(last_account, per_day)
+            last_account, per_day = row.account_id, {}
+        day = row.created_at.date()
+        per_day[day] = per_day.get(day, Decimal('0')) + row.amount
+        if len(pending) >= chunk_size:
+            upsert_daily_balances(pending)
+            written += len(pending)
+            pending.clear()
+    flush_account(last_account, per_day)
+    upsert_daily_balances(pending)
+    written += len(pending)
+
+    db.session.commit()
+    click.echo(f'{written} saldos diários gravados')
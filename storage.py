@@ -1,18 +1,75 @@
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from flask import current_app
+from sqlalchemy import case, event, func, inspect, select, tuple_, union_all
+from sqlalchemy.orm import Session, joinedload, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 from models import User, Account, Transaction
+from cache import create_cache, user_keys, account_keys, invalidate_on_commit
+from utils import encode_cursor, decode_cursor
+from snapshots import account_movements
 from app import db
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+DASHBOARD_WINDOW_DAYS = 30
+# Invalidation only reaches the writing process (and not at all for bulk
+# updates), so the balance is never cached: it always comes from the database
+ACCOUNT_CACHED_COLUMNS = ('id', 'user_id', 'account_number', 'account_type', 'created_at')
+
 class Storage:
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = create_cache(current_app.config)
+        return self._cache
+
+    def _cached(self, model, key: str, load, columns: Optional[Tuple[str, ...]] = None):
+        """Lê do cache (valores são as colunas `columns` da linha, ou todas) ou do banco via `load`"""
+        data = self.cache.get(key)
+        if data is not None:
+            # An instance already in the session is at least as fresh as the cache
+            existing = db.session.identity_map.get(identity_key(model, data['id']))
+            if existing is not None:
+                return existing
+            instance = model(**data)
+            # Columns left out of the cache are expired and load on first access
+            make_transient_to_detached(instance)
+            return db.session.merge(instance, load=False)
+        instance = load()
+        if instance is not None:
+            self.cache.set(key, {
+                attr.key: getattr(instance, attr.key)
+                for attr in model.__mapper__.column_attrs
+                if columns is None or attr.key in columns
+            })
+        return instance
+
+    def _cached_id(self, key: str, load) -> Optional[int]:
+        value = self.cache.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.cache.set(key, value)
+        return value
+
     def create_user(self, user: User) -> User:
         db.session.add(user)
         db.session.commit()
         return user
 
     def get_user_by_username(self, username: str) -> Optional[User]:
-        return User.query.filter_by(username=username).first()
+        user_id = self._cached_id(
+            f'user:name:{username}',
+            lambda: db.session.scalar(select(User.id).where(User.username == username))
+        )
+        return self.get_user_by_id(user_id) if user_id is not None else None
 
     def get_user_by_id(self, user_id: str) -> Optional[User]:
-        return User.query.get(user_id)
+        return self._cached(User, f'user:{int(user_id)}', lambda: db.session.get(User, int(user_id)))
 
     def create_account(self, account: Account) -> Account:
         db.session.add(account)
@@ -20,21 +77,152 @@ class Storage:
         return account
 
     def get_account(self, account_id: str) -> Optional[Account]:
-        return Account.query.get(account_id)
+        return self._cached(
+            Account, f'account:{int(account_id)}', lambda: db.session.get(Account, int(account_id)),
+            ACCOUNT_CACHED_COLUMNS
+        )
+
+    def account_reference(self, account_id) -> Account:
+        """Conta só com o id, sem consulta; os demais atributos carregam no primeiro acesso"""
+        instance = Account(id=int(account_id))
+        make_transient_to_detached(instance)
+        return db.session.merge(instance, load=False)
+
+    def get_account_by_number(self, account_number: str) -> Optional[Account]:
+        account_id = self._cached_id(
+            f'account:number:{account_number}',
+            lambda: db.session.scalar(select(Account.id).where(Account.account_number == account_number))
+        )
+        return self.get_account(account_id) if account_id is not None else None
 
     def get_user_accounts(self, user_id: str) -> List[Account]:
         return Account.query.filter_by(user_id=user_id).all()
 
+    def get_dashboard_summary(self, user_id: str, days: int = DASHBOARD_WINDOW_DAYS) -> List[Dict]:
+        """Contas do usuário com última movimentação e entradas/saídas do período, em uma só consulta"""
+        user_accounts = select(Account.id).where(Account.user_id == int(user_id))
+        movements = account_movements(
+            start=datetime.utcnow() - timedelta(days=days), account_ids=user_accounts
+        )
+        flows = (
+            select(
+                movements.c.account_id,
+                func.sum(case((movements.c.amount > 0, movements.c.amount), else_=0)).label('inflow'),
+                func.sum(case((movements.c.amount < 0, -movements.c.amount), else_=0)).label('outflow')
+            )
+            .group_by(movements.c.account_id)
+            .subquery()
+        )
+        # max() over each (account, created_at) index is a single index probe
+        last_sent = (
+            select(func.max(Transaction.created_at))
+            .where(Transaction.account_id == Account.id)
+            .scalar_subquery()
+        )
+        last_received = (
+            select(func.max(Transaction.created_at))
+            .where(Transaction.to_account_id == Account.id)
+            .scalar_subquery()
+        )
+        rows = db.session.execute(
+            select(Account, flows.c.inflow, flows.c.outflow,
+                   last_sent.label('last_sent'), last_received.label('last_received'))
+            .outerjoin(flows, flows.c.account_id == Account.id)
+            .where(Account.user_id == int(user_id))
+            .order_by(Account.id)
+        )
+        return [{
+            'account': row.Account,
+            'last_transaction_at': max(filter(None, (row.last_sent, row.last_received)), default=None),
+            'inflow': row.inflow or 0,
+            'outflow': row.outflow or 0
+        } for row in rows]
+
     def create_transaction(self, transaction: Transaction) -> Transaction:
         db.session.add(transaction)
         db.session.commit()
         return transaction
 
-    def get_account_transactions(self, account_id: str) -> List[Transaction]:
-        return Transaction.query.filter(
-            (Transaction.account_id == account_id) | 
-            (Transaction.to_account_id == account_id)
-        ).all()
+    def get_account_transactions(
+        self,
+        account_id: str,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Transaction], Optional[str]]:
+        """Retorna uma página do histórico (mais recentes primeiro) e o cursor da próxima."""
+        stmt, limit = self.history_statement(account_id, limit, cursor)
+        # The history page shows the destination account number of each row
+        stmt = stmt.options(joinedload(Transaction.to_account))
+        return self.split_page(db.session.scalars(stmt).all(), limit)
+
+    def history_statement(self, account_id, limit: int, cursor: Optional[str]):
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        after = decode_cursor(cursor) if cursor else None
+
+        # Each side of the old OR becomes its own branch so it can walk its
+        # (account, created_at, id) index; self-transfers only count once.
+        outgoing = self._history_branch(Transaction.account_id == account_id, limit, after)
+        incoming = self._history_branch(
+            (Transaction.to_account_id == account_id) & (Transaction.account_id != account_id),
+            limit, after
+        )
+        page = union_all(select(outgoing), select(incoming)).subquery()
+        page_ids = (
+            select(page.c.id)
+            .order_by(page.c.created_at.desc(), page.c.id.desc())
+            .limit(limit + 1)
+            .subquery()
+        )
+        stmt = (
+            select(Transaction)
+            .join(page_ids, Transaction.id == page_ids.c.id)
+            .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+        )
+        return stmt, limit
+
+    @staticmethod
+    def split_page(transactions: List[Transaction], limit: int) -> Tuple[List[Transaction], Optional[str]]:
+        next_cursor = None
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            last = transactions[-1]
+            next_cursor = encode_cursor(last.created_at, last.id)
+        return transactions, next_cursor
+
+    @staticmethod
+    def _history_branch(condition, limit, after):
+        stmt = select(Transaction.id, Transaction.created_at).where(condition)
+        if after:
+            # The plain bound repeats the row comparison so Postgres can skip
+            # the monthly partitions newer than the cursor
+            stmt = stmt.where(tuple_(Transaction.created_at, Transaction.id) < tuple_(*after),
+                              Transaction.created_at <= after[0])
+        return (
+            stmt.order_by(Transaction.created_at.desc(), Transaction.id.desc())
+            .limit(limit + 1)
+            .subquery()
+        )
 
 # Initialize global storage
-storage = Storage()
\ No newline at end of file
+storage = Storage()
+
+@event.listens_for(Session, 'after_flush')
+def _collect_cache_keys(session, flush_context):
+    keys = []
+    for instance in session.dirty | session.deleted:
+        if isinstance(instance, User):
+            keys += user_keys(instance.id, instance.username)
+            keys += [f'user:name:{name}' for name in inspect(instance).attrs.username.history.deleted or ()]
+        elif isinstance(instance, Account):
+            keys += account_keys(instance.id, instance.account_number)
+    invalidate_on_commit(session, keys)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_cache(session):
+    keys = session.info.pop('cache_keys', None)
+    if keys and storage._cache is not None:
+        storage.cache.delete(*keys)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_cache_keys(session):
+    session.info.pop('cache_keys', None)
@@ -1,43 +1,212 @@
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
 from decimal import Decimal
-from typing import Tuple
-from models import Account
+from typing import Callable, Dict, Generator, Iterable, Optional, Tuple
+from sqlalchemy import select, update
+from sqlalchemy.exc import SQLAlchemyError
+from models import Account, AccountDailyBalance, LedgerEntry, Transaction
+from cache import account_keys, invalidate_on_commit
+from hashing import get_hashing_service
+from snapshots import daily_balances_statement
+from ledger import ledger_legs
+from risk import NO_RESERVATION, Reservation, check_debit
+from app import db
 
 def hash_password(password: str) -> str:
-    return generate_password_hash(password)
+    return get_hashing_service(current_app).hash(password)
 
 def verify_password(password_hash: str, password: str) -> bool:
-    return check_password_hash(password_hash, password)
+    return get_hashing_service(current_app).verify(password_hash, password)
+
+def password_needs_rehash(password_hash: str) -> bool:
+    return get_hashing_service(current_app).needs_rehash(password_hash)
+
+def encode_cursor(created_at: datetime, transaction_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{transaction_id}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, transaction_id = urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(transaction_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Cursor inválido')
+
+# Statement builders shared by the sync engine below and the async API (asgi.py)
+def lock_accounts_statement(account_ids: Iterable[int]):
+    return select(Account.id).where(Account.id.in_(sorted(set(account_ids)))).order_by(Account.id).with_for_update()
+
+def debit_statement(account_id: int, amount: Decimal):
+    # The balance check and the debit are one statement, so two concurrent
+    # withdrawals can never both pass the same check.
+    return (
+        update(Account)
+        .where(Account.id == account_id, Account.balance >= amount)
+        .values(balance=Account.balance - amount)
+        .returning(Account.balance)
+        .execution_options(synchronize_session=False)
+    )
+
+def credit_statement(account_id: int, amount: Decimal):
+    return (
+        update(Account)
+        .where(Account.id == account_id)
+        .values(balance=Account.balance + amount)
+        .returning(Account.balance)
+        .execution_options(synchronize_session=False)
+    )
+
+def transaction_steps(
+    account_id: int,
+    transaction_type: str,
+    amount: Decimal,
+    description: str,
+    to_account_id: Optional[int],
+    dialect: str
+) -> Generator[Tuple[str, object], object, Tuple[str, Optional[Transaction], Dict[int, Decimal]]]:
+    """Passos de uma operação, executados pelo motor síncrono e pela API assíncrona.
+
+    Cada passo é ('execute', instrução), cujo resultado volta pelo send,
+    ('add', objeto) ou ('merge', objeto). Retorna (mensagem, transação ou
+    None se o saldo for insuficiente, novos saldos).
+    """
+    now = datetime.utcnow()
+    balances = {}
+    if transaction_type == 'deposit':
+        balances[account_id] = (yield 'execute', credit_statement(account_id, amount)).scalar_one()
+        message = "Depósito realizado com sucesso"
+    else:
+        if transaction_type == 'transfer':
+            # Always in ascending id order, so two opposite transfers cannot deadlock
+            (yield 'execute', lock_accounts_statement([account_id, to_account_id])).all()
+        balances[account_id] = (yield 'execute', debit_statement(account_id, amount)).scalar_one_or_none()
+        if balances[account_id] is None:
+            return "Saldo insuficiente", None, {}
+        if transaction_type == 'transfer':
+            balances[to_account_id] = (yield 'execute', credit_statement(to_account_id, amount)).scalar_one()
+            message = "Transferência realizada com sucesso"
+        else:
+            message = "Saque realizado com sucesso"
+
+    transaction = Transaction(
+        account_id=account_id,
+        transaction_type=transaction_type,
+        amount=amount,
+        description=description,
+        to_account_id=to_account_id,
+        created_at=now,
+        ledger_entries=[
+            LedgerEntry(**leg, created_at=now)
+            for leg in ledger_legs(transaction_type, account_id, amount, to_account_id)
+        ]
+    )
+    yield 'add', transaction
+    # The new balances are the end-of-day balances, written in the same transaction
+    rows = [{'account_id': key, 'day': now.date(), 'balance': value} for key, value in balances.items()]
+    stmt = daily_balances_statement(dialect, rows)
+    if stmt is None:
+        for row in rows:
+            yield 'merge', AccountDailyBalance(**row)
+    else:
+        yield 'execute', stmt
+    return message, transaction, balances
+
+def _run_steps(steps):
+    result = None
+    try:
+        while True:
+            kind, value = steps.send(result)
+            result = None
+            if kind == 'execute':
+                result = db.session.execute(value)
+            elif kind == 'add':
+                db.session.add(value)
+            else:
+                db.session.merge(value)
+    except StopIteration as done:
+        return done.value
+
+def apply_transaction(
+    account_id: int,
+    transaction_type: str,
+    amount: Decimal,
+    description: str,
+    to_account_id: Optional[int] = None
+) -> Tuple[str, Optional[Transaction], Dict[int, Decimal], Reservation]:
+    """Aplica a operação na transação aberta do banco, sem commit nem rollback.
+
+    Devolve (mensagem, transação já com id ou None se recusada, novos saldos,
+    reserva do limite a confirmar depois do commit). Uma recusa não deixa
+    nada gravado; em erro do banco a reserva é liberada aqui.
+    """
+    reservation = NO_RESERVATION
+    if transaction_type != 'deposit':
+        # Velocity limits are checked in memory before any row is touched
+        refused, reservation = check_debit(account_id, amount)
+        if refused:
+            return refused, None, {}, NO_RESERVATION
+
+    for changed in filter(None, (account_id, to_account_id)):
+        invalidate_on_commit(db.session, account_keys(changed))
+    try:
+        message, transaction, balances = _run_steps(transaction_steps(
+            account_id, transaction_type, amount, description, to_account_id,
+            db.session.get_bind().dialect.name
+        ))
+        if transaction is None:
+            reservation.release()
+            return message, None, {}, NO_RESERVATION
+        db.session.flush()
+    except SQLAlchemyError:
+        reservation.release()
+        raise
+    return message, transaction, balances, reservation
 
 def process_transaction(
     account: Account,
     transaction_type: str,
     amount: Decimal,
     description: str,
-    to_account_number: str = None
-) -> Tuple[bool, str]:
-    if transaction_type == 'deposit':
-        account.balance += amount
-        return True, "Depósito realizado com sucesso"
+    to_account_number: str = None,
+    before_commit: Optional[Callable[[Transaction, str, Dict[int, Decimal]], None]] = None
+) -> Tuple[bool, str, Optional[Transaction]]:
+    """Aplica a transação e grava o registro em uma única transação do banco.
 
-    elif transaction_type == 'withdrawal':
-        if account.balance >= amount:
-            account.balance -= amount
-            return True, "Saque realizado com sucesso"
-        return False, "Saldo insuficiente"
+    `before_commit(transação, mensagem, saldos)` roda nessa mesma transação,
+    logo antes do commit, com o id da transação e os novos saldos.
+    """
+    if transaction_type not in ('deposit', 'withdrawal', 'transfer'):
+        return False, "Tipo de transação inválido", None
 
-    elif transaction_type == 'transfer':
+    to_account_id = None
+    if transaction_type == 'transfer':
         if not to_account_number:
-            return False, "Número da conta de destino não especificado"
+            return False, "Número da conta de destino não especificado", None
 
-        to_account = Account.query.filter_by(account_number=to_account_number).first()
-        if not to_account:
-            return False, "Conta de destino não encontrada"
+        from storage import storage
+        to_account = storage.get_account_by_number(to_account_number)
+        if to_account is None:
+            return False, "Conta de destino não encontrada", None
+        to_account_id = to_account.id
 
-        if account.balance >= amount:
-            account.balance -= amount
-            to_account.balance += amount
-            return True, "Transferência realizada com sucesso"
-        return False, "Saldo insuficiente"
+    reservation = NO_RESERVATION
+    try:
+        message, transaction, balances, reservation = apply_transaction(
+            account.id, transaction_type, amount, description, to_account_id
+        )
+        if transaction is None:
+            db.session.rollback()
+            return False, message, None
+        transaction_id = transaction.id
+        if before_commit:
+            before_commit(transaction, message, balances)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        reservation.release()
+        raise
 
-    return False, "Tipo de transação inválido"
\ No newline at end of file
+    reservation.confirm(transaction_id)
+    return True, message, transaction